@@ -145,6 +145,20 @@ class RPCError(Exception):
         'FLOOD_WAIT_(\d+)': 'A wait of {} seconds is required.'
     }
 
+    # Numbers within the error messages, which are replaced by (\d+) to get their key
+    NumberRegex = re.compile(r'(?<=_)\d+(?=_|$)')
+
+    def __new__(cls, code, message):
+        # Classify the message only once, to create the right exception subclass
+        key, additional_data = RPCError.classify(message)
+        if cls is RPCError:
+            cls = RPCError.ErrorClasses.get(key, RPCError)
+
+        error = super().__new__(cls, code, message)
+        error.error_key = key
+        error.additional_data = additional_data
+        return error
+
     def __init__(self, code, message):
         self.code = code
         self.code_meaning = RPCError.CodeMessages[code]
@@ -152,30 +166,80 @@ class RPCError(Exception):
         self.message = message
         self.must_resend = code == 303  # ERROR_SEE_OTHER, "The request must be repeated"
 
-        called_super = False
-        for key, error_msg in RPCError.ErrorMessages.items():
-            match = re.match(key, message)
-            if match:
-                # Get additional_data, if any
-                if match.groups():
-                    self.additional_data = int(match.group(1))
-                    super().__init__(self,
-                                     error_msg.format(self.additional_data))
-                else:
-                    self.additional_data = None
-                    super().__init__(self, error_msg)
-
-                    # Add another field to easily determine whether this error
-                    # should be handled as a password-required error
-                    self.password_required = message == 'SESSION_PASSWORD_NEEDED'
-
-                called_super = True
-                break
-
-        if not called_super:
+        # Add another field to easily determine whether this error
+        # should be handled as a password-required error
+        self.password_required = message == 'SESSION_PASSWORD_NEEDED'
+
+        if self.error_key is None:
             super().__init__(
                 self, 'Unknown error message with code {}: {}'.format(code,
                                                                       message))
+        elif self.additional_data is None:
+            super().__init__(self, RPCError.ErrorMessages[self.error_key])
+        else:
+            super().__init__(self, RPCError.ErrorMessages[self.error_key]
+                             .format(self.additional_data))
+
+    @staticmethod
+    def classify(message):
+        """Finds the key in ErrorMessages matching the given error message,
+           and its additional data (the number within it) if there is any.
+           Returns (None, None) if the error message is unknown"""
+        match = RPCError.NumberRegex.search(message)
+        if match:
+            key = '{}(\\d+){}'.format(message[:match.start()],
+                                     message[match.end():])
+            if key in RPCError.ErrorMessages:
+                return key, int(match.group())
+
+        if message in RPCError.ErrorMessages:
+            return message, None
+
+        return None, None
+
+
+class FloodWaitError(RPCError):
+    """Occurs when too many requests were made (FLOOD_WAIT_X)"""
+
+    @property
+    def seconds(self):
+        """How many seconds must be waited before repeating the request"""
+        return self.additional_data
+
+
+class MigrateError(RPCError):
+    """Occurs when the request must be repeated in a different data center (*_MIGRATE_X)"""
+
+    @property
+    def new_dc(self):
+        """The ID of the data center where the request must be repeated"""
+        return self.additional_data
+
+
+class FileMigrateError(MigrateError):
+    """Occurs when the file to be accessed is stored in a different data center"""
+
+
+class PhoneMigrateError(MigrateError):
+    """Occurs when the phone number is associated with a different data center"""
+
+
+class NetworkMigrateError(MigrateError):
+    """Occurs when the source IP address is associated with a different data center"""
+
+
+class UserMigrateError(MigrateError):
+    """Occurs when the user is associated with a different data center"""
+
+
+# The exception subclass to be created for every key in RPCError.ErrorMessages
+RPCError.ErrorClasses = {
+    'FILE_MIGRATE_(\\d+)': FileMigrateError,
+    'PHONE_MIGRATE_(\\d+)': PhoneMigrateError,
+    'NETWORK_MIGRATE_(\\d+)': NetworkMigrateError,
+    'USER_MIGRATE_(\\d+)': UserMigrateError,
+    'FLOOD_WAIT_(\\d+)': FloodWaitError
+}
 
 
 class BadMessageError(Exception):
@@ -15,6 +15,60 @@ def ensure_parent_dir_exists(file_path):
     if parent:
         os.makedirs(parent, exist_ok=True)
 
+
+def get_stream_size(stream):
+    """Gets the size of the remaining data in the given stream,
+       or None if it cannot be known without reading it (it's not seekable)"""
+    seekable = getattr(stream, 'seekable', None)
+    if not seekable or not seekable():
+        return None
+
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END) - position
+    stream.seek(position)
+    return size
+
+
+def iter_stream_parts(stream, part_size):
+    """Iterates over the given stream yielding parts of exactly part_size bytes,
+       except for the last one, which may be smaller (but never empty)"""
+    while True:
+        part = stream.read(part_size)
+        if not part:
+            return
+
+        # Some streams may return less data than requested before they are over
+        while len(part) < part_size:
+            remaining = stream.read(part_size - len(part))
+            if not remaining:
+                break
+            part += remaining
+
+        yield part
+        if len(part) < part_size:
+            return
+
+
+def enumerate_parts(parts, part_count=None):
+    """Iterates over the given parts yielding tuple(index, total parts, part).
+       If part_count is None (not known), the total is -1 for every part but
+       the last one, which is read ahead to find out when the parts are over"""
+    parts = iter(parts)
+    index = 0
+    part = next(parts, None)
+    while part is not None:
+        next_part = next(parts, None)
+        if part_count is not None:
+            total_parts = part_count
+        elif next_part is None:
+            total_parts = index + 1
+        else:
+            total_parts = -1
+
+        yield index, total_parts, part
+        index += 1
+        part = next_part
+
 # endregion
 
 # region Cryptographic related utils
@@ -64,8 +64,10 @@ class InteractiveTelegramClient(TelegramClient):
                         raise e
 
     def run(self):
-        # Listen for updates
-        self.add_update_handler(self.update_handler)
+        # Listen for updates (only those which will be printed)
+        self.add_update_handler(
+            self.update_handler,
+            types=(UpdateShortMessage, UpdateShortChatMessage))
 
         # Enter a while loop to chat as long as the user wants
         while True:
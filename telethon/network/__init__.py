@@ -1,5 +1,8 @@
 from .mtproto_plain_sender import MtProtoPlainSender
+from .framing import (AbridgedFraming, Framing, FullFraming,
+                      IntermediateFraming, ObfuscatedFraming)
 from .tcp_client import TcpClient
 from .authenticator import do_authentication
 from .mtproto_sender import MtProtoSender
 from .tcp_transport import TcpTransport
+from .update_dispatcher import UpdateDispatcher
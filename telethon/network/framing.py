@@ -0,0 +1,152 @@
+import os
+from binascii import crc32
+from struct import pack, unpack
+
+import pyaes
+
+from telethon.errors import InvalidChecksumError
+
+# Original reference: https://core.telegram.org/mtproto#tcp-transport
+# Every framing tells how the packets are delimited on a TCP connection. A new
+# instance must be used for every connection, since some of them keep state.
+
+
+class Framing:
+    """Shared interface of the framings which can be used by a TcpTransport"""
+
+    def connection_header(self):
+        """Gets the bytes which must be sent once, when the connection is open,
+           to let the server know which framing will be used"""
+        return b''
+
+    def encode(self, parts):
+        """Encodes the given packet, as a list of the bytes-like objects it's made
+           of, into the list of parts of the frame to be sent. The parts are never
+           joined, so that they can be sent together without copying them"""
+        raise NotImplementedError
+
+    def read_frame(self, read):
+        """Reads a frame through the given read function, which reads exactly as
+           many bytes as requested. Returns tuple(sequence number or None, packet)"""
+        raise NotImplementedError
+
+
+class FullFraming(Framing):
+    """The packets are encoded as: total length, sequence number, packet and
+       checksum (CRC32). This is the default, although it's the most expensive"""
+
+    def __init__(self):
+        self.send_counter = 0
+
+    def encode(self, parts):
+        # The checksum is calculated incrementally from the parts
+        length = sum(len(part) for part in parts) + 12  # 12 = size_of (integer) * 3
+        header = pack('<ii', length, self.send_counter)
+        crc = crc32(header)
+        for part in parts:
+            crc = crc32(part, crc)
+
+        self.send_counter += 1
+        return [header] + parts + [pack('<I', crc)]
+
+    def read_frame(self, read):
+        header = read(8)
+        length, seq = unpack('<ii', header)
+        body = read(length - 12)
+        checksum, = unpack('<I', read(4))
+
+        # The checksum is calculated from the parts instead of joining them
+        valid_checksum = crc32(body, crc32(header))
+        if checksum != valid_checksum:
+            raise InvalidChecksumError(checksum, valid_checksum)
+
+        return seq, body
+
+
+class IntermediateFraming(Framing):
+    """The packets are only preceded by their length, which saves the
+       sequence number and the checksum (TCP already has its own)"""
+
+    # Also used to tell this framing apart when it's obfuscated
+    Tag = b'\xee\xee\xee\xee'
+
+    def connection_header(self):
+        return IntermediateFraming.Tag
+
+    def encode(self, parts):
+        return [pack('<i', sum(len(part) for part in parts))] + parts
+
+    def read_frame(self, read):
+        length, = unpack('<i', read(4))
+        return None, read(length)
+
+
+class AbridgedFraming(Framing):
+    """The packets are only preceded by their length divided by four, which
+       takes a single byte unless they're longer than 508 bytes"""
+
+    # Also used to tell this framing apart when it's obfuscated
+    Tag = b'\xef\xef\xef\xef'
+
+    def connection_header(self):
+        return b'\xef'
+
+    def encode(self, parts):
+        length = sum(len(part) for part in parts) >> 2
+        if length < 127:
+            return [bytes((length, ))] + parts
+        return [b'\x7f' + length.to_bytes(3, 'little')] + parts
+
+    def read_frame(self, read):
+        length = read(1)[0] & 0x7f  # The high bit only requests a quick ack
+        if length == 0x7f:
+            length = int.from_bytes(read(3), 'little')
+        return None, read(length << 2)
+
+
+class ObfuscatedFraming(Framing):
+    """Another framing (intermediate or abridged) whose frames are encrypted
+       with AES-256-CTR, so that the connection doesn't look like MTProto.
+       The keys are randomly chosen and sent in the connection header"""
+
+    # The first bytes of the header must not look like any other protocol
+    ForbiddenStarts = (b'HEAD', b'POST', b'GET ', b'OPTI', b'\x16\x03\x01\x02',
+                       IntermediateFraming.Tag, b'\xdd\xdd\xdd\xdd')
+
+    def __init__(self, framing=None):
+        self.framing = framing or IntermediateFraming()
+        self.encryptor = None
+        self.decryptor = None
+
+    def connection_header(self):
+        while True:
+            random = os.urandom(64)
+            if (random[0] != 0xef and random[:4] not in self.ForbiddenStarts and
+                    random[4:8] != b'\0\0\0\0'):
+                break
+
+        random = random[:56] + self.framing.Tag + random[60:]
+        random_reversed = random[55:7:-1]  # Reversed bytes 8 to 55
+
+        self.encryptor = ObfuscatedFraming.create_cipher(random[8:40],
+                                                         random[40:56])
+        self.decryptor = ObfuscatedFraming.create_cipher(random_reversed[:32],
+                                                         random_reversed[32:48])
+
+        # The last 8 bytes are sent encrypted, so the server can verify the keys
+        return random[:56] + self.encryptor.encrypt(random)[56:]
+
+    @staticmethod
+    def create_cipher(key, iv):
+        """Creates an AES-256-CTR cipher with the given key and initial counter"""
+        return pyaes.AESModeOfOperationCTR(
+            key, pyaes.Counter(int.from_bytes(iv, 'big')))
+
+    def encode(self, parts):
+        # The parts are encrypted in order, just as if they were a single one
+        return [self.encryptor.encrypt(bytes(part))
+                for part in self.framing.encode(parts)]
+
+    def read_frame(self, read):
+        return self.framing.read_frame(
+            lambda count: self.decryptor.decrypt(read(count)))
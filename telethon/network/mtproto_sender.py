@@ -1,44 +1,97 @@
-import gzip
+import os
+import random
+import zlib
 from datetime import timedelta
-from threading import RLock, Thread
-from time import sleep, time
+from struct import pack, pack_into
+from threading import Condition, Event, Lock, Thread, current_thread
+from time import monotonic
 
 import telethon.helpers as utils
 from telethon.crypto import AES
 from telethon.errors import *
+from telethon.network.update_dispatcher import UpdateDispatcher
 from telethon.tl.all_tlobjects import tlobjects
 from telethon.tl.types import MsgsAck
-from telethon.tl.functions import PingRequest
+from telethon.tl.functions import PingDelayDisconnectRequest
+from telethon.tl.functions.upload import (SaveBigFilePartRequest,
+                                          SaveFilePartRequest)
 from telethon.utils import BinaryReader, BinaryWriter
 
 
 class MtProtoSender:
     """MTProto Mobile Protocol sender (https://core.telegram.org/mtproto/description)"""
 
-    def __init__(self, transport, session):
+    # File parts are usually compressed already, so compressing them is not worth it
+    NeverCompressed = (SaveFilePartRequest, SaveBigFilePartRequest)
+
+    def __init__(self, transport, session, updates=None,
+                 ping_interval=60, ping_timeout=10, auto_reconnect=True,
+                 max_reconnects=5, reconnect_delay=0.5, max_reconnect_delay=30,
+                 compression_threshold=None, compression_level=6):
+        """The updates (an UpdateDispatcher) may be given to keep
+           the same handlers when the connection is replaced.
+
+           A ping is sent every ping_interval seconds to keep the connection alive.
+           If its pong takes longer than ping_timeout seconds to arrive, the connection
+           is considered dead. The server will also close it if no ping arrives
+           in ping_interval + ping_timeout seconds.
+
+           If auto_reconnect is True, dead connections are replaced by new ones (up
+           to max_reconnects times in a row) with the same auth key and session.
+           The delay between the attempts starts at reconnect_delay seconds and
+           doubles every time (up to max_reconnect_delay), with random jitter.
+
+           If compression_threshold is given, the requests which are serialized into
+           at least as many bytes are sent as gzip_packed (compressed with the given
+           zlib compression_level), as long as that makes them smaller"""
         self.transport = transport
         self.session = session
 
         self.need_confirmation = []  # Message IDs that need confirmation
-        self.on_update_handlers = []
-
-        # Store an RLock instance to make this class safely multi-threaded
-        self.lock = RLock()
-
-        # Flag used to determine whether we've received a sent request yet or not
-        # We need this to avoid using the updates thread if we're waiting to read
-        self.waiting_receive = False
-
-        self.updates_thread = Thread(
-            target=self.updates_thread_method, name='Updates thread')
-
-        # Signal for correct stopping update thread
-        self.updates_thread_stopping = False
-
-        self.ping_interval = 60
-        self.ping_time_last = time()
-
-        self.updates_thread_receiving = False
+        self.pending_requests = {}  # Message IDs of the sent requests: request
+        self.acked_msg_ids = set()  # Those pending which the server received
+        self.updates = updates or UpdateDispatcher()
+
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+
+        # Only one thread may send at once, while the reader thread owns
+        # receiving and notifies whoever waits for the requests it fills in
+        self.write_lock = Lock()
+        self.received = Condition()
+
+        # The reader thread only needs this one to add the messages to confirm,
+        # so it never waits for the writers (which may be sending a big part)
+        self.ack_lock = Lock()
+
+        # Set if the connection failed, so that nobody waits forever
+        self.connection_error = None
+
+        # Replacing the connection when it fails
+        self.auto_reconnect = auto_reconnect
+        self.max_reconnects = max_reconnects
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.on_reconnect = None  # Called after reconnecting, to resume updates
+        self.reconnects = 0
+        self.failover_time = None  # Seconds it took to reconnect the last time
+
+        # Keepalive pings (ping ID: monotonic time it was sent)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.pending_pings = {}
+        self.ping_event = Event()  # Set once disconnected, to wake up the threads
+
+        # Set to wake up the ping thread to send the dirty requests, since
+        # the reader thread doesn't send anything not to wait for the writers
+        self.dirty_event = Event()
+
+        # Latency metrics, in seconds
+        self.rtt = None  # Round-trip time of the last pong
+        self.average_rtt = None
+        self.max_rtt = 0
+        self.pongs = 0
+        self.rtt_smoothing = 0.1
 
         # Determine whether the received acknowledge request confirm
         # our requests or not. This is not desired until we initialize
@@ -46,35 +99,37 @@ class MtProtoSender:
         # TODO There might be a better way to handle msgs_ack requests
         self.ack_requests_confirm = False
 
-        # Always running thread for periodical ping requests
-        # after all initialization is complete
-        self.updates_thread.start()
+        # The only thread reading from the connection, which handles everything
+        # received (results, pongs, acknowledgements and updates) as it arrives
+        self.reader_thread_stopping = False
+        self.reader_thread = Thread(target=self.reader_thread_method,
+                                    name='Reader thread', daemon=True)
+        self.reader_thread.start()
+
+        self.ping_thread = Thread(target=self.ping_thread_method,
+                                  name='Ping thread', daemon=True)
+        self.ping_thread.start()
 
     def disconnect(self):
         """Disconnects and **stops all the running threads** if any"""
-        self.set_listen_for_updates(enabled=False)
-        # Stop thread on next loop cycle
-        self.updates_thread_stopping = True
-        self.transport.close()
-
-    def add_update_handler(self, handler):
-        """Adds an update handler (a method with one argument, the received
-           TLObject) that is fired when there are updates available"""
+        self.reader_thread_stopping = True
+        self.ping_event.set()
+        self.dirty_event.set()
+        self.transport.close()  # Wakes up the reader thread
+        if self.reader_thread is not current_thread():
+            self.reader_thread.join()
 
-        first_handler = not self.on_update_handlers
-        self.on_update_handlers.append(handler)
+        self.on_connection_error(ConnectionError('The connection was closed.'))
+        self.session.flush()
 
-        # If this is the first added handler,
-        # we must start the thread to receive updates
-        if first_handler:
-            self.set_listen_for_updates(enabled=True)
+    def add_update_handler(self, handler, types=None):
+        """Adds an update handler (a method with one argument, the received
+           TLObject) that is fired when there are updates available
+           (of the given types only, if any), from the update workers"""
+        self.updates.add_handler(handler, types)
 
     def remove_update_handler(self, handler):
-        self.on_update_handlers.remove(handler)
-
-        # If there are no more update handlers, stop the thread
-        if not self.on_update_handlers:
-            self.set_listen_for_updates(False)
+        self.updates.remove_handler(handler)
 
     def generate_sequence(self, confirmed):
         """Generates the next sequence number, based on whether it
@@ -88,93 +143,166 @@ class MtProtoSender:
 
     # region Send and receive
 
-    def send_ping(self):
-        """Sends PingRequest"""
-        request = PingRequest(0)
-        self.send(request)
-        self.receive(request)
-
     def send(self, request):
         """Sends the specified MTProtoRequest, previously sending any message
-           which needed confirmation. This also pauses the updates thread"""
-
-        # Only cancel the receive *if* it was the
-        # updates thread who was receiving. We do
-        # not want to cancel other pending requests!
-        if self.updates_thread_receiving:
-            self.transport.cancel_receive()
+           which needed confirmation. Only sending is locked, so this never
+           waits for anything being received"""
+        if self.connection_error:
+            raise self.connection_error
 
         # Now only us can be using this method
-        with self.lock:
-            # Set the flag to true so the updates thread stops trying to receive
-            self.waiting_receive = True
-
+        with self.write_lock:
             # If any message needs confirmation send an AckRequest first
-            if self.need_confirmation:
-                msgs_ack = MsgsAck(self.need_confirmation)
-                with BinaryWriter() as writer:
-                    msgs_ack.on_send(writer)
-                    self.send_packet(writer.get_bytes(), msgs_ack)
+            with self.ack_lock:
+                need_confirmation = self.need_confirmation
+                self.need_confirmation = []
+            if need_confirmation:
+                self.send_packet(MsgsAck(need_confirmation))
 
-                del self.need_confirmation[:]
+            # Those which must be sent again were sent before this one
+            self.send_dirty()
 
             # Finally send our packed request
-            with BinaryWriter() as writer:
-                request.on_send(writer)
-                self.send_packet(writer.get_bytes(), request)
+            try:
+                self.send_packet(request)
+            except OSError:
+                if not self.auto_reconnect:
+                    raise
+                # It will be sent again as soon as there is a new connection
+                request.dirty = True
 
             # And update the saved session
             self.session.save()
 
+    def send_dirty(self):
+        """Sends again the pending requests marked as dirty (those lost with the
+           connection, or sent with a bad salt). The write lock must be held"""
+        for request in list(self.pending_requests.values()):
+            if not request.dirty:
+                continue
+            try:
+                self.send_packet(request)
+            except OSError:
+                # The connection is dead, so they will be sent on the new one
+                request.dirty = True
+                return
+
+    def resend_dirty(self):
+        """Sends the dirty requests as soon as possible, from the ping thread
+           unless some other request is sent before"""
+        self.dirty_event.set()
+
     def receive(self, request, timeout=timedelta(seconds=5)):
         """Receives the specified MTProtoRequest ("fills in it"
-           the received data). This also restores the updates thread.
+           the received data), waiting until the reader thread does so.
            An optional timeout can be specified to cancel the operation
-           if no data has been read after its time delta"""
-
-        with self.lock:
-            # Don't stop trying to receive until we get the request we wanted
-            while not request.confirm_received:
-                seq, body = self.transport.receive(timeout)
-                message, remote_msg_id, remote_sequence = self.decode_msg(body)
+           if it was not received after its time delta.
 
-                with BinaryReader(message) as reader:
-                    self.process_msg(remote_msg_id, remote_sequence, reader,
-                                     request)
+           Several requests may be sent before receiving them, in which case
+           the results of the other requests will be filled in as they arrive.
 
-            # We can now set the flag to False thus resuming the updates thread
-            self.waiting_receive = False
+           If this gives up, nobody waits for the request anymore,
+           so it won't be sent again if the connection is replaced"""
+        deadline = monotonic() + timeout.total_seconds() if timeout else None
+        with self.received:
+            while not request.confirm_received:
+                if self.connection_error:
+                    self.forget(request)
+                    raise self.connection_error
+
+                if deadline is None:
+                    self.received.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self.forget(request)
+                        raise TimeoutError(
+                            'The read operation exceeded the timeout.')
+                    self.received.wait(remaining)
+
+        # The error may have been received while receiving another request
+        if request.rpc_error:
+            error, request.rpc_error = request.rpc_error, None
+            raise error
+
+    def forget(self, request):
+        """Stops tracking the given request, whose result won't be waited for"""
+        if self.pending_requests.get(request.msg_id) is request:
+            del self.pending_requests[request.msg_id]
+            self.acked_msg_ids.discard(request.msg_id)
 
     # endregion
 
     # region Low level processing
 
-    def send_packet(self, packet, request):
-        """Sends the given packet bytes with the additional
-           information of the original request. This does NOT lock the threads!"""
+    def send_packet(self, request):
+        """Sends the given request, serializing it straight after the additional
+           information of the message it will be sent in. This does NOT lock the threads!"""
+        # If the request is being resent, its previous message ID won't be answered
+        self.pending_requests.pop(request.msg_id, None)
+        self.acked_msg_ids.discard(request.msg_id)
         request.msg_id = self.session.get_new_msg_id()
-
-        # First calculate plain_text to encrypt it
+        if request.confirmed:
+            self.pending_requests[request.msg_id] = request
+            request.confirm_received = False
+        request.dirty = False
+        request.on_send_success()
+
+        # First calculate plain_text to encrypt it. The request is serialized
+        # into the same buffer so its (possibly large) contents are not copied
         with BinaryWriter() as plain_writer:
             plain_writer.write_long(self.session.salt, signed=False)
             plain_writer.write_long(self.session.id, signed=False)
             plain_writer.write_long(request.msg_id)
             plain_writer.write_int(self.generate_sequence(request.confirmed))
-            plain_writer.write_int(len(packet))
-            plain_writer.write(packet)
-
-            msg_key = utils.calc_msg_key(plain_writer.get_bytes())
-
-            key, iv = utils.calc_key(self.session.auth_key.key, msg_key, True)
-            cipher_text = AES.encrypt_ige(plain_writer.get_bytes(), key, iv)
-
-        # And then finally send the encrypted packet
-        with BinaryWriter() as cipher_writer:
-            cipher_writer.write_long(
-                self.session.auth_key.key_id, signed=False)
-            cipher_writer.write(msg_key)
-            cipher_writer.write(cipher_text)
-            self.transport.send(cipher_writer.get_bytes())
+            plain_writer.write_int(0)  # Length, known once it's serialized
+            request.on_send(plain_writer)
+
+            if self.should_compress(request, plain_writer.written_count - 32):
+                with plain_writer.get_buffer() as plain_text:
+                    packed_data = self.gzip(plain_text[32:])
+                if packed_data:
+                    # Replace the request with its compressed version
+                    plain_writer.truncate(32)
+                    plain_writer.write_int(0x3072cfa1, signed=False)  # gzip_packed
+                    plain_writer.tgwrite_bytes(packed_data)
+
+            # Pad here so that the encryption needs no copy to do it
+            length = plain_writer.written_count - 32
+            if plain_writer.written_count % 16 != 0:
+                plain_writer.write(
+                    os.urandom(16 - plain_writer.written_count % 16))
+
+            with plain_writer.get_buffer() as plain_text:
+                pack_into('<i', plain_text, 28, length)
+
+                msg_key = utils.calc_msg_key(plain_text[:32 + length])
+                key, iv = utils.calc_key(self.session.auth_key.key, msg_key,
+                                         True)
+                cipher_text = AES.encrypt_ige(plain_text, key, iv)
+
+        # And then finally send the encrypted packet, without joining its parts
+        self.transport.send(
+            [pack('<Q', self.session.auth_key.key_id), msg_key, cipher_text])
+
+    def should_compress(self, request, length):
+        """Whether the given request, serialized into length bytes,
+           should be sent compressed as gzip_packed"""
+        return (self.compression_threshold is not None and
+                length >= self.compression_threshold and request.confirmed and
+                not isinstance(request, MtProtoSender.NeverCompressed))
+
+    def gzip(self, data):
+        """Compresses the given data to be sent as gzip_packed.
+           Returns None if that wouldn't make it smaller"""
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        packed_data = compressor.compress(data) + compressor.flush()
+
+        # The constructor ID and the length of the bytes are sent too
+        if len(packed_data) + 8 >= len(data):
+            return None
+        return packed_data
 
     def decode_msg(self, body):
         """Decodes an received encrypted message body bytes"""
@@ -204,36 +332,40 @@ class MtProtoSender:
 
         return message, remote_msg_id, remote_sequence
 
-    def process_msg(self, msg_id, sequence, reader, request=None):
+    def process_msg(self, msg_id, sequence, reader):
         """Processes and handles a Telegram message"""
 
         # TODO Check salt, session_id and sequence_number
-        self.need_confirmation.append(msg_id)
+        with self.ack_lock:
+            self.need_confirmation.append(msg_id)
 
         code = reader.read_int(signed=False)
         reader.seek(-4)
 
         # The following codes are "parsed manually"
         if code == 0xf35c6d01:  # rpc_result, (response of an RPC call, i.e., we sent a request)
-            return self.handle_rpc_result(msg_id, sequence, reader, request)
+            return self.handle_rpc_result(msg_id, sequence, reader)
 
         if code == 0x347773c5:  # pong
-            return self.handle_pong(msg_id, sequence, reader, request)
+            return self.handle_pong(msg_id, sequence, reader)
         if code == 0x73f1f8dc:  # msg_container
-            return self.handle_container(msg_id, sequence, reader, request)
+            return self.handle_container(msg_id, sequence, reader)
         if code == 0x3072cfa1:  # gzip_packed
-            return self.handle_gzip_packed(msg_id, sequence, reader, request)
+            return self.handle_gzip_packed(msg_id, sequence, reader)
         if code == 0xedab447b:  # bad_server_salt
-            return self.handle_bad_server_salt(msg_id, sequence, reader,
-                                               request)
+            return self.handle_bad_server_salt(msg_id, sequence, reader)
         if code == 0xa7eff811:  # bad_msg_notification
             return self.handle_bad_msg_notification(msg_id, sequence, reader)
 
-        # msgs_ack, it may handle the request we wanted
-        if self.ack_requests_confirm and code == 0x62d6b459:
+        # msgs_ack, the server received the requests we sent (and won't need them again)
+        if code == 0x62d6b459:
             ack = reader.tgread_object()
-            if request and request.msg_id in ack.msg_ids:
-                request.confirm_received = True
+            for ack_msg_id in ack.msg_ids:
+                request = self.pending_requests.get(ack_msg_id)
+                if request:
+                    self.acked_msg_ids.add(ack_msg_id)
+                    if self.ack_requests_confirm:
+                        request.confirm_received = True
             return False
 
         # If the code is not parsed manually, then it was parsed by the code generator!
@@ -250,22 +382,40 @@ class MtProtoSender:
     # region Message handling
 
     def handle_update(self, msg_id, sequence, reader):
+        # Peek the constructor ID first, since decoding the
+        # update is not worth it if no handler would handle it
+        code = reader.read_int(signed=False)
+        reader.seek(-4)
+        if not self.updates.wants(code):
+            self.updates.skipped += 1
+            return False
+
         tlobject = reader.tgread_object()
-        for handler in self.on_update_handlers:
-            handler(tlobject)
+        self.session.process_entities(tlobject)
+
+        # The handlers run on other threads, so they never block reading
+        self.updates.dispatch(tlobject)
+        self.session.save_update_state()
 
         return False
 
-    def handle_pong(self, msg_id, sequence, reader, request):
+    def handle_pong(self, msg_id, sequence, reader):
         reader.read_int(signed=False)  # code
-        recv_msg_id = reader.read_long(signed=False)
+        recv_msg_id = reader.read_long()
+        ping_id = reader.read_long()
 
-        if recv_msg_id == request.msg_id:
+        request = self.pending_requests.pop(recv_msg_id, None)
+        self.acked_msg_ids.discard(recv_msg_id)
+        if request:
             request.confirm_received = True
 
+        sent_time = self.pending_pings.pop(ping_id, None)
+        if sent_time is not None:
+            self.on_rtt(monotonic() - sent_time)
+
         return False
 
-    def handle_container(self, msg_id, sequence, reader, request):
+    def handle_container(self, msg_id, sequence, reader):
         reader.read_int(signed=False)  # code
         size = reader.read_int()
         for _ in range(size):
@@ -274,132 +424,266 @@ class MtProtoSender:
             inner_length = reader.read_int()
             begin_position = reader.tell_position()
 
-            if not self.process_msg(inner_msg_id, sequence, reader, request):
+            if not self.process_msg(inner_msg_id, sequence, reader):
                 reader.set_position(begin_position + inner_length)
 
         return False
 
-    def handle_bad_server_salt(self, msg_id, sequence, reader, request):
+    def handle_bad_server_salt(self, msg_id, sequence, reader):
         reader.read_int(signed=False)  # code
-        reader.read_long(signed=False)  # bad_msg_id
+        bad_msg_id = reader.read_long()
         reader.read_int()  # bad_msg_seq_no
         reader.read_int()  # error_code
         new_salt = reader.read_long(signed=False)
 
         self.session.salt = new_salt
 
-        if request is None:
-            raise ValueError(
-                'Tried to handle a bad server salt with no request specified')
-
-        # Resend
-        self.send(request)
+        # Resend the request which had the bad salt, if we're still waiting for it
+        request = self.pending_requests.get(bad_msg_id)
+        if request:
+            request.dirty = True
+            self.resend_dirty()
 
         return True
 
     def handle_bad_msg_notification(self, msg_id, sequence, reader):
         reader.read_int(signed=False)  # code
-        reader.read_long(signed=False)  # request_id
+        bad_msg_id = reader.read_long()
         reader.read_int()  # request_sequence
-
         error_code = reader.read_int()
-        raise BadMessageError(error_code)
 
-    def handle_rpc_result(self, msg_id, sequence, reader, request):
+        # Let whoever receives the bad request handle the error
+        request = self.pending_requests.pop(bad_msg_id, None)
+        if request:
+            request.rpc_error = BadMessageError(error_code)
+            request.confirm_received = True
+        else:
+            print('Bad message notification: {}'.format(
+                BadMessageError(error_code)))
+
+        return False
+
+    def handle_rpc_result(self, msg_id, sequence, reader):
         reader.read_int(signed=False)  # code
-        request_id = reader.read_long(signed=False)
+        request_id = reader.read_long()
         inner_code = reader.read_int(signed=False)
 
-        if request and request_id == request.msg_id:
-            request.confirm_received = True
+        # The result may belong to any of the requests which were sent
+        target = self.pending_requests.pop(request_id, None)
+        self.acked_msg_ids.discard(request_id)
+        if not target:
+            # Nobody is waiting for it (anymore), so there is nothing to fill in
+            return False
 
         if inner_code == 0x2144ca19:  # RPC Error
-            error = RPCError(
+            # FLOOD_WAIT and *_MIGRATE_X errors are raised too when the request is
+            # received, so that whoever sent it decides how to wait or where to send
+            # it again. The error is raised to them, never on the reader thread
+            target.rpc_error = RPCError(
                 code=reader.read_int(), message=reader.tgread_string())
-            if error.must_resend:
-                if not request:
-                    raise ValueError(
-                        'The previously sent request must be resent. '
-                        'However, no request was previously sent (called from updates thread).')
-                request.confirm_received = False
-
-            if error.message.startswith('FLOOD_WAIT_'):
-                print('Should wait {}s. Sleeping until then.'.format(
-                    error.additional_data))
-                sleep(error.additional_data)
-
-            elif error.message.startswith('PHONE_MIGRATE_'):
-                raise InvalidDCError(error.additional_data)
-
-            else:
-                raise error
+            target.confirm_received = True
         else:
-            if not request:
-                raise ValueError(
-                    'Cannot receive a request from inside an RPC result from the updates thread.')
 
             if inner_code == 0x3072cfa1:  # GZip packed
-                unpacked_data = gzip.decompress(reader.tgread_bytes())
+                unpacked_data = self.gunzip(reader.tgread_bytes())
                 with BinaryReader(unpacked_data) as compressed_reader:
-                    request.on_response(compressed_reader)
+                    target.on_response(compressed_reader)
             else:
                 reader.seek(-4)
-                request.on_response(reader)
+                target.on_response(reader)
+
+            # Remember the users and chats to be able to use them later on
+            self.session.process_entities(getattr(target, 'result', None))
+
+            # The state must know about the pts of the result (if any), or the
+            # next update received would seem to come after missing ones
+            self.updates.dispatch_result(target, getattr(target, 'result', None))
+            self.session.save_update_state()
+            target.confirm_received = True
+
+        return False
 
-    def handle_gzip_packed(self, msg_id, sequence, reader, request):
+    @staticmethod
+    def gunzip(packed_data):
+        """Decompresses the data of a gzip_packed object, with a single
+           decompressor and without the gzip module's header parsing"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        unpacked_data = decompressor.decompress(packed_data)
+        if not decompressor.eof:
+            raise zlib.error('Incomplete gzip_packed data')
+        return unpacked_data
+
+    def handle_gzip_packed(self, msg_id, sequence, reader):
         reader.read_int(signed=False)  # code
         packed_data = reader.tgread_bytes()
-        unpacked_data = gzip.decompress(packed_data)
+        unpacked_data = self.gunzip(packed_data)
 
         with BinaryReader(unpacked_data) as compressed_reader:
-            return self.process_msg(msg_id, sequence, compressed_reader,
-                                    request)
+            return self.process_msg(msg_id, sequence, compressed_reader)
 
     # endregion
 
-    def set_listen_for_updates(self, enabled):
-        if enabled:
-            self.updates_thread_receiving = False
+    def reader_thread_method(self):
+        """Receives and handles everything sent by the server, one message
+           after another, until disconnected. It blocks until something arrives,
+           and whoever waits for a request is notified once it's received"""
+        while not self.reader_thread_stopping:
+            try:
+                # The ping thread makes sure this doesn't block forever
+                seq, body = self.transport.receive(None)
+            except Exception as error:
+                # Anything wrong with a frame (such as an invalid checksum)
+                # leaves the stream out of sync, so the connection is lost
+                if self.reader_thread_stopping:
+                    return
+                if not self.auto_reconnect or not self.reconnect():
+                    self.on_connection_error(error)
+                    return
+                continue
+
+            try:
+                message, remote_msg_id, remote_sequence = self.decode_msg(body)
+                with BinaryReader(message) as reader:
+                    self.process_msg(remote_msg_id, remote_sequence, reader)
+            except Exception as error:
+                print('Could not handle a received message: {}'.format(error))
+
+            with self.received:
+                self.received.notify_all()
+
+    def on_connection_error(self, error):
+        """Makes whoever waits for a request (or sends one) fail with the
+           error which made the connection unusable, instead of waiting forever"""
+        if not isinstance(error, ConnectionError):
+            error = ConnectionError('The connection failed: {}'.format(error))
+
+        with self.received:
+            # The first error is the one which tells what went wrong
+            if not self.connection_error:
+                self.connection_error = error
+            self.received.notify_all()
+
+    # region Reconnecting
+
+    def reconnect(self):
+        """Replaces the dead connection with a new one, waiting longer between
+           every failed attempt. The same auth key and session are used, so the
+           results and updates sent meanwhile are not lost. Returns True on success"""
+        start = monotonic()
+        delay = self.reconnect_delay
+        for _ in range(self.max_reconnects):
+            # Full jitter, so that many clients don't reconnect all at once
+            if self.ping_event.wait(random.uniform(0, delay)):
+                return False  # Disconnected meanwhile
+
+            delay = min(delay * 2, self.max_reconnect_delay)
+            # No writer may use the new connection before its header is sent
+            with self.write_lock:
+                try:
+                    self.transport.reconnect()
+                except OSError:
+                    continue
+
+            self.reconnects += 1
+            self.failover_time = monotonic() - start
+            self.pending_pings.clear()
+            self.resend_pending()
+            if self.on_reconnect:
+                self.on_reconnect()
+            return True
+
+        return False
+
+    def resend_pending(self):
+        """Sends again the requests which may have been lost with the connection.
+           The server will send the results of those it acknowledged anyway"""
+        for msg_id, request in list(self.pending_requests.items()):
+            if isinstance(request, PingDelayDisconnectRequest):
+                self.forget(request)  # Nobody waits for its pong
+                continue
+
+            if msg_id in self.acked_msg_ids:
+                continue  # Sending it again would execute it twice
+
+            request.dirty = True
+
+        self.resend_dirty()
+
+    # endregion
+
+    # region Keepalive
+
+    def ping_thread_method(self):
+        """Sends a ping every ping_interval seconds, without waiting for its pong,
+           and closes the connection if a pong takes longer than ping_timeout.
+           It only wakes up when the next ping or pong is due"""
+        next_ping = monotonic() + self.ping_interval
+        while not self.reader_thread_stopping:
+            now = monotonic()
+            # Copied, since the reader thread removes those answered
+            sent_times = list(self.pending_pings.values())
+            if sent_times:
+                overdue = min(sent_times) + self.ping_timeout
+                if now >= overdue:
+                    if not self.auto_reconnect:
+                        self.on_connection_error(ConnectionError(
+                            'No pong was received in {} seconds.'
+                            .format(self.ping_timeout)))
+
+                    # The reader thread will wake up and reconnect, if it should
+                    self.pending_pings.clear()
+                    self.transport.close()
+                    next_ping = now + self.ping_interval
+                    continue
+            else:
+                overdue = None
+
+            if now >= next_ping:
+                self.send_ping()
+                next_ping = now + self.ping_interval
+                continue
+
+            if self.dirty_event.is_set():
+                self.dirty_event.clear()
+                with self.write_lock:
+                    self.send_dirty()
+                continue
+
+            wake_up = next_ping if overdue is None else min(next_ping, overdue)
+            self.dirty_event.wait(wake_up - now)
+
+    def send_ping(self):
+        """Sends a ping, which also asks the server to close the connection if no
+           other ping arrives in time (so dead connections don't linger there)"""
+        ping_id = int.from_bytes(os.urandom(8), 'big', signed=True)
+        self.pending_pings[ping_id] = monotonic()
+        try:
+            self.send(PingDelayDisconnectRequest(
+                ping_id, int(self.ping_interval + self.ping_timeout)))
+        except OSError:
+            pass  # The pong won't arrive, so the connection will be closed
+
+    def on_rtt(self, rtt):
+        """Updates the latency metrics with the round-trip time of a new pong"""
+        self.rtt = rtt
+        self.max_rtt = max(self.max_rtt, rtt)
+        self.pongs += 1
+        if self.average_rtt is None:
+            self.average_rtt = rtt
         else:
-            if self.updates_thread_receiving:
-                self.transport.cancel_receive()
-
-    def updates_thread_method(self):
-        """This method will run until specified and listen for incoming updates"""
-
-        # Set a reasonable timeout when checking for updates
-        timeout = timedelta(minutes=1)
-
-        while not self.updates_thread_stopping:
-            # Only try to receive updates if we're not waiting to receive a request
-            if not self.waiting_receive:
-                with self.lock:
-                    try:
-                        now = time()
-                        # if ping_interval seconds passed since last ping
-                        # (or startup) - send new one
-                        if now >= self.ping_time_last + self.ping_interval:
-                            self.ping_time_last = now
-                            self.send_ping()
-                            # if sending ping - we doesn't processing any other updates
-                            continue
-
-                        self.updates_thread_receiving = True
-                        seq, body = self.transport.receive(timeout)
-                        message, remote_msg_id, remote_sequence = self.decode_msg(
-                            body)
-
-                        with BinaryReader(message) as reader:
-                            self.process_msg(remote_msg_id, remote_sequence,
-                                             reader)
-
-                    except (ReadCancelledError, TimeoutError):
-                        pass
-
-                self.updates_thread_receiving = False
-
-            # If we are here, it is because the read was cancelled
-            # Sleep a bit just to give enough time for the other thread
-            # to acquire the lock. No need to sleep if we're not running anymore
-            if not self.updates_thread_stopping:
-                sleep(0.1)
+            self.average_rtt += self.rtt_smoothing * (rtt - self.average_rtt)
+
+    def get_metrics(self):
+        """Gets the round-trip time of the pings and the
+           times the connection was replaced as a dictionary"""
+        return {
+            'rtt': self.rtt,
+            'average_rtt': self.average_rtt,
+            'max_rtt': self.max_rtt,
+            'pongs': self.pongs,
+            'pending_pings': len(self.pending_pings),
+            'reconnects': self.reconnects,
+            'failover_time': self.failover_time
+        }
+
+    # endregion
@@ -1,22 +1,28 @@
 # Python rough implementation of a C# TCP client
 import socket
-import time
-from datetime import datetime, timedelta
 from threading import Lock
 
-from telethon.errors import ReadCancelledError
-from telethon.utils import BinaryWriter
-
 
 class TcpClient:
-    def __init__(self):
+    def __init__(self, buffer_size=256 * 1024):
+        """Everything received goes through a buffer of buffer_size bytes (which grows
+           if a larger read is needed), so that receiving many small messages only
+           takes a single call to the socket"""
         self.connected = False
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.timeout = None  # The current timeout of the socket, in seconds
+
+        # Received data which was not read yet lays between start and end. New data
+        # is received after it, and it's moved back to the beginning to make room
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
 
-        # Support for multi-threading advantages and safety
-        self.cancelled = False  # Has the read operation been cancelled?
-        self.delay = 0.1  # Read delay when there was no data available
-        self.lock = Lock()
+        # Support for multi-threading advantages and safety. Reading and
+        # writing can happen at the same time, but only by one thread each
+        self.read_lock = Lock()
+        self.write_lock = Lock()
 
     def connect(self, ip, port):
         """Connects to the specified IP and port number"""
@@ -24,66 +30,107 @@ class TcpClient:
         self.connected = True
 
     def close(self):
-        """Closes the connection"""
-        self.socket.close()
+        """Closes the connection, waking up any thread blocked reading from it"""
         self.connected = False
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # It was not connected
+        self.socket.close()
 
     def write(self, data):
-        """Writes (sends) the specified bytes to the connected peer"""
+        """Writes (sends) the specified bytes, or list of bytes-like objects
+           (which are sent together without joining them), to the connected peer"""
 
         # Ensure that only one thread can send data at once
-        with self.lock:
-            # Set blocking so it doesn't error
-            self.socket.setblocking(True)
-            self.socket.sendall(data)
-
-    def read(self, buffer_size, timeout=timedelta(seconds=5)):
+        with self.write_lock:
+            if isinstance(data, list):
+                self.write_vectored(data)
+            else:
+                self.socket.sendall(data)
+
+    def write_vectored(self, buffers):
+        """Sends all the given buffers with scatter/gather calls to the socket,
+           so that they don't need to be copied into a single one first"""
+        if not hasattr(self.socket, 'sendmsg'):
+            self.socket.sendall(b''.join(buffers))  # Not available on Windows
+            return
+
+        buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+        while buffers:
+            sent = self.socket.sendmsg(buffers)
+
+            # Skip whatever was sent, which may end in the middle of a buffer
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+    def read(self, buffer_size, timeout=None):
         """Reads (receives) the specified bytes from the connected peer.
-           A timeout can be specified, which will cancel the operation if no data
-           has been read in the specified time. If data was read and it's waiting
-           for more, the timeout will NOT cancel the operation. Set to None for no timeout"""
+           A timeout (timedelta) can be specified, which will cancel the operation if no
+           data has been read in the specified time. If data was read and it's waiting
+           for more, the timeout will NOT cancel the operation. Set to None for no timeout.
+
+           The thread blocks until there is data available instead of polling for it.
+           Whatever else was received is kept for the next reads"""
 
         # Ensure that only one thread can receive data at once
-        with self.lock:
-            # Ensure it is not cancelled at first, so we can enter the loop
-            self.cancelled = False
-
-            # Set non-blocking so it can be cancelled
-            self.socket.setblocking(False)
-
-            # Set the starting time so we can calculate whether the timeout should fire
-            if timeout:
-                start_time = datetime.now()
-
-            with BinaryWriter() as writer:
-                while writer.written_count < buffer_size:
-                    # Only do cancel if no data was read yet
-                    # Otherwise, carry on reading and finish
-                    if self.cancelled and writer.written_count == 0:
-                        raise ReadCancelledError()
-
-                    try:
-                        # When receiving from the socket, we may not receive all the data at once
-                        # This is why we need to keep checking to make sure that we receive it all
-                        left_count = buffer_size - writer.written_count
-                        partial = self.socket.recv(left_count)
-                        writer.write(partial)
-
-                    except BlockingIOError:
-                        # There was no data available for us to read. Sleep a bit
-                        time.sleep(self.delay)
-
-                        # Check if the timeout finished
-                        if timeout:
-                            time_passed = datetime.now() - start_time
-                            if time_passed > timeout:
-                                raise TimeoutError(
-                                    'The read operation exceeded the timeout.')
-
-                # If everything went fine, return the read bytes
-                return writer.get_bytes()
-
-    def cancel_read(self):
-        """Cancels the read operation IF it hasn't yet
-           started, raising a ReadCancelledError"""
-        self.cancelled = True
+        with self.read_lock:
+            if self.end - self.start < buffer_size:
+                self.fill(buffer_size, timeout)
+
+            # The only copy, since the buffer will be reused
+            data = bytes(self.view[self.start:self.start + buffer_size])
+            self.start += buffer_size
+            if self.start == self.end:
+                self.start = self.end = 0
+
+            return data
+
+    def fill(self, size, timeout):
+        """Receives into the buffer until it has at least size bytes to be read,
+           receiving as much as fits at once. The read lock must be held"""
+        self.make_room(size)
+
+        timeout = timeout.total_seconds() if timeout else None
+        if timeout != self.timeout:
+            self.socket.settimeout(timeout)
+            self.timeout = timeout
+
+        received_any = False
+        while self.end - self.start < size:
+            try:
+                received = self.socket.recv_into(self.view[self.end:])
+            except socket.timeout:
+                # Only time out if no data was read yet
+                # Otherwise, carry on reading and finish
+                if not received_any:
+                    raise TimeoutError(
+                        'The read operation exceeded the timeout.')
+                continue
+
+            if not received:
+                raise ConnectionResetError(
+                    'The connection was closed by the remote peer.')
+            self.end += received
+            received_any = True
+
+    def make_room(self, size):
+        """Makes sure that size bytes fit in the buffer after the unread data,
+           moving it to the beginning of the buffer (or to a larger one)"""
+        if len(self.buffer) - self.start >= size:
+            return
+
+        unread = self.end - self.start
+        if len(self.buffer) < size:
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:unread] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer, self.view = buffer, memoryview(buffer)
+        else:
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+
+        self.start, self.end = 0, unread
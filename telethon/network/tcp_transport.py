@@ -1,72 +1,66 @@
-from binascii import crc32
 from datetime import timedelta
 
 from telethon.errors import *
 from telethon.network import TcpClient
-from telethon.utils import BinaryWriter
+from telethon.network.framing import FullFraming
 
 
 class TcpTransport:
-    def __init__(self, ip_address, port):
+    def __init__(self, ip_address, port, framing=FullFraming):
+        """The framing (a callable returning a new Framing, such as its class)
+           chooses how the packets are delimited. It's called for every connection"""
+        self.ip_address = ip_address
+        self.port = port
+        self.framing_factory = framing
+        self.tcp_client = None
+        self.framing = None
+
+        self.connect()
+
+    def connect(self):
+        """Connects to the address of this transport with a new framing"""
         self.tcp_client = TcpClient()
-        self.send_counter = 0
+        self.framing = self.framing_factory()
+        self.tcp_client.connect(self.ip_address, self.port)
 
-        self.tcp_client.connect(ip_address, port)
+        header = self.framing.connection_header()
+        if header:
+            self.tcp_client.write(header)
+
+    def reconnect(self):
+        """Closes the connection (if it's still open) and connects again
+           to the same address. The framing starts from scratch again"""
+        self.close()
+        self.connect()
 
-    # Original reference: https://core.telegram.org/mtproto#tcp-transport
-    # The packets are encoded as: total length, sequence number, packet and checksum (CRC32)
     def send(self, packet):
-        """Sends the given packet (bytes array) to the connected peer"""
+        """Sends the given packet (bytes array, or a list of the bytes-like objects it's
+           made of) to the connected peer. The frame is sent without joining its parts"""
         if not self.tcp_client.connected:
             raise ConnectionError('Client not connected to server.')
 
-        with BinaryWriter() as writer:
-            writer.write_int(len(packet) + 12)  # 12 = size_of (integer) * 3
-            writer.write_int(self.send_counter)
-            writer.write(packet)
-
-            crc = crc32(writer.get_bytes())
-            writer.write_int(crc, signed=False)
-
-            self.send_counter += 1
-            self.tcp_client.write(writer.get_bytes())
+        if not isinstance(packet, list):
+            packet = [packet]
+        self.tcp_client.write(self.framing.encode(packet))
 
     def receive(self, timeout=timedelta(seconds=5)):
         """Receives a TCP message (tuple(sequence number, body)) from the connected peer.
            There is a default timeout of 5 seconds before the operation is cancelled.
-           Timeout can be set to None for no timeout"""
-
-        # First read everything we need
-        packet_length_bytes = self.tcp_client.read(4, timeout)
-        packet_length = int.from_bytes(packet_length_bytes, byteorder='little')
-
-        seq_bytes = self.tcp_client.read(4, timeout)
-        seq = int.from_bytes(seq_bytes, byteorder='little')
+           Timeout can be set to None for no timeout. The sequence number is None
+           if the framing doesn't have any.
 
-        body = self.tcp_client.read(packet_length - 12, timeout)
+           The client buffers whatever it receives, so if several messages arrived
+           together, reading them won't need to receive anything else"""
+        timeouts = [timeout]
 
-        checksum = int.from_bytes(
-            self.tcp_client.read(4, timeout), byteorder='little', signed=False)
+        def read(count):
+            # Once the message started arriving, the rest must be waited for
+            data = self.tcp_client.read(count, timeouts[0])
+            timeouts[0] = None
+            return data
 
-        # Then perform the checks
-        rv = packet_length_bytes + seq_bytes + body
-        valid_checksum = crc32(rv)
-
-        if checksum != valid_checksum:
-            raise InvalidChecksumError(checksum, valid_checksum)
-
-        # If we passed the tests, we can then return a valid TCP message
-        return seq, body
+        return self.framing.read_frame(read)
 
     def close(self):
         if self.tcp_client.connected:
             self.tcp_client.close()
-
-    def cancel_receive(self):
-        """Cancels (stops) trying to receive from the
-        remote peer and raises a ReadCancelledError"""
-        self.tcp_client.cancel_read()
-
-    def get_client_delay(self):
-        """Gets the client read delay"""
-        return self.tcp_client.delay
@@ -0,0 +1,360 @@
+import time
+from collections import deque
+from queue import Full, Queue
+from threading import Lock, Thread
+
+from telethon.tl.all_tlobjects import tlobjects
+from telethon.tl.types import (PeerUser, UpdateShort, UpdateShortChatMessage,
+                               UpdateShortMessage, UpdatesCombined, UpdatesTg,
+                               UpdatesTooLong)
+from telethon.tl.update_state import UpdateState
+from telethon.utils import get_peer_id
+
+
+def get_update_chat_id(update):
+    """Gets the marked ID (see get_peer_id) of the chat the given update belongs to,
+       so that the updates of the same chat can be handled in order.
+       Returns None if the update doesn't belong to any chat"""
+    if isinstance(update, UpdateShort):
+        return get_update_chat_id(update.update)
+    if isinstance(update, (UpdatesTg, UpdatesCombined)):
+        return get_update_chat_id(update.updates[0]) if update.updates else None
+
+    if isinstance(update, UpdateShortMessage):
+        return update.user_id
+    if isinstance(update, UpdateShortChatMessage):
+        return -update.chat_id
+
+    message = getattr(update, 'message', None)
+    to_id = getattr(message, 'to_id', None)
+    if to_id is not None:
+        # Private messages we receive are sent to ourselves, but belong to the sender
+        if (isinstance(to_id, PeerUser) and not message.out and
+                message.from_id is not None):
+            return message.from_id
+        return get_peer_id(to_id)
+
+    if getattr(update, 'channel_id', None) is not None:
+        return -(10**12 + update.channel_id)
+    if getattr(update, 'chat_id', None) is not None:
+        return -update.chat_id
+    return getattr(update, 'user_id', None)
+
+
+class UpdateDispatcher:
+    """Delivers the updates to their handlers from a pool of worker threads, so that
+       slow handlers never block the thread reading from the network.
+
+       Handlers may be registered for some types of updates only, in which case they
+       are indexed by the constructor ID of those types. The updates within containers
+       (such as Updates) are delivered on their own to the handlers of their types.
+
+       The updates of the same chat are always handled by the same worker, and
+       thus in the order they arrived. Every worker has a bounded queue, and the
+       updates which don't fit in it are kept in an overflow buffer until there
+       is room, so that the thread reading from the network is never blocked.
+       The overflow buffer is bounded too: if the handlers can't keep up even
+       then, the newest updates are dropped (and counted) instead of using
+       more and more memory.
+
+       If a state (an UpdateState) is set, updates which were already received
+       are not delivered again, and on_gap is called with the channel ID (or None
+       for the account) whenever a gap is found, to fetch the missed updates"""
+
+    # The constructor IDs of the updates containing other updates
+    ContainerIds = frozenset(c.constructor_id for c in
+                             (UpdateShort, UpdatesTg, UpdatesCombined))
+
+    # The types of the results which are updates themselves
+    UpdatesTypes = (UpdateShort, UpdatesTg, UpdatesCombined, UpdatesTooLong,
+                    UpdateShortMessage, UpdateShortChatMessage)
+
+    # The constructor IDs of the updates which the state may not apply: those
+    # carrying a pts, qts or seq, and those telling about a gap. Any other
+    # update is always applied, so it's never decoded only to be checked
+    StatefulIds = frozenset(
+        [UpdatesTooLong.constructor_id] +
+        [constructor_id for constructor_id, tlobject in tlobjects.items()
+         if any(hasattr(tlobject.empty(), name) for name in ('pts', 'qts', 'seq'))])
+
+    def __init__(self, workers=4, max_queue_size=1024, max_overflow_size=64 * 1024,
+                 smoothing=0.1):
+        """
+        :param workers: How many threads should handle the updates
+        :param max_queue_size: How many updates every worker may have queued
+                               before they start to overflow
+        :param max_overflow_size: How many updates may overflow for every worker
+                                  before the new ones are dropped
+        :param smoothing: The weight of new samples for the averaged handler latency
+        """
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.max_overflow_size = max_overflow_size
+        self.smoothing = smoothing
+
+        # Handlers of any update, and handlers of some types (constructor ID: [handlers]).
+        # They're replaced (not modified) on changes, so they're never locked to be read
+        self.any_handlers = []
+        self.typed_handlers = {}
+
+        self.state = None
+        self.on_gap = None
+
+        # The queues (with their overflow buffers) and threads
+        # are only created once they're needed
+        self.queues = []
+        self.overflows = []
+        self.threads = []
+        self.lock = Lock()
+        self.overflow_lock = Lock()
+
+        # Metrics
+        self.dispatched = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.gaps = 0
+        self.handled = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self.overflowed = 0
+        self.dropped = 0
+        self.latency = None  # Seconds, averaged, since dispatched until handled
+        self.max_latency = 0
+        self.handler_time = None  # Seconds, averaged, running the handlers
+
+    # region Handlers
+
+    @property
+    def handlers(self):
+        """Whether there is any handler at all"""
+        return bool(self.any_handlers or self.typed_handlers)
+
+    def add_handler(self, handler, types=None):
+        """Adds an update handler (a function which takes a TLObject, an update,
+           as its parameter). If types is given (a type or a tuple of types, or their
+           constructor IDs), the handler is only called for the updates of those types"""
+        with self.lock:
+            if types is None:
+                self.any_handlers = self.any_handlers + [handler]
+            else:
+                if not isinstance(types, (tuple, list, set, frozenset)):
+                    types = (types, )
+
+                typed_handlers = dict(self.typed_handlers)
+                for update_type in types:
+                    constructor_id = getattr(update_type, 'constructor_id',
+                                             update_type)
+                    typed_handlers[constructor_id] = \
+                        typed_handlers.get(constructor_id, []) + [handler]
+                self.typed_handlers = typed_handlers
+
+            self.start()
+
+    def remove_handler(self, handler):
+        """Removes a previously added update handler"""
+        with self.lock:
+            self.any_handlers = [h for h in self.any_handlers if h != handler]
+
+            typed_handlers = {}
+            for constructor_id, handlers in self.typed_handlers.items():
+                handlers = [h for h in handlers if h != handler]
+                if handlers:
+                    typed_handlers[constructor_id] = handlers
+            self.typed_handlers = typed_handlers
+
+    def wants(self, constructor_id):
+        """Whether the update with the given constructor ID (read before decoding it)
+           would be handled at all, or checked against the state (if any).
+           If it wouldn't, it doesn't need to be decoded"""
+        if self.any_handlers or constructor_id in self.typed_handlers:
+            return True
+        if constructor_id in UpdateDispatcher.ContainerIds:
+            return bool(self.typed_handlers or self.state)
+        return bool(self.state and constructor_id in UpdateDispatcher.StatefulIds)
+
+    # endregion
+
+    # region Dispatching
+
+    def dispatch(self, update, check_state=True):
+        """Queues the update (and those within it) to be handled by its chat's worker,
+           without ever blocking. The update is first checked against the
+           state, if any, unless check_state is False (for instance, if it came from
+           a difference, which sets the state on its own)"""
+        check_state = check_state and self.state
+        if check_state and not self.check_state(update):
+            return
+
+        # Updates within containers go to the handlers of their own types
+        if isinstance(update, UpdateShort):
+            inner_updates = (update.update, )
+        elif isinstance(update, (UpdatesTg, UpdatesCombined)):
+            inner_updates = update.updates
+        else:
+            inner_updates = ()
+
+        # They're checked even without handlers, or the state would fall behind
+        if check_state:
+            inner_updates = [u for u in inner_updates if self.check_state(u)]
+
+        if not self.handlers:
+            return
+
+        typed_handlers = self.typed_handlers
+        handlers = self.any_handlers + typed_handlers.get(
+            type(update).constructor_id, [])
+        if handlers:
+            self.put(update, handlers)
+
+        for inner_update in inner_updates:
+            handlers = typed_handlers.get(type(inner_update).constructor_id)
+            if handlers:
+                self.put(inner_update, handlers)
+
+    def dispatch_result(self, request, result):
+        """Applies the result of the given request to the state (if any), if it
+           carries one. Results which are updates (such as those of sending media)
+           are dispatched as if they had been received on their own, and those
+           with a pts (such as those of sending a message or deleting messages)
+           are checked against it, so that they're not taken as a gap later"""
+        if not self.state:
+            return
+
+        if isinstance(result, UpdateDispatcher.UpdatesTypes):
+            self.dispatch(result)
+        elif getattr(result, 'pts_count', None) is not None:
+            # The pts is the channel's if the request was sent to a channel
+            channel = getattr(request, 'channel', None)
+            self.check_state(result, getattr(channel, 'channel_id', None))
+
+    def check_state(self, update, channel_id=None):
+        """Checks the update against the state, notifying about any gap found.
+           The channel ID is needed if it can't be found from the update itself.
+           Returns True if the update should be delivered to the handlers"""
+        result = self.state.check(update, channel_id)
+        if result == UpdateState.Gap:
+            self.gaps += 1
+            if self.on_gap:
+                self.on_gap(channel_id if channel_id is not None
+                            else UpdateState.get_channel_id(update))
+        elif result == UpdateState.Duplicate:
+            self.duplicates += 1
+
+        return result == UpdateState.Apply
+
+    def put(self, update, handlers):
+        """Queues the update to be handled by the given handlers on its chat's worker"""
+        queues, overflows = self.queues, self.overflows
+        if not queues:
+            # The workers were stopped, but there are handlers again
+            with self.lock:
+                self.start()
+                queues, overflows = self.queues, self.overflows
+
+        index = hash(get_update_chat_id(update)) % len(queues)
+        queue, overflow = queues[index], overflows[index]
+        if not self.enqueue(queue, overflow, (update, handlers, time.monotonic())):
+            return
+
+        self.dispatched += 1
+        self.max_queue_depth = max(self.max_queue_depth,
+                                   queue.qsize() + len(overflow))
+
+    def enqueue(self, queue, overflow, item):
+        """Adds the item to the given queue, or to its overflow buffer if the
+           queue is full or the buffer has older items (to keep them in order).
+           Returns False if it was dropped because the buffer was full too"""
+        with self.overflow_lock:
+            if not overflow:
+                try:
+                    queue.put_nowait(item)
+                    return True
+                except Full:
+                    pass
+
+            if item is not None:
+                # The None which stops the worker must always be queued
+                if len(overflow) >= self.max_overflow_size:
+                    self.dropped += 1
+                    return False
+                self.overflowed += 1
+
+            overflow.append(item)
+            return True
+
+    def start(self):
+        """Starts the worker threads, if they weren't started yet"""
+        if self.threads:
+            return
+
+        for i in range(self.workers):
+            queue, overflow = Queue(self.max_queue_size), deque()
+            thread = Thread(target=self.worker_method, args=(queue, overflow),
+                            name='Update worker {}'.format(i), daemon=True)
+            self.queues.append(queue)
+            self.overflows.append(overflow)
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """Stops the worker threads once they handle the updates already queued"""
+        with self.lock:
+            for queue, overflow in zip(self.queues, self.overflows):
+                self.enqueue(queue, overflow, None)
+            self.queues, self.overflows, self.threads = [], [], []
+
+    def worker_method(self, queue, overflow):
+        """Handles the updates from the given queue (and then from its
+           overflow buffer, once they fit in the queue) until None is found"""
+        while True:
+            item = queue.get()
+            if overflow:
+                with self.overflow_lock:
+                    while overflow and not queue.full():
+                        queue.put_nowait(overflow.popleft())
+
+            if item is None:
+                return
+
+            update, handlers, dispatched_time = item
+            start = time.monotonic()
+            for handler in handlers:
+                try:
+                    handler(update)
+                except Exception as error:
+                    self.errors += 1
+                    print('Unhandled exception on update handler {}: {}'
+                          .format(handler, error))
+
+            now = time.monotonic()
+            self.handled += 1
+            self.handler_time = self.average(self.handler_time, now - start)
+            self.latency = self.average(self.latency, now - dispatched_time)
+            self.max_latency = max(self.max_latency, now - dispatched_time)
+
+    def average(self, current, sample):
+        """Exponentially weighted moving average of the current value and a new sample"""
+        if current is None:
+            return sample
+        return current + self.smoothing * (sample - current)
+
+    # endregion
+
+    def get_metrics(self):
+        """Gets the current queue depth, handler latency and counters as a dictionary"""
+        return {
+            'queue_depth': sum(queue.qsize() + len(overflow) for queue, overflow
+                               in zip(self.queues, self.overflows)),
+            'max_queue_depth': self.max_queue_depth,
+            'overflowed': self.overflowed,
+            'dropped': self.dropped,
+            'dispatched': self.dispatched,
+            'skipped': self.skipped,
+            'duplicates': self.duplicates,
+            'gaps': self.gaps,
+            'handled': self.handled,
+            'errors': self.errors,
+            'latency': self.latency,
+            'max_latency': self.max_latency,
+            'handler_time': self.handler_time
+        }
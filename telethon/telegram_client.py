@@ -1,14 +1,22 @@
+import heapq
+import mmap
 import platform
+from collections import deque
 from datetime import datetime, timedelta
 from hashlib import md5
+from math import ceil
+from itertools import chain, islice
 from mimetypes import guess_type
 from os import listdir, path
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
 
 # Import some externalized utilities to work with the Telegram types and more
 import telethon.helpers as utils
 import telethon.network.authenticator as authenticator
 from telethon.errors import *
-from telethon.network import MtProtoSender, TcpTransport
+from telethon.network import (FullFraming, MtProtoSender, TcpTransport,
+                              UpdateDispatcher)
 from telethon.parser.markdown_parser import parse_message_entities
 # For sending and receiving requests
 from telethon.tl import MTProtoRequest, Session
@@ -16,10 +24,12 @@ from telethon.tl.all_tlobjects import layer
 from telethon.tl.functions import InitConnectionRequest, InvokeWithLayerRequest
 # The following is required to get the password salt
 from telethon.tl.functions.account import GetPasswordRequest
-from telethon.tl.functions.auth import (CheckPasswordRequest, LogOutRequest,
-                                        SendCodeRequest, SignInRequest,
-                                        SignUpRequest)
+from telethon.tl.functions.auth import (
+    CheckPasswordRequest, ExportAuthorizationRequest, ImportAuthorizationRequest,
+    LogOutRequest, SendCodeRequest, SignInRequest, SignUpRequest)
 from telethon.tl.functions.help import GetConfigRequest
+from telethon.tl.functions.updates import (
+    GetChannelDifferenceRequest, GetDifferenceRequest, GetStateRequest)
 from telethon.tl.functions.messages import (
     GetDialogsRequest, GetHistoryRequest, ReadHistoryRequest, SendMediaRequest,
     SendMessageRequest)
@@ -28,12 +38,20 @@ from telethon.tl.functions.upload import (
     GetFileRequest, SaveBigFilePartRequest, SaveFilePartRequest)
 # All the types we need to work with
 from telethon.tl.types import (
-    ChatPhotoEmpty, DocumentAttributeAudio, DocumentAttributeFilename,
-    InputDocumentFileLocation, InputFile, InputFileLocation,
-    InputMediaUploadedDocument, InputMediaUploadedPhoto, InputPeerEmpty,
-    MessageMediaContact, MessageMediaDocument, MessageMediaPhoto,
-    UserProfilePhotoEmpty)
-from telethon.utils import (find_user_or_chat, get_input_peer,
+    ChannelMessagesFilterEmpty, ChatPhotoEmpty, DocumentAttributeAudio, DocumentAttributeFilename,
+    InputDocument, InputDocumentFileLocation, InputFile, InputFileBig,
+    InputFileLocation, InputMediaDocument, InputMediaPhoto,
+    InputChannel, InputMediaUploadedDocument, InputMediaUploadedPhoto,
+    InputPeerChannel, InputPeerEmpty, InputPhoto, MessageMediaContact,
+    MessageMediaDocument, MessageMediaPhoto, UpdateNewChannelMessage,
+    UpdateNewEncryptedMessage, UpdateNewMessage, UserProfilePhotoEmpty)
+from telethon.tl.types.updates import (
+    ChannelDifference, ChannelDifferenceTooLong, Difference, DifferenceEmpty,
+    DifferenceSlice, DifferenceTooLong)
+from telethon.utils import (AdaptivePartSize, FloodWaitRegistry, RateLimiter,
+                            UploadCache, find_user_or_chat,
+                            get_entities_by_peer_id, get_input_media,
+                            get_input_peer, get_peer_id,
                             get_appropiate_part_size, get_extension)
 
 
@@ -44,7 +62,10 @@ class TelegramClient:
 
     # region Initialization
 
-    def __init__(self, session, api_id, api_hash):
+    def __init__(self, session, api_id, api_hash, upload_cache=None,
+                 flood_sleep_threshold=60, update_workers=4, track_updates=True,
+                 auto_reconnect=True, framing=FullFraming,
+                 compression_threshold=None, compression_level=6):
         """Initializes the Telegram client with the specified API ID and Hash.
 
            Session can either be a `str` object (the filename for the loaded/saved .session)
@@ -52,7 +73,34 @@ class TelegramClient:
            If you don't want any file to be saved, pass `None`
 
            In the later case, you are free to override the `Session` class to provide different
-           .save() and .load() implementations to suit your needs."""
+           .write() and .load() implementations to suit your needs, or to use a `SQLiteSession`,
+           which only writes the fields that changed whenever it's saved.
+
+           The upload_cache can either be a `str` object (the filename for the loaded/saved
+           cache) or an `UploadCache` instance. If given, uploading the same file contents
+           more than once will reuse the previously uploaded file instead.
+
+           Requests failing with a FLOOD_WAIT shorter than flood_sleep_threshold seconds
+           are sent again after waiting. Longer ones are raised, and the same request
+           will fail without being sent until the FLOOD_WAIT is over.
+
+           The update handlers are called from update_workers threads. The updates
+           of the same chat are always handled in order, by the same thread.
+
+           If track_updates is True, the state of the updates is saved in the session,
+           so that the updates are never handled twice, and those missed (while
+           offline, or because of a gap) are fetched and handled as well.
+
+           If auto_reconnect is True, connections which fail are replaced by new
+           ones, and the requests which were being sent are sent again.
+
+           The framing chooses how the packets are delimited on the connections
+           (FullFraming, IntermediateFraming, AbridgedFraming or ObfuscatedFraming).
+           It can be any callable returning a new Framing, such as its class.
+
+           If compression_threshold is given, the requests which take at least as many
+           bytes (such as long messages or big vectors) are sent compressed with the
+           given zlib compression_level, whenever compressing them makes them smaller."""
 
         if api_id is None or api_hash is None:
             raise PermissionError(
@@ -70,14 +118,52 @@ class TelegramClient:
             raise ValueError(
                 'The given session must either be a string or a Session instance.')
 
+        if isinstance(upload_cache, str):
+            self.upload_cache = UploadCache.try_load_or_create_new(upload_cache)
+        elif upload_cache is None or isinstance(upload_cache, UploadCache):
+            self.upload_cache = upload_cache
+        else:
+            raise ValueError(
+                'The given upload cache must either be a string or an UploadCache instance.')
+
+        self.framing = framing
         self.transport = TcpTransport(self.session.server_address,
-                                      self.session.port)
+                                      self.session.port, framing)
+
+        # Chooses the part size and how many parts to transfer at once
+        self.part_size_controller = AdaptivePartSize()
+
+        # Keeps track of how many messages can be sent when sending them in bulk
+        self.rate_limiter = RateLimiter()
+
+        # Remembers which requests can't be sent yet because of a FLOOD_WAIT
+        self.flood_waits = FloodWaitRegistry()
+        self.flood_sleep_threshold = flood_sleep_threshold
+
+        # Delivers the updates to their handlers from other threads
+        self.updates = UpdateDispatcher(workers=update_workers)
+        self.auto_reconnect = auto_reconnect
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+
+        # Missed updates are fetched from another thread (see catch_up)
+        self.pending_gaps = set()  # Channel IDs, or None for the account
+        self.gaps_lock = Lock()
+        self.gaps_event = Event()
+        self.catch_up_thread = None
+        if track_updates:
+            self.updates.state = self.session.update_state
+            self.updates.on_gap = self.on_gap
 
         # These will be set later
         self.dc_options = None
         self.sender = None
         self.phone_code_hashes = {}
 
+        # Connections to other DCs (DC ID: MtProtoSender), to send the requests
+        # which must be sent there without moving the main connection
+        self.dc_senders = {}
+
         # We need to be signed in before we can listen for updates
         self.signed_in = False
 
@@ -90,32 +176,36 @@ class TelegramClient:
            Note that authenticating to the Telegram servers is not the same as authenticating
            the app, which requires to send a code first."""
         try:
+            if self.sender:
+                # Its reader thread owns the connection, so it needs a new one
+                self.sender.disconnect()
+                self.sender = None
+                self.transport = TcpTransport(self.session.server_address,
+                                              self.session.port, self.framing)
+
             if not self.session.auth_key or reconnect:
                 self.session.auth_key, self.session.time_offset = \
                     authenticator.do_authentication(self.transport)
 
                 self.session.save()
 
-            self.sender = MtProtoSender(self.transport, self.session)
-
-            # Now it's time to send an InitConnectionRequest
-            # This must always be invoked with the layer we'll be using
-            query = InitConnectionRequest(
-                api_id=self.api_id,
-                device_model=platform.node(),
-                system_version=platform.system(),
-                app_version=self.__version__,
-                lang_code='en',
-                query=GetConfigRequest())
-
-            result = self.invoke(
-                InvokeWithLayerRequest(
-                    layer=layer, query=query))
+            # The same updates are kept, so their handlers survive reconnections
+            self.sender = MtProtoSender(
+                self.transport, self.session, self.updates,
+                auto_reconnect=self.auto_reconnect,
+                compression_threshold=self.compression_threshold,
+                compression_level=self.compression_level)
+            self.sender.on_reconnect = self.on_reconnect
+            result = self.init_connection(self.sender)
 
             # We're only interested in the DC options,
             # although many other options are available!
             self.dc_options = result.dc_options
 
+            # Remember the auth key for this DC, to reuse it when coming back
+            self.session.dc_id = result.this_dc
+            self.session.set_dc_auth_key(result.this_dc, self.session.auth_key)
+
             # We can now enable these (for such methods such as logout)
             self.sender.ack_requests_confirm = True
 
@@ -126,26 +216,119 @@ class TelegramClient:
             print('Could not stabilise initial connection: {}'.format(error))
             return False
 
-    def reconnect_to_dc(self, dc_id):
-        """Reconnects to the specified DC ID. This is automatically called after an InvalidDCError is raised"""
+    def init_connection(self, sender):
+        """Sends an InitConnectionRequest through the given sender, which must
+           always be invoked with the layer we'll be using, and returns the Config"""
+        query = InitConnectionRequest(
+            api_id=self.api_id,
+            device_model=platform.node(),
+            system_version=platform.system(),
+            app_version=self.__version__,
+            lang_code='en',
+            query=GetConfigRequest())
+
+        return self.invoke_on(sender,
+                              InvokeWithLayerRequest(layer=layer, query=query))
+
+    def get_dc(self, dc_id):
+        """Gets the DcOption for the specified DC ID, preferring IPv4"""
         if self.dc_options is None or not self.dc_options:
             raise ConnectionError(
                 "Can't reconnect. Stabilise an initial connection first.")
 
-        dc = next(dc for dc in self.dc_options if dc.id == dc_id)
+        return min((dc for dc in self.dc_options if dc.id == dc_id),
+                   key=lambda dc: (bool(dc.ipv6), bool(dc.media_only)))
+
+    def reconnect_to_dc(self, dc_id):
+        """Reconnects to the specified DC ID. This is automatically called after
+           a MigrateError (other than FileMigrateError) is raised.
+           If this DC was used before, its auth key is reused"""
+        dc = self.get_dc(dc_id)
+
+        if self.sender:
+            self.sender.disconnect()
+            self.sender = None
 
-        self.transport.close()
-        self.transport = TcpTransport(dc.ip_address, dc.port)
+        # A connection which was already open to this DC can't be kept
+        other_sender = self.dc_senders.pop(dc_id, None)
+        if other_sender:
+            other_sender.disconnect()
+
+        self.transport = TcpTransport(dc.ip_address, dc.port, self.framing)
         self.session.server_address = dc.ip_address
         self.session.port = dc.port
+        self.session.auth_key = self.session.dc_auth_keys.get(dc_id)
+        self.session.start_new_session()
         self.session.save()
 
-        self.connect(reconnect=True)
+        self.connect()
+
+    def get_dc_sender(self, dc_id):
+        """Gets a sender connected to the specified DC ID, authorized as the current
+           user, to send the requests which must be sent there (for instance, to
+           download files stored there). Senders are cached and reused, as are their
+           auth keys, so only the first time they're needed requires authenticating"""
+        if dc_id == self.session.dc_id:
+            return self.sender
+
+        sender = self.dc_senders.get(dc_id)
+        if sender:
+            return sender
+
+        dc = self.get_dc(dc_id)
+        transport = TcpTransport(dc.ip_address, dc.port, self.framing)
+
+        # Each connection needs its own MTProto session, which is not saved
+        session = Session(None)
+        session.server_address = dc.ip_address
+        session.port = dc.port
+        session.entities = self.session.entities
+        session.auth_key = self.session.dc_auth_keys.get(dc_id)
+        if session.auth_key:
+            session.time_offset = self.session.time_offset
+        else:
+            session.auth_key, session.time_offset = \
+                authenticator.do_authentication(transport)
+
+        sender = MtProtoSender(
+            transport, session, auto_reconnect=self.auto_reconnect,
+            compression_threshold=self.compression_threshold,
+            compression_level=self.compression_level)
+        self.init_connection(sender)
+
+        if session.auth_key is not self.session.dc_auth_keys.get(dc_id):
+            # The new auth key must be authorized as the current user
+            if self.is_user_authorized():
+                exported = self.invoke(ExportAuthorizationRequest(dc_id))
+                self.invoke_on(sender, ImportAuthorizationRequest(
+                    exported.id, exported.bytes))
+
+            self.session.set_dc_auth_key(dc_id, session.auth_key)
+
+        sender.ack_requests_confirm = True
+        self.dc_senders[dc_id] = sender
+        return sender
 
     def disconnect(self):
-        """Disconnects from the Telegram server **and pauses all the spawned threads**"""
+        """Disconnects from the Telegram server **and pauses all the spawned threads**.
+           Any pending change to the session is also saved"""
+        for sender in self.dc_senders.values():
+            sender.disconnect()
+        self.dc_senders.clear()
+        self.updates.stop()
+
+        self.catch_up_thread = None
+        self.gaps_event.set()  # Wake it up so it can stop
+
         if self.sender:
             self.sender.disconnect()
+        elif self.session:
+            self.session.flush()
+
+    def get_connection_metrics(self):
+        """Gets the round-trip time of the pings sent to keep the connection
+           alive as a dictionary, which tells how much latency there is"""
+        return self.sender.get_metrics()
 
     # endregion
 
@@ -158,8 +341,24 @@ class TelegramClient:
         if not issubclass(type(request), MTProtoRequest):
             raise ValueError('You can only invoke MtProtoRequests')
 
-        self.sender.send(request)
-        self.sender.receive(request, timeout)
+        try:
+            return self.invoke_on(self.sender, request, timeout)
+
+        except FileMigrateError as error:
+            # Only this request must be sent to the other DC
+            return self.invoke_on(
+                self.get_dc_sender(error.new_dc), request, timeout)
+
+        except MigrateError as error:
+            # Everything else must be sent to the other DC from now on
+            self.reconnect_to_dc(error.new_dc)
+            return self.invoke_on(self.sender, request, timeout)
+
+    def invoke_on(self, sender, request, timeout=timedelta(seconds=5)):
+        """Invokes a MTProtoRequest through the given sender and returns its result"""
+        self.check_flood_wait(request)
+        sender.send(request)
+        self.receive_flood_waiting(request, timeout, sender)
 
         return request.result
 
@@ -172,16 +371,10 @@ class TelegramClient:
 
     def send_code_request(self, phone_number):
         """Sends a code request to the specified phone number"""
-        request = SendCodeRequest(phone_number, self.api_id, self.api_hash)
-        completed = False
-        while not completed:
-            try:
-                result = self.invoke(request)
-                self.phone_code_hashes[phone_number] = result.phone_code_hash
-                completed = True
-
-            except InvalidDCError as error:
-                self.reconnect_to_dc(error.new_dc)
+        # If the phone is associated with another DC, invoke moves there
+        result = self.invoke(
+            SendCodeRequest(phone_number, self.api_id, self.api_hash))
+        self.phone_code_hashes[phone_number] = result.phone_code_hash
 
     def sign_in(self, phone_number=None, code=None, password=None):
         """Completes the authorization of a phone number by providing the received code.
@@ -257,6 +450,27 @@ class TelegramClient:
 
     # endregion
 
+    # region Entities
+
+    def get_input_entity(self, entity):
+        """Gets the input peer for the given entity (user, chat, channel or input peer),
+           or for the given ID, username or phone number of any of the entities
+           which have been seen before (and saved in the session).
+           Raises ValueError if it could not be found"""
+        input_peer = get_input_peer(entity)
+        if input_peer is None:
+            input_peer = self.session.entities.get_input_peer(entity)
+
+        if input_peer is None:
+            raise ValueError(
+                'Could not find the input peer for {}. Make sure the entity '
+                'was seen before (for instance, by getting the dialogs)'
+                .format(repr(entity)))
+
+        return input_peer
+
+    # endregion
+
     # region Dialogs ("chats") requests
 
     def get_dialogs(self,
@@ -273,9 +487,99 @@ class TelegramClient:
                 offset_id=offset_id,
                 offset_peer=offset_peer,
                 limit=count))
+        entities = get_entities_by_peer_id(r.users, r.chats)
         return (
             r.dialogs,
-            [find_user_or_chat(d.peer, r.users, r.chats) for d in r.dialogs])
+            [find_user_or_chat(d.peer, r.users, r.chats, entities)
+             for d in r.dialogs])
+
+    def iter_dialogs(self, limit=None, batch_size=100, prefetch=True):
+        """
+        Iterates over all the dialogs, from the most recent to the oldest one,
+        yielding (dialog, entity) tuples, where the `entity` represents the
+        user, chat or channel corresponding to that dialog (or None if it was not found).
+        The dialogs are retrieved page by page, and only the current page is kept,
+        while the entities found are remembered in the session as they arrive.
+
+        :param limit:      Number of dialogs to be retrieved. None = All the dialogs
+        :param batch_size: Number of dialogs to be retrieved on every request (100 at most)
+        :param prefetch:   Whether the next page should be requested while the current one is consumed
+        """
+        batch_size = min(batch_size, 100)
+        remaining = limit
+        offset_date, offset_id, offset_peer = None, 0, InputPeerEmpty()
+
+        def request_page():
+            request = GetDialogsRequest(
+                offset_date=offset_date,
+                offset_id=offset_id,
+                offset_peer=offset_peer,
+                limit=batch_size if remaining is None else min(batch_size, remaining),
+                # The pinned dialogs are always returned on the first page
+                exclude_pinned=True if offset_id else None)
+            self.check_flood_wait(request)
+            self.sender.send(request)
+            return request
+
+        # The peers of the previous page, since the dialog with the
+        # offset given may be returned again on the next page
+        seen = set()
+        request = None
+        try:
+            request = request_page()
+            while request:
+                self.receive_flood_waiting(request)
+                result, requested, request = request.result, request.limit, None
+                dialogs = [d for d in result.dialogs
+                           if get_peer_id(d.peer) not in seen]
+                seen = {get_peer_id(d.peer) for d in result.dialogs}
+
+                # Dialogs (instead of a slice) means that there is nothing left
+                done = (not dialogs or len(result.dialogs) < requested or
+                        not hasattr(result, 'count'))
+                if remaining is not None:
+                    dialogs = dialogs[:remaining]
+                    remaining -= len(dialogs)
+                    done |= remaining <= 0
+
+                entities = get_entities_by_peer_id(result.users, result.chats)
+                if not done:
+                    offset_date, offset_id, offset_peer = self.get_dialogs_offset(
+                        result.dialogs[-1], result.messages, entities)
+                    done = offset_peer is None
+                    if prefetch and not done:
+                        request = request_page()
+
+                for dialog in dialogs:
+                    yield dialog, entities.get(get_peer_id(dialog.peer))
+
+                if not done and not prefetch:
+                    request = request_page()
+        finally:
+            # Don't leave the prefetched page behind unanswered
+            if request:
+                self.drain(self.sender, deque([(request, None)]))
+
+    def get_dialogs_offset(self, dialog, messages, entities):
+        """Gets the (offset_date, offset_id, offset_peer) needed to retrieve
+           the dialogs after the given one, which must be the last one of a response
+           with the given messages and entities (see get_entities_by_peer_id).
+           The offset_peer will be None if it can't be found"""
+        # Message IDs are only unique outside channels, so match the channel too
+        channel_id = getattr(dialog.peer, 'channel_id', None)
+        offset_date = None
+        for message in messages:
+            if (message.id == dialog.top_message and
+                    getattr(message.to_id, 'channel_id', None) == channel_id):
+                offset_date = message.date
+                break
+
+        peer_id = get_peer_id(dialog.peer)
+        offset_peer = get_input_peer(entities.get(peer_id))
+        if offset_peer is None:
+            offset_peer = self.session.entities.get_input_peer(peer_id)
+
+        return offset_date, dialog.top_message, offset_peer
 
     # endregion
 
@@ -286,7 +590,7 @@ class TelegramClient:
                      message,
                      markdown=False,
                      no_web_page=False):
-        """Sends a message to the given entity (or input peer) and returns the sent message ID"""
+        """Sends a message to the given entity (or input peer, ID, username or phone) and returns the sent message ID"""
         if markdown:
             msg, entities = parse_message_entities(message)
         else:
@@ -295,13 +599,104 @@ class TelegramClient:
         msg_id = utils.generate_random_long()
         self.invoke(
             SendMessageRequest(
-                peer=get_input_peer(entity),
+                peer=self.get_input_entity(entity),
                 message=msg,
                 random_id=msg_id,
                 entities=entities,
                 no_webpage=no_web_page))
         return msg_id
 
+    def send_messages_bulk(self,
+                           peers,
+                           message,
+                           markdown=False,
+                           no_web_page=False,
+                           window=8,
+                           max_flood_wait=None):
+        """
+        Sends a message to every given peer, sending several of them at once
+        while respecting the budgets of the client's rate_limiter (a RateLimiter).
+        A FLOOD_WAIT only delays sending more messages to the peer which caused it.
+
+        :param peers:          The entities (or input peers, IDs, usernames or phones) to send the message to
+        :param message:        The message to send, or a function taking the peer and returning it
+        :param markdown:       Whether the message should be parsed as markdown
+        :param no_web_page:    Whether the web page preview should be disabled
+        :param window:         How many messages may be sent before receiving their results
+        :param max_flood_wait: Maximum seconds to wait after a FLOOD_WAIT before giving up on a peer.
+                               None = Wait as long as required
+
+        :return: A list with a result for every peer, in the same order: either the
+                 sent message ID, or the exception which prevented sending it
+        """
+        def parse(text):
+            return parse_message_entities(text) if markdown else (text, [])
+
+        # The same message is parsed only once for all the peers
+        parsed = None if callable(message) else parse(message)
+
+        limiter = self.rate_limiter
+        results = [None] * len(peers)
+
+        # (when it can be sent, index, input peer, marked ID) of the
+        # messages to be sent, and (request, index) of those already sent
+        scheduled = []
+        pending = deque()
+        for i, peer in enumerate(peers):
+            try:
+                input_peer = self.get_input_entity(peer)
+            except ValueError as error:
+                results[i] = error
+                continue
+            scheduled.append((0, i, input_peer, get_peer_id(input_peer)))
+        heapq.heapify(scheduled)
+
+        while scheduled or pending:
+            # Send as many messages as the window and the budgets allow
+            while (scheduled and len(pending) < window and
+                   scheduled[0][0] <= monotonic() and not limiter.get_delay()):
+                when, i, input_peer, peer_id = heapq.heappop(scheduled)
+                delay = limiter.get_delay(peer_id)
+                if delay:
+                    heapq.heappush(scheduled, (monotonic() + delay, i,
+                                               input_peer, peer_id))
+                    continue
+
+                msg, entities = parsed or parse(message(peers[i]))
+                request = SendMessageRequest(
+                    peer=input_peer,
+                    message=msg,
+                    random_id=utils.generate_random_long(),
+                    entities=entities,
+                    no_webpage=no_web_page)
+                self.sender.send(request)
+                limiter.on_send(peer_id)
+                pending.append((request, i, input_peer, peer_id))
+
+            if not pending:
+                # Nothing can be sent yet, so wait until something can
+                sleep(max(scheduled[0][0] - monotonic(), limiter.get_delay()))
+                continue
+
+            request, i, input_peer, peer_id = pending.popleft()
+            try:
+                self.sender.receive(request)
+                results[i] = request.random_id
+            except FloodWaitError as error:
+                self.flood_waits.record(request, error.seconds)
+                if max_flood_wait is None or error.seconds <= max_flood_wait:
+                    limiter.on_flood_wait(error.seconds, peer_id)
+                    heapq.heappush(scheduled, (monotonic() + error.seconds, i,
+                                               input_peer, peer_id))
+                else:
+                    results[i] = error
+            except RPCError as error:
+                results[i] = error
+            except TimeoutError as error:
+                results[i] = error
+
+        return results
+
     def get_message_history(self,
                             entity,
                             limit=20,
@@ -313,7 +708,7 @@ class TelegramClient:
         """
         Gets the message history for the specified entity
 
-        :param entity:      The entity (or input peer) from whom to retrieve the message history
+        :param entity:      The entity (or input peer, ID, username or phone) from whom to retrieve the message history
         :param limit:       Number of messages to be retrieved
         :param offset_date: Offset date (messages *previous* to this date will be retrieved)
         :param offset_id:   Offset message ID (only messages *previous* to the given ID will be retrieved)
@@ -326,7 +721,7 @@ class TelegramClient:
         """
         result = self.invoke(
             GetHistoryRequest(
-                get_input_peer(entity),
+                self.get_input_entity(entity),
                 limit=limit,
                 offset_date=offset_date,
                 offset_id=offset_id,
@@ -339,16 +734,89 @@ class TelegramClient:
         # the total messages count is retrieved by counting all the retrieved messages
         total_messages = getattr(result, 'count', len(result.messages))
 
-        # Iterate over all the messages and find the sender User
-        users = []
-        for msg in result.messages:
-            for usr in result.users:
-                if msg.from_id == usr.id:
-                    users.append(usr)
-                    break
+        # Find the sender User of every message (None if it was not found)
+        users_by_id = {usr.id: usr for usr in result.users}
+        users = [users_by_id.get(getattr(msg, 'from_id', None))
+                 for msg in result.messages]
 
         return total_messages, result.messages, users
 
+    def iter_messages(self,
+                      entity,
+                      limit=None,
+                      offset_date=None,
+                      offset_id=0,
+                      max_id=0,
+                      min_id=0,
+                      batch_size=100,
+                      prefetch=True):
+        """
+        Iterates over the message history for the specified entity, from the
+        newest to the oldest message, yielding (message, sender) tuples.
+        The history is retrieved page by page, and only the current page is kept,
+        so the memory used doesn't depend on how long the history is.
+
+        :param entity:      The entity (or input peer, ID, username or phone) from whom to retrieve the message history
+        :param limit:       Number of messages to be retrieved. None = The whole history
+        :param offset_date: Offset date (messages *previous* to this date will be retrieved)
+        :param offset_id:   Offset message ID (only messages *previous* to the given ID will be retrieved)
+        :param max_id:      All the messages with a higher (newer) ID or equal to this will be excluded
+        :param min_id:      All the messages with a lower (older) ID or equal to this will be excluded
+        :param batch_size:  Number of messages to be retrieved on every request (100 at most)
+        :param prefetch:    Whether the next page should be requested while the current one is consumed
+
+        Note that the sender can be null if it was not found!
+        """
+        input_peer = self.get_input_entity(entity)
+        batch_size = min(batch_size, 100)
+        remaining = limit
+
+        def request_page():
+            request = GetHistoryRequest(
+                input_peer,
+                limit=batch_size if remaining is None else min(batch_size, remaining),
+                offset_date=offset_date,
+                offset_id=offset_id,
+                max_id=max_id,
+                min_id=min_id,
+                add_offset=0)
+            self.check_flood_wait(request)
+            self.sender.send(request)
+            return request
+
+        request = None
+        try:
+            request = request_page()
+            while request:
+                self.receive_flood_waiting(request)
+                result, requested, request = request.result, request.limit, None
+                messages = result.messages
+
+                # Messages (instead of a slice) means that there is nothing left
+                done = (not messages or len(messages) < requested or
+                        not hasattr(result, 'count'))
+                if remaining is not None:
+                    remaining -= len(messages)
+                    done |= remaining <= 0
+
+                if not done:
+                    # Only the next page depends on the current one, so it can be
+                    # requested already while the messages of this one are consumed
+                    offset_id, offset_date = messages[-1].id, None
+                    if prefetch:
+                        request = request_page()
+
+                users = {user.id: user for user in result.users}
+                for message in messages:
+                    yield message, users.get(getattr(message, 'from_id', None))
+
+                if not done and not prefetch:
+                    request = request_page()
+        finally:
+            # Don't leave the prefetched page behind unanswered
+            if request:
+                self.drain(self.sender, deque([(request, None)]))
+
     def send_read_acknowledge(self, entity, messages=None, max_id=None):
         """Sends a "read acknowledge" (i.e., notifying the given peer that we've
            read their messages, also known as the "double check ✅✅").
@@ -367,7 +835,7 @@ class TelegramClient:
             else:
                 max_id = messages.id
 
-        return self.invoke(ReadHistoryRequest(peer=get_input_peer(entity), max_id=max_id))
+        return self.invoke(ReadHistoryRequest(peer=self.get_input_entity(entity), max_id=max_id))
 
     # endregion
 
@@ -377,22 +845,94 @@ class TelegramClient:
     # region Uploading media requests
 
     def upload_file(self,
-                    file_path,
+                    file,
                     part_size_kb=None,
                     file_name=None,
                     progress_callback=None):
-        """Uploads the specified file_path and returns a handle which can be later used
+        """Uploads the specified file and returns a handle which can be later used
 
-        :param file_path: The file path of the file that will be uploaded
+        :param file: The file that will be uploaded. This can be a file path, a bytes-like
+                     object (such as bytes or a memoryview) or any readable binary stream,
+                     even if its length is unknown (i.e., it is not seekable)
         :param part_size_kb: The part size when uploading the file. None = Automatic
         :param file_name: The name of the uploaded file. None = Automatic
         :param progress_callback: A callback function which takes two parameters,
-                                  uploaded size (in bytes) and total file size (in bytes)
+                                  uploaded size (in bytes) and total file size (in bytes,
+                                  or None if it is not known yet)
                                   This is called every time a part is uploaded
+
+        If an upload_cache is being used and the same contents were uploaded before,
+        the previous handle will be returned and nothing will be uploaded.
         """
-        file_size = path.getsize(file_path)
+        if not isinstance(file, str):
+            return self.upload_contents(file, part_size_kb, file_name,
+                                        progress_callback)
+
+        # Set a default file name if None was specified
+        if not file_name:
+            file_name = path.basename(file)
+
+        # Memory map the file so its parts are read straight from it.
+        # Empty files cannot be mapped, but there's nothing to read either
+        with open(file, 'rb') as stream:
+            if not path.getsize(file):
+                return self.upload_contents(b'', part_size_kb, file_name,
+                                            progress_callback)
+
+            mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            return self.upload_contents(mapped, part_size_kb, file_name,
+                                        progress_callback)
+        finally:
+            # The views of its parts are gone once the upload is over, unless
+            # an error is being raised (then it's closed once it's collected)
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+
+    def upload_contents(self,
+                        file,
+                        part_size_kb=None,
+                        file_name=None,
+                        progress_callback=None):
+        """Uploads the given bytes-like object or readable binary stream,
+           just like upload_file does, and returns a handle to the uploaded file"""
+        if not file_name:
+            file_name = path.basename(getattr(file, 'name', '')) or 'unnamed'
+
+        content_hash = None
+        if self.upload_cache:
+            content_hash = UploadCache.get_content_hash(file)
+            entry = self.upload_cache.get(content_hash)
+            if entry:
+                cached = entry.input_file
+                if isinstance(cached, InputFileBig):
+                    return InputFileBig(
+                        id=cached.id, parts=cached.parts, name=file_name)
+                return InputFile(
+                    id=cached.id,
+                    parts=cached.parts,
+                    name=file_name,
+                    md5_checksum=cached.md5_checksum)
+
+        if isinstance(file, (bytes, bytearray, memoryview, mmap.mmap)):
+            file = memoryview(file)
+            file_size = len(file)
+        else:
+            file_size = utils.get_stream_size(file)
+
+        adaptive = self.part_size_controller
         if not part_size_kb:
-            part_size_kb = get_appropiate_part_size(file_size)
+            # Streams of unknown length may be as big as possible, and the
+            # part size can't be changed midway, so use the adaptive one
+            # unless the file is too big to be uploaded with such part size
+            if file_size is None:
+                part_size_kb = 512
+            else:
+                part_size_kb = max(
+                    get_appropiate_part_size(file_size), adaptive.part_size_kb)
 
         if part_size_kb > 512:
             raise ValueError('The part size must be less or equal to 512KB')
@@ -401,49 +941,93 @@ class TelegramClient:
         if part_size % 1024 != 0:
             raise ValueError('The part size must be evenly divisible by 1024')
 
+        if isinstance(file, memoryview):
+            parts = (file[i:i + part_size]
+                     for i in range(0, file_size, part_size))
+        else:
+            parts = utils.iter_stream_parts(file, part_size)
+
         # Determine whether the file is too big (over 10MB) or not
         # Telegram does make a distinction between smaller or larger files
-        is_large = file_size > 10 * 1024 * 1024
-        part_count = (file_size + part_size - 1) // part_size
+        big_size = 10 * 1024 * 1024
+        if file_size is None:
+            # Read ahead to find it out, and if it is big, count its parts lazily
+            read_ahead = list(islice(parts, big_size // part_size + 1))
+            if sum(len(part) for part in read_ahead) > big_size:
+                is_large, part_count = True, None
+            else:
+                is_large, part_count = False, len(read_ahead)
+                file_size = sum(len(part) for part in read_ahead)
+
+            parts = chain(read_ahead, parts)
+        else:
+            is_large = file_size > big_size
+            part_count = (file_size + part_size - 1) // part_size
 
         # Multiply the datetime timestamp by 10^6 to get the ticks
         # This is high likely going to be unique
         file_id = int(datetime.now().timestamp() * (10**6))
         hash_md5 = md5()
 
-        with open(file_path, 'rb') as file:
-            for part_index in range(part_count):
-                # Read the file by in chunks of size part_size
-                part = file.read(part_size)
-
-                # The SavePartRequest is different depending on whether
-                # the file is too large or not (over or less than 10MB)
-                if is_large:
-                    request = SaveBigFilePartRequest(file_id, part_index,
-                                                     part_count, part)
-                else:
-                    request = SaveFilePartRequest(file_id, part_index, part)
+        # If the part count is not known yet, it must be -1 until the last part
+        parts = utils.enumerate_parts(parts, part_count)
 
-                # Invoke the file upload and increment both the part index and MD5 checksum
-                result = self.invoke(request)
-                if result:
-                    hash_md5.update(part)
+        # Requests which were sent (and when) but have not been received yet
+        pending = deque()
+        uploaded_size = 0
+        part_index = 0
+        try:
+            next_part = next(parts, None)
+            while next_part is not None or pending:
+                # Keep as many parts in flight as the adaptive window allows
+                if next_part is not None and len(pending) < adaptive.window:
+                    part_index, total_parts, part = next_part
+
+                    # The SavePartRequest is different depending on whether
+                    # the file is too large or not (over or less than 10MB)
+                    if is_large:
+                        request = SaveBigFilePartRequest(file_id, part_index,
+                                                         total_parts, part)
+                    else:
+                        request = SaveFilePartRequest(file_id, part_index, part)
+                        hash_md5.update(part)
+
+                    self.sender.send(request)
+                    pending.append((request, monotonic()))
+
+                    part_index += 1
+                    next_part = next(parts, None)
+                    continue
+
+                # Receive the oldest file part upload and report the progress
+                request, send_time = pending.popleft()
+                self.receive_part(request, send_time, adaptive)
+                if request.result:
+                    uploaded_size += len(request.bytes)
                     if progress_callback:
-                        progress_callback(file.tell(), file_size)
+                        progress_callback(uploaded_size, file_size)
                 else:
                     raise ValueError('Could not upload file part #{}'.format(
-                        part_index))
-
-        # Set a default file name if None was specified
-        if not file_name:
-            file_name = path.basename(file_path)
+                        request.file_part))
+        finally:
+            # Don't leave any part behind unanswered if the upload failed
+            self.drain(self.sender, pending)
 
         # After the file has been uploaded, we can return a handle pointing to it
-        return InputFile(
-            id=file_id,
-            parts=part_count,
-            name=file_name,
-            md5_checksum=hash_md5.hexdigest())
+        if is_large:
+            input_file = InputFileBig(
+                id=file_id, parts=part_index, name=file_name)
+        else:
+            input_file = InputFile(
+                id=file_id,
+                parts=part_index,
+                name=file_name,
+                md5_checksum=hash_md5.hexdigest())
+
+        if content_hash:
+            self.upload_cache.add(content_hash, input_file)
+
+        return input_file
 
     def send_photo_file(self, input_file, entity, caption=''):
         """Sends a previously uploaded input_file
@@ -477,11 +1061,48 @@ class TelegramClient:
 
     def send_media_file(self, input_media, entity):
         """Sends any input_media (contact, document, photo...) to the given entiy"""
-        self.invoke(
-            SendMediaRequest(
-                peer=get_input_peer(entity),
-                media=input_media,
-                random_id=utils.generate_random_long()))
+        entry = None
+        if self.upload_cache and isinstance(
+                input_media,
+            (InputMediaUploadedPhoto, InputMediaUploadedDocument)):
+            entry = self.upload_cache.get_by_input_file(input_media.file)
+
+        # If these contents were already sent, there's no need to send the
+        # uploaded file again: we can reuse the media Telegram already has
+        reused = False
+        if entry and entry.input_media:
+            if isinstance(input_media, InputMediaUploadedDocument):
+                if isinstance(entry.input_media, InputDocument):
+                    input_media = InputMediaDocument(entry.input_media,
+                                                     input_media.caption)
+                    reused = True
+            elif isinstance(entry.input_media, InputPhoto):
+                input_media = InputMediaPhoto(entry.input_media,
+                                              input_media.caption)
+                reused = True
+        try:
+            result = self.invoke(
+                SendMediaRequest(
+                    peer=self.get_input_entity(entity),
+                    media=input_media,
+                    random_id=utils.generate_random_long()))
+        except RPCError:
+            # The cached media may no longer be valid, don't reuse it again
+            if reused:
+                self.upload_cache.remove(entry.content_hash)
+                self.upload_cache.save()
+            raise
+
+        if entry and not reused:
+            # Remember the media we've been given back for the next time
+            for update in getattr(result, 'updates', []):
+                message = getattr(update, 'message', None)
+                input_media_ref = get_input_media(
+                    getattr(message, 'media', None))
+                if input_media_ref:
+                    self.upload_cache.set_input_media(input_media.file,
+                                                      input_media_ref)
+                    break
 
     # endregion
 
@@ -641,44 +1262,189 @@ class TelegramClient:
     def download_file_loc(self,
                           input_location,
                           file_path,
-                          part_size_kb=64,
+                          part_size_kb=None,
                           file_size=None,
                           progress_callback=None):
         """Downloads media from the given input_file_location to the specified file_path.
            If a progress_callback function is given, it will be called taking two
            arguments (downloaded bytes count and total file size)"""
 
-        if not part_size_kb:
-            if not file_size:
-                raise ValueError('A part size value must be provided')
-            else:
-                part_size_kb = get_appropiate_part_size(file_size)
-
-        part_size = int(part_size_kb * 1024)
-        if part_size % 1024 != 0:
-            raise ValueError('The part size must be evenly divisible by 1024')
+        downloader = self.iter_download(input_location, part_size_kb,
+                                        file_size)
 
         # Ensure that we'll be able to download the media
         utils.ensure_parent_dir_exists(file_path)
 
-        # Start with an offset index of 0
-        offset_index = 0
         with open(file_path, 'wb') as file:
+            try:
+                while True:
+                    file.write(next(downloader))
+                    if progress_callback:
+                        progress_callback(file.tell(), file_size)
+
+            except StopIteration as stop:
+                return stop.value  # Return some extra information
+
+    def iter_download(self,
+                      input_location,
+                      part_size_kb=None,
+                      file_size=None,
+                      prefetch=None):
+        """Iterates over the media from the given input_file_location,
+           yielding the downloaded bytes part by part as soon as they arrive.
+           Once the iteration is over, the generator returns the file type.
+
+        :param input_location: The InputFileLocation of the media to download
+        :param part_size_kb: The part size when downloading the file.
+                             None = Adapt it to the measured throughput
+        :param file_size: The size of the file, if known. Then nothing past
+                          its end is requested, and the last part needs
+                          no extra request to find out that the file is over
+        :param prefetch: How many more parts should be requested ahead while the
+                         previous parts are being consumed (0 = no read-ahead).
+                         None = Adapt it to the measured throughput
+        """
+        adaptive = self.part_size_controller
+        if part_size_kb:
+            part_size = int(part_size_kb * 1024)
+            if part_size % 1024 != 0:
+                raise ValueError(
+                    'The part size must be evenly divisible by 1024')
+
+        # Requests which were sent (and when) but have not been received yet
+        pending = deque()
+        offset = 0
+        sender = self.sender
+        try:
             while True:
-                # The current offset equals the offset_index multiplied by the part size
-                offset = offset_index * part_size
-                result = self.invoke(
-                    GetFileRequest(input_location, offset, part_size))
-                offset_index += 1
+                window = prefetch + 1 if prefetch is not None else adaptive.window
+                while len(pending) < window:
+                    # At least one part is requested, even if it's empty
+                    if pending and file_size is not None and offset >= file_size:
+                        break
+
+                    if not part_size_kb:
+                        # Parts can't cross a 1MB boundary, so only grow
+                        # the part size when the offset is a multiple of it
+                        part_size = adaptive.part_size_kb * 1024
+                        while offset % part_size != 0:
+                            part_size //= 2
+
+                    request = GetFileRequest(input_location, offset, part_size)
+                    sender.send(request)
+                    pending.append((request, monotonic()))
+                    offset += part_size
+
+                request, send_time = pending.popleft()
+                try:
+                    self.receive_part(request, send_time,
+                                      None if part_size_kb else adaptive, sender)
+                except FileMigrateError as error:
+                    # The file is stored in another DC, so request it from there
+                    self.drain(sender, pending)
+                    sender = self.get_dc_sender(error.new_dc)
+                    offset = request.offset
+                    continue
+
+                part = request.result.bytes
 
                 # If we have received no data (0 bytes), the file is over
-                # So there is nothing left to download and write
-                if not result.bytes:
-                    return result.type  # Return some extra information
+                if part:
+                    yield part
+
+                # Less data than requested means that this was the last part
+                if len(part) < request.limit or (
+                        file_size is not None and
+                        request.offset + len(part) >= file_size):
+                    return request.result.type
+        finally:
+            # Don't leave any read-ahead request behind unanswered
+            self.drain(sender, pending)
 
-                file.write(result.bytes)
-                if progress_callback:
-                    progress_callback(file.tell(), file_size)
+    @staticmethod
+    def drain(sender, pending):
+        """Receives and discards the (request, send time) pending in the given sender,
+           so that no request is left behind unanswered"""
+        while pending:
+            request, _ = pending.popleft()
+            try:
+                sender.receive(request)
+            except (RPCError, TimeoutError, ConnectionError):
+                pass  # Nobody is waiting for it anymore
+
+    def check_flood_wait(self, request):
+        """Checks whether the given request can be sent, or if it would fail because
+           of a previous FLOOD_WAIT. If so, waits until it's over if it's shorter than
+           the flood_sleep_threshold, or raises the FLOOD_WAIT error right away"""
+        delay = self.flood_waits.get_delay(request)
+        if delay > self.flood_sleep_threshold:
+            raise RPCError(420, 'FLOOD_WAIT_{}'.format(ceil(delay)))
+        if delay:
+            sleep(delay)
+
+    def receive_flood_waiting(self,
+                              request,
+                              timeout=timedelta(seconds=5),
+                              sender=None):
+        """Receives a previously sent request (through the given sender, or the
+           main one if None). If it failed because too many requests were made
+           (FLOOD_WAIT), waits as long as required (if it's shorter than the
+           flood_sleep_threshold, or raises otherwise) and then sends it again"""
+        sender = sender or self.sender
+        while True:
+            try:
+                sender.receive(request, timeout)
+                return
+            except FloodWaitError as error:
+                # Only this thread waits, the connection is free for other requests
+                self.flood_waits.record(request, error.seconds)
+                if error.seconds > self.flood_sleep_threshold:
+                    raise
+
+                sleep(error.seconds)
+                sender.send(request)
+
+    def receive_part(self, request, send_time, adaptive, sender=None, retries=3):
+        """Receives a previously sent request to upload or download a file part
+           (through the given sender, or the main one if None), letting the
+           adaptive part size (if any) know how the transfer went.
+
+           If the part times out, it's sent again (up to retries times in a row).
+           If it fails because of a FLOOD_WAIT, it's sent again after waiting,
+           unless it's longer than the flood_sleep_threshold (then it's raised)"""
+        sender = sender or self.sender
+        timeouts = 0
+        while True:
+            try:
+                sender.receive(request)
+                break
+            except TimeoutError:
+                if adaptive:
+                    adaptive.on_timeout()
+                timeouts += 1
+                if timeouts > retries:
+                    raise
+            except FloodWaitError as error:
+                self.flood_waits.record(request, error.seconds)
+                if adaptive:
+                    adaptive.on_flood_wait()
+                if error.seconds > self.flood_sleep_threshold:
+                    raise
+                sleep(error.seconds)
+
+            # Fewer parts will be sent at once from now on, but this one
+            # was already sent with its size, so it's sent just as it was
+            sender.send(request)
+            send_time = monotonic()
+
+        if not adaptive:
+            return
+
+        if isinstance(request, GetFileRequest):
+            size = len(request.result.bytes)
+        else:
+            size = len(request.bytes)
+        adaptive.on_part(size, monotonic() - send_time)
 
     # endregion
 
@@ -686,16 +1452,144 @@ class TelegramClient:
 
     # region Updates handling
 
-    def add_update_handler(self, handler):
+    def add_update_handler(self, handler, types=None):
         """Adds an update handler (a function which takes a TLObject,
-          an update, as its parameter) and listens for updates"""
+          an update, as its parameter) and listens for updates.
+          If types is given (a type or a tuple of types, or their constructor IDs),
+          the handler is only called for the updates of those types, even if they
+          come within a container, and any other update is not even decoded"""
         if not self.signed_in:
             raise ValueError(
                 "You cannot add update handlers until you've signed in.")
 
-        self.sender.add_update_handler(handler)
+        self.sender.add_update_handler(handler, types)
+
+        # Fetch whatever was missed since the last time (or the initial state)
+        if self.updates.state:
+            self.on_gap(None)
 
     def remove_update_handler(self, handler):
         self.sender.remove_update_handler(handler)
 
+    def get_update_metrics(self):
+        """Gets the queue depth and handler latency of the updates as a dictionary"""
+        return self.updates.get_metrics()
+
+    def on_reconnect(self):
+        """Called when the connection was replaced, to fetch the updates
+           which may have been missed while there was no connection"""
+        if self.updates.state and self.updates.handlers:
+            self.on_gap(None)
+
+    def on_gap(self, channel_id):
+        """Called when a gap is found in the updates of the given channel (or the
+           account's if None). The missed updates are fetched from another thread,
+           since those receiving the updates can't wait for any request"""
+        with self.gaps_lock:
+            self.pending_gaps.add(channel_id)
+            if not self.catch_up_thread:
+                self.catch_up_thread = Thread(
+                    target=self.catch_up_thread_method,
+                    name='Updates catch up thread', daemon=True)
+                self.catch_up_thread.start()
+
+        self.gaps_event.set()
+
+    def catch_up_thread_method(self):
+        """Fetches the missed updates of the gaps found, until disconnected"""
+        thread = self.catch_up_thread
+        while self.catch_up_thread is thread:
+            self.gaps_event.wait()
+            self.gaps_event.clear()
+            with self.gaps_lock:
+                gaps, self.pending_gaps = self.pending_gaps, set()
+
+            for channel_id in gaps:
+                if self.catch_up_thread is not thread:
+                    return
+                try:
+                    self.catch_up(channel_id)
+                except (RPCError, TimeoutError) as error:
+                    print('Could not fetch the missed updates: {}'.format(error))
+
+    def catch_up(self, channel_id=None):
+        """Fetches and handles the updates missed by the account (or the given
+           channel) since the saved state, which is then updated and saved.
+           If the state of the account is unknown, the current one is fetched"""
+        state = self.session.update_state
+        if channel_id is not None:
+            self.catch_up_channel(channel_id)
+
+        elif state.pts is None or state.qts is None or state.date is None:
+            state.set_state(self.invoke(GetStateRequest()))
+
+        else:
+            while True:
+                result = self.invoke(
+                    GetDifferenceRequest(state.pts, state.date, state.qts))
+
+                if isinstance(result, DifferenceEmpty):
+                    state.set(date=result.date, seq=result.seq)
+                    break
+
+                if isinstance(result, DifferenceTooLong):
+                    state.set(pts=result.pts)
+                    continue
+
+                if isinstance(result, Difference):
+                    new_state = result.state
+                else:
+                    new_state = result.intermediate_state
+
+                for message in result.new_messages:
+                    self.updates.dispatch(
+                        UpdateNewMessage(message, new_state.pts, 0),
+                        check_state=False)
+                for message in result.new_encrypted_messages:
+                    self.updates.dispatch(
+                        UpdateNewEncryptedMessage(message, new_state.qts),
+                        check_state=False)
+                for update in result.other_updates:
+                    self.updates.dispatch(update, check_state=False)
+
+                state.set_state(new_state)
+                if not isinstance(result, DifferenceSlice):
+                    break
+
+        self.session.save_update_state()
+
+    def catch_up_channel(self, channel_id):
+        """Fetches and handles the updates missed on the given channel. Nothing can
+           be fetched unless both its pts and its access hash are known"""
+        state = self.session.update_state
+        input_peer = self.session.entities.input_peers.get(
+            -(10**12 + channel_id))
+        if state.channel_pts.get(channel_id) is None or \
+                not isinstance(input_peer, InputPeerChannel):
+            return
+
+        channel = InputChannel(channel_id, input_peer.access_hash)
+        while True:
+            result = self.invoke(GetChannelDifferenceRequest(
+                channel, ChannelMessagesFilterEmpty(),
+                state.channel_pts[channel_id], 100))
+
+            if isinstance(result, ChannelDifferenceTooLong):
+                messages, updates = result.messages, []
+            elif isinstance(result, ChannelDifference):
+                messages, updates = result.new_messages, result.other_updates
+            else:
+                messages, updates = [], []
+
+            for message in messages:
+                self.updates.dispatch(
+                    UpdateNewChannelMessage(message, result.pts, 0),
+                    check_state=False)
+            for update in updates:
+                self.updates.dispatch(update, check_state=False)
+
+            state.set_channel_pts(channel_id, result.pts)
+            if result.final:
+                break
+
     # endregion
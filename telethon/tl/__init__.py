@@ -1,2 +1,3 @@
 from telethon.tl.mtproto_request import MTProtoRequest
 from telethon.tl.session import Session
+from telethon.tl.sqlite_session import SQLiteSession
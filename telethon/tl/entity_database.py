@@ -0,0 +1,161 @@
+from telethon.tl.types import (
+    Channel, ChannelForbidden, Chat, ChatForbidden, InputPeerChannel,
+    InputPeerChat, InputPeerUser, User)
+from telethon.utils.tl_utils import get_peer_id
+
+
+class EntityDatabase:
+    """Stores the input peers of the users, chats and channels which have been seen,
+       so that they can be used later on from only their ID, username or phone"""
+
+    def __init__(self):
+        self.input_peers = {}  # Marked ID (see get_peer_id): InputPeer
+        self.usernames = {}  # Lowercase username: marked ID
+        self.phones = {}  # Phone number (only digits): marked ID
+
+        # The reverse indices, to update the above when an entity changes
+        self.id_usernames = {}  # Marked ID: username
+        self.id_phones = {}  # Marked ID: phone number
+
+        # Marked IDs which changed since they were last saved
+        self.changed = set()
+
+    # region Adding entities
+
+    def process(self, tlobject):
+        """Adds the users and chats found in the given TLObject (for instance,
+           any result or update with "users" and "chats" vectors), if any.
+           Returns True if any new entity (or changes to one) was found"""
+        if isinstance(tlobject, list):
+            # Some results are vectors of users or chats themselves
+            found = False
+            for item in tlobject:
+                found |= self.add(item)
+            return found
+
+        found = False
+        for attribute in ('users', 'chats'):
+            entities = getattr(tlobject, attribute, None)
+            if isinstance(entities, list):
+                for entity in entities:
+                    found |= self.add(entity)
+
+        # The user is also given when signing in
+        user = getattr(tlobject, 'user', None)
+        if isinstance(user, User):
+            found |= self.add(user)
+
+        return found
+
+    def add(self, entity):
+        """Adds the given user, chat or channel. Returns True if it was
+           either new or changed, or False if it could not be used to
+           retrieve its input peer (for instance, "min" users)"""
+        input_peer = None
+        username = phone = None
+
+        if isinstance(entity, User):
+            if entity.access_hash is not None and not entity.min:
+                input_peer = InputPeerUser(entity.id, entity.access_hash)
+                username, phone = entity.username, entity.phone
+
+        elif isinstance(entity, (Chat, ChatForbidden)):
+            input_peer = InputPeerChat(entity.id)
+
+        elif isinstance(entity, Channel):
+            if entity.access_hash is not None and not entity.min:
+                input_peer = InputPeerChannel(entity.id, entity.access_hash)
+                username = entity.username
+
+        elif isinstance(entity, ChannelForbidden):
+            input_peer = InputPeerChannel(entity.id, entity.access_hash)
+
+        if input_peer is None:
+            return False
+
+        marked_id = get_peer_id(input_peer)
+        old = self.input_peers.get(marked_id)
+        if (old is not None and
+                getattr(old, 'access_hash', None) == getattr(
+                    input_peer, 'access_hash', None) and
+                self.id_usernames.get(marked_id) == username and
+                self.id_phones.get(marked_id) == phone):
+            return False
+
+        self.set_input_peer(marked_id, input_peer, username, phone)
+        self.changed.add(marked_id)
+        return True
+
+    def add_row(self, marked_id, access_hash, username, phone):
+        """Adds an entity which was previously stored by its fields (marked ID,
+           access hash, username and phone), for instance, in a database"""
+        if marked_id > 0:
+            input_peer = InputPeerUser(marked_id, access_hash)
+        elif marked_id > -10**12:
+            input_peer = InputPeerChat(-marked_id)
+        else:
+            input_peer = InputPeerChannel(-marked_id - 10**12, access_hash)
+
+        self.set_input_peer(marked_id, input_peer, username, phone)
+
+    def set_input_peer(self, marked_id, input_peer, username, phone):
+        """Sets the input peer for the given marked ID, updating the indices"""
+        self.remove_indices(marked_id)
+        self.input_peers[marked_id] = input_peer
+        if username:
+            self.usernames[username.lower()] = marked_id
+            self.id_usernames[marked_id] = username
+        if phone:
+            self.phones[phone] = marked_id
+            self.id_phones[marked_id] = phone
+
+    def remove_indices(self, marked_id):
+        """Removes the username and phone of the given marked ID from the indices"""
+        username = self.id_usernames.pop(marked_id, None)
+        if username and self.usernames.get(username.lower()) == marked_id:
+            del self.usernames[username.lower()]
+
+        phone = self.id_phones.pop(marked_id, None)
+        if phone and self.phones.get(phone) == marked_id:
+            del self.phones[phone]
+
+    # endregion
+
+    # region Retrieving entities
+
+    def get_input_peer(self, key):
+        """Gets the input peer for the given ID (either marked or not, in which case
+           users have preference over chats, and these over channels),
+           username (with or without the leading '@') or phone number.
+           Returns None if it was not found"""
+        if isinstance(key, int):
+            if key in self.input_peers or key < 0:
+                return self.input_peers.get(key)
+
+            for marked_id in (-key, -(10**12 + key)):
+                if marked_id in self.input_peers:
+                    return self.input_peers[marked_id]
+            return None
+
+        if isinstance(key, str):
+            key = key.strip()
+            if key.startswith('@'):
+                marked_id = self.usernames.get(key[1:].lower())
+            else:
+                marked_id = self.phones.get(''.join(c for c in key
+                                                    if c.isdigit()))
+                if marked_id is None:
+                    marked_id = self.usernames.get(key.lower())
+
+            return self.input_peers.get(marked_id)
+
+    def __contains__(self, key):
+        return self.get_input_peer(key) is not None
+
+    # endregion
+
+    def __getstate__(self):
+        # Which entities changed only matters until they're saved
+        state = self.__dict__.copy()
+        state['changed'] = set()
+        return state
@@ -11,6 +11,7 @@ class MTProtoRequest:
         self.dirty = False
         self.send_time = None
         self.confirm_received = False
+        self.rpc_error = None  # Set if an error was received for this request
 
         # These should be overrode
         self.constructor_id = 0
@@ -3,12 +3,25 @@ import pickle
 import random
 import time
 from os.path import isfile as file_exists
+from threading import RLock, Timer
 
 import telethon.helpers as utils
+from telethon.tl.entity_database import EntityDatabase
+from telethon.tl.update_state import UpdateState
 
 
 class Session:
+    # Changes to these fields are saved right away, since losing them would mean
+    # having to connect or authorize again. Other changes are saved after a while
+    SignificantFields = {'auth_key', 'server_address', 'port', 'salt', 'user',
+                         'dc_id', 'dc_auth_keys'}
+
+    # These fields are used to save the session, and they're not saved themselves
+    UnsavedFields = {'dirty_fields', 'flush_delay', 'flush_timer', 'flush_lock'}
+
     def __init__(self, session_user_id):
+        self.init_saving()
+
         self.session_user_id = session_user_id
         self.server_address = '91.108.56.165'
         self.port = 443
@@ -19,21 +32,141 @@ class Session:
         self.time_offset = 0
         self.last_message_id = 0  # Long
         self.user = None
+        self.entities = EntityDatabase()
+
+        # The DC this session is connected to, and the auth keys
+        # for every DC used so far (to reuse them instead of creating new ones)
+        self.dc_id = None
+        self.dc_auth_keys = {}  # DC ID: AuthKey
+
+        # The state of the updates, to know which ones were missed
+        self.update_state = UpdateState()
+
+    def init_saving(self, flush_delay=5):
+        """Initializes the fields used to save the session, which are not saved"""
+        self.__dict__['dirty_fields'] = set()  # Which fields changed since saved
+        self.__dict__['flush_delay'] = flush_delay  # Seconds
+        self.__dict__['flush_timer'] = None
+        self.__dict__['flush_lock'] = RLock()
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name not in Session.UnsavedFields:
+            self.dirty_fields.add(name)
+
+    # region Saving
 
     def save(self):
-        """Saves the current session object as session_user_id.session"""
+        """Saves the current session object as session_user_id.session.
+           Significant changes are written right away, and any other change
+           is written after flush_delay seconds (or when flush() is called)"""
+        with self.flush_lock:
+            if not self.dirty_fields:
+                return
+
+            if self.dirty_fields & Session.SignificantFields:
+                self.flush()
+
+            elif self.flush_timer is None:
+                self.flush_timer = Timer(self.flush_delay, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        """Writes any pending change right away, for instance before exiting"""
+        with self.flush_lock:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            if self.dirty_fields:
+                # Cleared first so that changes made while writing are noticed,
+                # but restored if writing failed, so that they're not lost
+                dirty_fields = set(self.dirty_fields)
+                self.dirty_fields.clear()
+                try:
+                    self.write()
+                except:
+                    self.dirty_fields.update(dirty_fields)
+                    raise
+
+    def write(self):
+        """Writes the whole session object to session_user_id.session.
+           The file is replaced atomically, so it's never left half-written"""
         if self.session_user_id:
-            with open('{}.session'.format(self.session_user_id), 'wb') as file:
-                pickle.dump(self, file)
+            path = '{}.session'.format(self.session_user_id)
+            try:
+                with open(path + '.tmp', 'wb') as file:
+                    pickle.dump(self, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+                os.replace(path + '.tmp', path)
+            except:
+                if file_exists(path + '.tmp'):
+                    os.remove(path + '.tmp')
+                raise
+
+            # The whole entities were written, not only those which changed.
+            # Sessions which are not saved may share them with one that is
+            self.entities.changed.clear()
 
     def delete(self):
         """Deletes the current session file"""
+        with self.flush_lock:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.dirty_fields.clear()
+
         try:
             os.remove('{}.session'.format(self.session_user_id))
             return True
         except:
             return False
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in Session.UnsavedFields:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('entities', EntityDatabase())
+        self.__dict__.setdefault('dc_id', None)
+        self.__dict__.setdefault('dc_auth_keys', {})
+        self.__dict__.setdefault('update_state', UpdateState())
+        self.init_saving()
+
+    # endregion
+
+    def set_dc_auth_key(self, dc_id, auth_key):
+        """Sets the auth key to be used when connecting to the given DC"""
+        if self.dc_auth_keys.get(dc_id) is not auth_key:
+            # Replaced (not modified) so that the change is noticed
+            self.dc_auth_keys = dict(self.dc_auth_keys)
+            self.dc_auth_keys[dc_id] = auth_key
+            self.save()
+
+    def process_entities(self, tlobject):
+        """Adds the users and chats found in the given TLObject
+           to the entities, and saves them if any new one was found"""
+        # Locked so that they don't change while the session is being written
+        with self.flush_lock:
+            if not self.entities.process(tlobject):
+                return
+            self.dirty_fields.add('entities')
+        self.save()
+
+    def save_update_state(self):
+        """Saves the update state if it changed since it was last saved"""
+        if self.update_state.changed:
+            self.update_state.changed = False
+            with self.flush_lock:
+                self.dirty_fields.add('update_state')
+            self.save()
+
     @staticmethod
     def try_load_or_create_new(session_user_id):
         """Loads a saved session_user_id session, or creates a new one if none existed before.
@@ -45,10 +178,19 @@ class Session:
 
             if file_exists(path):
                 with open(path, 'rb') as file:
-                    return pickle.load(file)
+                    session = pickle.load(file)
+                    session.start_new_session()
+                    return session
             else:
                 return Session(session_user_id)
 
+    def start_new_session(self):
+        """Starts a new MTProto session (not to be confused with the authorization,
+           which is kept). Since the session is not saved after every message,
+           the saved sequence may be outdated, so it must not be reused"""
+        self.id = utils.generate_random_long(signed=False)
+        self.sequence = 0
+
     def get_new_msg_id(self):
         """Generates a new message ID based on the current time (in ms) since epoch"""
         # Refer to mtproto_plain_sender.py for the original method, this is a simple copy
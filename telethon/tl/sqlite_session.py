@@ -0,0 +1,196 @@
+import os
+import pickle
+import sqlite3
+from os.path import isfile as file_exists
+from threading import Lock
+
+from telethon.tl.session import Session
+
+
+def load_auth_key(data):
+    """Loads the AuthKey from its stored data"""
+    # Imported here since telethon.crypto needs telethon.tl to be imported first
+    from telethon.crypto import AuthKey
+    return AuthKey(data) if data else None
+
+
+class SQLiteSession(Session):
+    """Session which is saved as session_user_id.session in a SQLite database.
+       Every field is stored in its own row, so saving the session only
+       writes those fields which changed since the last time it was saved"""
+
+    # The fields to be saved, and how they're stored in and loaded from the database
+    Fields = {
+        'server_address': (lambda value: value, lambda value: value),
+        'port': (lambda value: value, lambda value: value),
+        'auth_key': (lambda key: key.key if key else None, load_auth_key),
+        'id': (lambda value: str(value), lambda value: int(value)),
+        'sequence': (lambda value: value, lambda value: value),
+        'salt': (lambda value: str(value), lambda value: int(value)),
+        'time_offset': (lambda value: value, lambda value: value),
+        'last_message_id': (lambda value: str(value), lambda value: int(value)),
+        'user': (lambda user: pickle.dumps(user) if user else None,
+                 lambda data: pickle.loads(data) if data else None),
+        'dc_id': (lambda value: value, lambda value: value),
+        'dc_auth_keys': (
+            lambda keys: pickle.dumps({dc: key.key for dc, key in keys.items()}),
+            lambda data: {dc: load_auth_key(key)
+                          for dc, key in pickle.loads(data).items()}),
+        'update_state': (pickle.dumps, pickle.loads)
+    }
+
+    # The fields which are modified in place, and must be compared by their dumped value
+    DumpedFields = {'update_state'}
+
+    def __init__(self, session_user_id):
+        super().__init__(session_user_id)
+
+        # The values which were last saved, to determine which ones changed
+        self.saved_values = {}
+
+        # The updates thread may also save the session
+        self.db_lock = Lock()
+        self.db = None
+        if session_user_id:
+            self.db = sqlite3.connect(
+                '{}.session'.format(session_user_id), check_same_thread=False)
+
+            # Write-ahead logging doesn't rewrite the database on every commit
+            self.db.execute('pragma journal_mode=wal')
+            self.db.execute('create table if not exists session '
+                            '(name text primary key, value)')
+            self.db.execute('create table if not exists entities '
+                            '(id integer primary key, hash integer, '
+                            'username text, phone text)')
+            self.db.commit()
+
+    def write(self):
+        """Writes those fields of the current session which changed since the last write"""
+        if not self.db:
+            return
+
+        # Nothing is marked as saved until it's been committed
+        changed, saved_values = [], {}
+        for name, (dump, _) in SQLiteSession.Fields.items():
+            value = getattr(self, name)
+
+            # Compare the objects themselves instead of dumping them every time
+            if name in ('auth_key', 'user', 'dc_auth_keys'):
+                if self.saved_values.get(name, None) is not value:
+                    changed.append((name, dump(value)))
+                    saved_values[name] = value
+
+            elif name in SQLiteSession.DumpedFields:
+                value = dump(value)
+                if self.saved_values.get(name, None) != value:
+                    changed.append((name, value))
+                    saved_values[name] = value
+
+            elif self.saved_values.get(name, None) != value:
+                changed.append((name, dump(value)))
+                saved_values[name] = value
+
+        # Only the entities which are new or changed need to be written
+        entities = self.entities
+        changed_ids = list(entities.changed)
+        changed_entities = [
+            (marked_id,
+             getattr(entities.input_peers[marked_id], 'access_hash', None),
+             entities.id_usernames.get(marked_id),
+             entities.id_phones.get(marked_id))
+            for marked_id in changed_ids]
+
+        if changed or changed_entities:
+            with self.db_lock:
+                try:
+                    self.db.executemany(
+                        'insert or replace into session (name, value) values (?, ?)',
+                        changed)
+                    self.db.executemany(
+                        'insert or replace into entities (id, hash, username, phone) '
+                        'values (?, ?, ?, ?)', changed_entities)
+                    self.db.commit()
+                except:
+                    self.db.rollback()
+                    raise
+
+            self.saved_values.update(saved_values)
+            entities.changed.difference_update(changed_ids)
+
+    def delete(self):
+        """Deletes the current session database"""
+        if self.db:
+            self.db.close()
+            self.db = None
+
+        if not super().delete():
+            return False
+
+        try:
+            for suffix in ('-wal', '-shm'):
+                path = '{}.session{}'.format(self.session_user_id, suffix)
+                if file_exists(path):
+                    os.remove(path)
+            return True
+        except:
+            return False
+
+    @staticmethod
+    def try_load_or_create_new(session_user_id):
+        """Loads a saved session_user_id session, or creates a new one if none existed before.
+           If a pickled Session was saved with the same session_user_id, it is converted.
+           If the given session_user_id is None, we assume that it is for testing purposes"""
+        if session_user_id is None:
+            return SQLiteSession(None)
+
+        path = '{}.session'.format(session_user_id)
+        backup_path = path + '.old'
+        old_session = None
+        if file_exists(backup_path):
+            # A previous conversion didn't finish, so its database is incomplete
+            with open(backup_path, 'rb') as file:
+                old_session = pickle.load(file)
+
+            for suffix in ('', '-wal', '-shm'):
+                if file_exists(path + suffix):
+                    os.remove(path + suffix)
+
+        elif file_exists(path):
+            with open(path, 'rb') as file:
+                if file.read(16) != b'SQLite format 3\x00':
+                    file.seek(0)
+                    old_session = pickle.load(file)
+
+            # The pickled session is kept until it's been converted,
+            # so that it's not lost if the conversion doesn't finish
+            if old_session:
+                os.replace(path, backup_path)
+
+        session = SQLiteSession(session_user_id)
+        if old_session:
+            for name in SQLiteSession.Fields:
+                setattr(session, name, getattr(old_session, name))
+
+            session.entities = old_session.entities
+            session.entities.changed.update(session.entities.input_peers)
+        else:
+            for name, value in session.db.execute(
+                    'select name, value from session'):
+                if name in SQLiteSession.Fields:
+                    load = SQLiteSession.Fields[name][1]
+                    setattr(session, name, load(value))
+                    session.saved_values[name] = (
+                        value if name in SQLiteSession.DumpedFields
+                        else getattr(session, name))
+
+            for row in session.db.execute(
+                    'select id, hash, username, phone from entities'):
+                session.entities.add_row(*row)
+
+        session.start_new_session()
+        if old_session:
+            session.flush()
+            os.remove(backup_path)
+
+        return session
+
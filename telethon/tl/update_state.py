@@ -0,0 +1,128 @@
+from telethon.tl.types import (
+    UpdateChannelTooLong, UpdateDeleteChannelMessages, UpdateEditChannelMessage,
+    UpdateNewChannelMessage, UpdateNewEncryptedMessage, UpdatesCombined,
+    UpdatesTg, UpdatesTooLong)
+
+
+class UpdateState:
+    """Keeps track of the state of the updates (pts, qts, date and seq) for the
+       account and the pts of every channel, to tell whether an update comes
+       right after the previous one, was already received, or there is a gap
+       because some updates were missed (and must be fetched as a difference)"""
+
+    # The results of checking an update
+    Apply = 'apply'
+    Duplicate = 'duplicate'
+    Gap = 'gap'
+
+    def __init__(self):
+        self.pts = None
+        self.qts = None
+        self.date = None
+        self.seq = None
+        self.channel_pts = {}  # Channel ID: pts
+
+        # Whether the state changed since it was last saved
+        self.changed = False
+
+    # region Checking updates
+
+    def check(self, update, channel_id=None):
+        """Checks the given update (either a container or an update within one)
+           against the current state, which is updated if the update should be applied.
+           The pts is that of the given channel, if any, or else that of the channel
+           the update belongs to (see get_channel_id), or else the account's.
+           Returns UpdateState.Apply, UpdateState.Duplicate or UpdateState.Gap"""
+        if isinstance(update, UpdatesTooLong):
+            return UpdateState.Gap
+
+        if isinstance(update, UpdateChannelTooLong):
+            return UpdateState.Gap
+
+        if isinstance(update, (UpdatesTg, UpdatesCombined)):
+            if not update.seq:
+                return UpdateState.Apply  # The order doesn't matter
+
+            seq_start = getattr(update, 'seq_start', update.seq)
+            result = self.check_sequence(self.seq, seq_start, 1)
+            if result == UpdateState.Apply:
+                self.set(seq=update.seq, date=update.date)
+            return result
+
+        if isinstance(update, UpdateNewEncryptedMessage):
+            result = self.check_sequence(self.qts, update.qts, 1)
+            if result == UpdateState.Apply:
+                self.set(qts=update.qts)
+            return result
+
+        pts = getattr(update, 'pts', None)
+        pts_count = getattr(update, 'pts_count', None)
+        if pts is None or pts_count is None:
+            return UpdateState.Apply  # Updates without state are always applied
+
+        if channel_id is None:
+            channel_id = UpdateState.get_channel_id(update)
+        if channel_id is None:
+            result = self.check_sequence(self.pts, pts, pts_count)
+            if result == UpdateState.Apply:
+                self.set(pts=pts)
+        else:
+            result = self.check_sequence(
+                self.channel_pts.get(channel_id), pts, pts_count)
+            if result == UpdateState.Apply:
+                self.set_channel_pts(channel_id, pts)
+
+        return result
+
+    @staticmethod
+    def check_sequence(local, remote, count):
+        """Checks whether the remote value (which advanced the local value in count)
+           should be applied, was already applied, or there is a gap before it"""
+        if local is None or local + count == remote:
+            return UpdateState.Apply
+        if local + count > remote:
+            return UpdateState.Duplicate
+        return UpdateState.Gap
+
+    @staticmethod
+    def get_channel_id(update):
+        """Gets the ID of the channel the given update belongs to, if its pts
+           is that of a channel instead of the account's. None otherwise"""
+        if isinstance(update, (UpdateNewChannelMessage, UpdateEditChannelMessage)):
+            return getattr(update.message.to_id, 'channel_id', None)
+        if isinstance(update, UpdateDeleteChannelMessages):
+            return update.channel_id
+        return getattr(update, 'channel_id', None)
+
+    # endregion
+
+    # region Setting the state
+
+    def set(self, pts=None, qts=None, date=None, seq=None):
+        """Sets the given values of the account's state (those which are not None)"""
+        if pts is not None:
+            self.pts = pts
+        if qts is not None:
+            self.qts = qts
+        if date is not None:
+            self.date = date
+        if seq is not None:
+            self.seq = seq
+        self.changed = True
+
+    def set_state(self, state):
+        """Sets the account's state from an updates.State"""
+        self.set(pts=state.pts, qts=state.qts, date=state.date, seq=state.seq)
+
+    def set_channel_pts(self, channel_id, pts):
+        """Sets the pts of the given channel"""
+        self.channel_pts[channel_id] = pts
+        self.changed = True
+
+    # endregion
+
+    def __getstate__(self):
+        # Whether it changed only matters until it's saved
+        state = self.__dict__.copy()
+        state['changed'] = False
+        return state
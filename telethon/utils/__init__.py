@@ -1,3 +1,7 @@
 from .binary_writer import BinaryWriter
 from .binary_reader import BinaryReader
 from .tl_utils import *
+from .upload_cache import UploadCache
+from .adaptive_part_size import AdaptivePartSize
+from .rate_limiter import RateLimiter
+from .flood_wait_registry import FloodWaitRegistry
@@ -0,0 +1,137 @@
+import time
+
+
+class AdaptivePartSize:
+    """Chooses the part size and the amount of parts in flight (window) when
+       uploading or downloading files, based on the measured throughput.
+
+       The part size is grown first (since bigger parts waste less of each
+       round trip), and then the window. Both are kept as long as the throughput
+       does not get worse, and are halved when a FLOOD_WAIT or a timeout occurs"""
+
+    # Part sizes must be powers of two so that they evenly divide 512KB (uploads)
+    # and 1MB (downloads, which also can't request parts crossing a 1MB boundary)
+    MIN_PART_SIZE_KB = 32
+    MAX_PART_SIZE_KB = 512
+
+    def __init__(self,
+                 part_size_kb=64,
+                 window=1,
+                 max_window=8,
+                 grow_after=4,
+                 smoothing=0.3):
+        """
+        :param part_size_kb: The initial part size
+        :param window: The initial amount of parts to keep in flight
+        :param max_window: The maximum amount of parts to keep in flight
+        :param grow_after: How many parts must succeed before growing again
+        :param smoothing: The weight of new samples for the averaged measures
+        """
+        self.part_size_kb = part_size_kb
+        self.window = window
+        self.max_window = max_window
+        self.grow_after = grow_after
+        self.smoothing = smoothing
+
+        # Averaged measures and their value before growing the last time
+        self.rtt = None  # Seconds
+        self.throughput = None  # Bytes per second
+        self.previous_throughput = None
+
+        self.successes = 0
+        self.stalled = False  # Growing stopped improving the throughput
+        self.parts = 0
+        self.flood_waits = 0
+        self.timeouts = 0
+
+        # When the last part was received, used to measure the throughput
+        self.last_received = None
+
+    # region Measuring
+
+    def on_part(self, size, rtt):
+        """Records that a part of the given size (in bytes) was
+           transferred, and that it took rtt seconds since it was requested"""
+        now = time.monotonic()
+        if self.last_received is None or self.window == 1:
+            elapsed = rtt
+        else:
+            # With several parts in flight, they arrive every so often
+            elapsed = now - self.last_received
+        self.last_received = now
+
+        self.rtt = self.average(self.rtt, rtt)
+        if elapsed > 0:
+            self.throughput = self.average(self.throughput, size / elapsed)
+
+        self.parts += 1
+        self.successes += 1
+        if self.successes >= self.grow_after:
+            self.successes = 0
+            self.adapt()
+
+    def on_flood_wait(self):
+        """Records that a FLOOD_WAIT error occurred, shrinking the parameters"""
+        self.flood_waits += 1
+        self.shrink()
+
+    def on_timeout(self):
+        """Records that a part timed out, shrinking the parameters"""
+        self.timeouts += 1
+        self.shrink()
+
+    # endregion
+
+    # region Adapting
+
+    def adapt(self):
+        """Grows the parameters if the last growth paid off, or reverts it otherwise"""
+        if (self.previous_throughput is not None and
+                self.throughput < self.previous_throughput):
+            self.stalled = True
+            self.shrink(halve_window=False)
+            return
+
+        if not self.stalled:
+            self.previous_throughput = self.throughput
+            if self.part_size_kb < AdaptivePartSize.MAX_PART_SIZE_KB:
+                self.part_size_kb *= 2
+            elif self.window < self.max_window:
+                self.window += 1
+            else:
+                self.stalled = True
+
+    def shrink(self, halve_window=True):
+        """Reverts the last growth, or halves the parameters on errors"""
+        if self.window > 1:
+            self.window = max(1, self.window // 2 if halve_window else
+                              self.window - 1)
+        elif self.part_size_kb > AdaptivePartSize.MIN_PART_SIZE_KB:
+            self.part_size_kb //= 2
+
+        self.successes = 0
+        self.previous_throughput = None
+        self.last_received = None
+        if halve_window:
+            # Conditions changed, so growing may pay off again later
+            self.stalled = False
+
+    def average(self, current, sample):
+        """Exponentially weighted moving average of the current value and a new sample"""
+        if current is None:
+            return sample
+        return current + self.smoothing * (sample - current)
+
+    # endregion
+
+    def get_metrics(self):
+        """Gets the currently chosen parameters and measures as a dictionary"""
+        return {
+            'part_size_kb': self.part_size_kb,
+            'window': self.window,
+            'rtt': self.rtt,
+            'throughput': self.throughput,
+            'parts': self.parts,
+            'flood_waits': self.flood_waits,
+            'timeouts': self.timeouts
+        }
@@ -128,6 +128,20 @@ class BinaryWriter:
             self.writer.flush()
         return self.stream.getvalue()
 
+    def get_buffer(self, flush=True):
+        """Get a view over the current buffer content without copying it, optionally
+           flushing first. The view must be released before writing or closing again"""
+        if flush:
+            self.writer.flush()
+        return self.stream.getbuffer()
+
+    def truncate(self, size):
+        """Discards everything written after the first size bytes, so that
+           the writer can continue writing from there"""
+        self.writer.seek(size)
+        self.writer.truncate()
+        self.written_count = size
+
     def get_written_bytes_count(self):
         """Gets the count of bytes written in the buffer.
            This may NOT be equal to the stream length if one was provided when initializing the writer"""
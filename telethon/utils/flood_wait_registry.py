@@ -0,0 +1,55 @@
+import time
+from threading import Lock
+
+from .tl_utils import get_peer_id
+
+
+class FloodWaitRegistry:
+    """Remembers until when every kind of request can't be sent after a FLOOD_WAIT,
+       by the request class and, for requests with a peer, the peer they were sent to.
+       This way, a request which would surely fail can fail fast without sending it,
+       while any other request can still be sent"""
+
+    def __init__(self):
+        # (request class, marked peer ID or None): monotonic time until it's blocked
+        self.blocked_until = {}
+
+        # Only held to look up or update the dictionary, never while waiting
+        self.lock = Lock()
+
+    @staticmethod
+    def get_keys(request):
+        """Gets the keys under which the given request may be blocked:
+           its class alone, and its class and peer (if it has any)"""
+        peer = getattr(request, 'peer', None)
+        peer_id = get_peer_id(peer) if peer is not None else None
+        if peer_id is None:
+            return (type(request), None),
+        return (type(request), None), (type(request), peer_id)
+
+    def record(self, request, seconds):
+        """Records that a FLOOD_WAIT of the given seconds occurred for the given
+           request, blocking those of the same class (and peer, if it has any)"""
+        key = FloodWaitRegistry.get_keys(request)[-1]
+        blocked_until = time.monotonic() + seconds
+        with self.lock:
+            self.blocked_until[key] = max(self.blocked_until.get(key, 0),
+                                          blocked_until)
+
+    def get_delay(self, request):
+        """Gets how many seconds must be waited before the given request
+           can be sent without failing due to a previous FLOOD_WAIT (or 0)"""
+        now = time.monotonic()
+        delay = 0
+        with self.lock:
+            for key in FloodWaitRegistry.get_keys(request):
+                blocked_until = self.blocked_until.get(key)
+                if blocked_until is None:
+                    continue
+
+                if blocked_until <= now:
+                    del self.blocked_until[key]  # Expired
+                else:
+                    delay = max(delay, blocked_until - now)
+
+        return delay
@@ -0,0 +1,76 @@
+import time
+
+
+class RateLimiter:
+    """Keeps track of how many requests may be sent, globally and to every peer,
+       so that sending many of them in a row doesn't trigger FLOOD_WAIT errors.
+
+       The global budget is a token bucket refilled at `global_rate` requests per
+       second (up to `global_burst`), while every peer is only sent a request every
+       `peer_interval` seconds. A FLOOD_WAIT only blocks the scope it affected"""
+
+    def __init__(self, global_rate=30, global_burst=30, peer_interval=1):
+        """
+        :param global_rate: How many requests per second may be sent in total
+        :param global_burst: How many requests may be sent at once in total
+        :param peer_interval: How many seconds to wait between requests to the same peer
+        """
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.peer_interval = peer_interval
+
+        self.tokens = global_burst
+        self.last_refill = time.monotonic()
+
+        # When the next request may be sent, globally and to every peer
+        self.global_blocked_until = 0
+        self.peer_blocked_until = {}
+
+        self.flood_waits = 0
+
+    # region Budgets
+
+    def get_delay(self, peer=None):
+        """Gets how many seconds must be waited before sending a request to the given
+           peer (any hashable key, such as its marked ID), or to any peer if None"""
+        now = time.monotonic()
+        self.refill(now)
+
+        delay = max(0, self.global_blocked_until - now)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.global_rate)
+
+        if peer is not None:
+            delay = max(delay, self.peer_blocked_until.get(peer, 0) - now)
+
+        return delay
+
+    def on_send(self, peer=None):
+        """Records that a request was sent to the given peer, spending its budget"""
+        now = time.monotonic()
+        self.refill(now)
+
+        self.tokens -= 1
+        if peer is not None:
+            self.peer_blocked_until[peer] = max(
+                self.peer_blocked_until.get(peer, 0), now + self.peer_interval)
+
+    def on_flood_wait(self, seconds, peer=None):
+        """Records that a FLOOD_WAIT of the given seconds occurred, which blocks
+           sending requests to the given peer, or to any peer if None"""
+        self.flood_waits += 1
+        blocked_until = time.monotonic() + seconds
+        if peer is None:
+            self.global_blocked_until = max(self.global_blocked_until,
+                                            blocked_until)
+        else:
+            self.peer_blocked_until[peer] = max(
+                self.peer_blocked_until.get(peer, 0), blocked_until)
+
+    def refill(self, now):
+        """Refills the global budget with the tokens earned since the last refill"""
+        self.tokens = min(self.global_burst, self.tokens +
+                          (now - self.last_refill) * self.global_rate)
+        self.last_refill = now
+
+    # endregion
@@ -5,9 +5,10 @@
 from mimetypes import add_type, guess_extension
 
 from telethon.tl.types import (
-    Channel, Chat, ChatPhoto, InputPeerChannel, InputPeerChat, InputPeerUser,
-    MessageMediaDocument, MessageMediaPhoto, PeerChannel, PeerChat, PeerUser,
-    User, UserProfilePhoto)
+    Channel, ChannelForbidden, Chat, ChatEmpty, ChatForbidden, ChatPhoto,
+    Document, InputDocument, InputPeerChannel, InputPeerChat, InputPeerUser,
+    InputPhoto, MessageMediaDocument, MessageMediaPhoto, PeerChannel, PeerChat,
+    PeerUser, Photo, User, UserEmpty, UserProfilePhoto)
 
 
 def get_display_name(entity):
@@ -57,24 +58,59 @@ def get_input_peer(entity):
         return InputPeerChannel(entity.id, entity.access_hash)
 
 
-def find_user_or_chat(peer, users, chats):
-    """Finds the corresponding user or chat given a peer.
+def get_input_media(media):
+    """Gets the input photo or document for the given message media
+       (which can be used to send it again without uploading it).
        Returns None if it was not found"""
-    try:
-        if isinstance(peer, PeerUser):
-            user = next(u for u in users if u.id == peer.user_id)
-            return user
+    if isinstance(media, MessageMediaPhoto) and isinstance(media.photo, Photo):
+        return InputPhoto(media.photo.id, media.photo.access_hash)
+    if (isinstance(media, MessageMediaDocument) and
+            isinstance(media.document, Document)):
+        return InputDocument(media.document.id, media.document.access_hash)
 
-        elif isinstance(peer, PeerChat):
-            chat = next(c for c in chats if c.id == peer.chat_id)
-            return chat
 
-        elif isinstance(peer, PeerChannel):
-            channel = next(c for c in chats if c.id == peer.channel_id)
-            return channel
+def get_peer_id(peer):
+    """Gets the "marked" ID for the given peer, input peer or entity (user, chat or channel).
+       Users keep their ID, chats are negated and channels are negated after adding 10^12,
+       so that the IDs of different kinds of peers never collide.
+       Returns None if it was not found"""
+    if isinstance(peer, (PeerUser, InputPeerUser)):
+        return peer.user_id
+    if isinstance(peer, (User, UserEmpty)):
+        return peer.id
+
+    if isinstance(peer, (PeerChat, InputPeerChat)):
+        return -peer.chat_id
+    if isinstance(peer, (Chat, ChatEmpty, ChatForbidden)):
+        return -peer.id
+
+    if isinstance(peer, (PeerChannel, InputPeerChannel)):
+        return -(10**12 + peer.channel_id)
+    if isinstance(peer, (Channel, ChannelForbidden)):
+        return -(10**12 + peer.id)
+
+
+def get_entities_by_peer_id(users, chats):
+    """Builds a dictionary of the given users and chats (or channels) keyed by
+       their marked ID (see get_peer_id), to find them later on with any peer.
+       Should be built once per response, instead of once for every lookup"""
+    entities = {}
+    for user in users:
+        entities[user.id] = user
+    for chat in chats:
+        entities[get_peer_id(chat)] = chat
+    return entities
+
+
+def find_user_or_chat(peer, users, chats, entities=None):
+    """Finds the corresponding user or chat given a peer.
+       If the entities dictionary (see get_entities_by_peer_id) was already
+       built for these users and chats, it should be given to reuse it.
+       Returns None if it was not found"""
+    if entities is None:
+        entities = get_entities_by_peer_id(users, chats)
 
-    except StopIteration:
-        return None
+    return entities.get(get_peer_id(peer))
 
 
 def get_appropiate_part_size(file_size):
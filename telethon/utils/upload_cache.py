@@ -0,0 +1,146 @@
+import hashlib
+import mmap
+import os
+import pickle
+import time
+from collections import OrderedDict
+from os.path import isfile as file_exists
+
+
+class UploadCacheEntry:
+    """A single cached upload: the InputFile handle obtained after uploading
+       the file, and the server-side media (InputPhoto or InputDocument)
+       obtained after it was sent for the first time (if it was sent at all)"""
+
+    def __init__(self, content_hash, input_file):
+        self.content_hash = content_hash
+        self.input_file = input_file
+        self.input_media = None
+        self.created = time.time()
+
+
+class UploadCache:
+    """Content-addressed cache mapping the hash of the uploaded bytes to the
+       handles Telegram gave us for them, so identical files are only uploaded once.
+
+       Entries expire after `ttl` seconds, and the least recently used
+       entries are evicted once more than `max_entries` are stored"""
+
+    def __init__(self, file_path=None, max_entries=1024, ttl=24 * 60 * 60):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # content_hash: UploadCacheEntry, least recently used first
+        self.entries = OrderedDict()
+
+        # InputFile.id: content_hash, to find the entry when sending the media
+        self.file_ids = {}
+
+    # region Lookup
+
+    def get(self, content_hash):
+        """Gets the UploadCacheEntry for the given content hash,
+           or None if it was never cached or if it has already expired"""
+        entry = self.entries.get(content_hash)
+        if entry is None:
+            return None
+
+        if time.time() - entry.created > self.ttl:
+            self.remove(content_hash)
+            return None
+
+        self.entries.move_to_end(content_hash)
+        return entry
+
+    def get_by_input_file(self, input_file):
+        """Gets the UploadCacheEntry corresponding to the given InputFile handle"""
+        content_hash = self.file_ids.get(input_file.id)
+        return self.get(content_hash) if content_hash else None
+
+    # endregion
+
+    # region Modification
+
+    def add(self, content_hash, input_file):
+        """Adds a new InputFile handle for the given content hash,
+           evicting the least recently used entries if required"""
+        self.remove(content_hash)
+
+        entry = UploadCacheEntry(content_hash, input_file)
+        self.entries[content_hash] = entry
+        self.file_ids[input_file.id] = content_hash
+
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+        self.save()
+        return entry
+
+    def set_input_media(self, input_file, input_media):
+        """Sets the server-side media (InputPhoto or InputDocument)
+           which was obtained after sending the given InputFile"""
+        entry = self.get_by_input_file(input_file)
+        if entry:
+            entry.input_media = input_media
+            self.save()
+
+    def remove(self, content_hash):
+        """Removes the entry for the given content hash, if any"""
+        entry = self.entries.pop(content_hash, None)
+        if entry:
+            self.file_ids.pop(entry.input_file.id, None)
+
+    # endregion
+
+    # region Persistence
+
+    def save(self):
+        """Saves the current cache to its file_path, if any.
+           The file is replaced atomically, so it's never left half-written"""
+        if not self.file_path:
+            return
+
+        temp_path = self.file_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as file:
+                pickle.dump(self, file)
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temp_path, self.file_path)
+        except:
+            if file_exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def try_load_or_create_new(file_path, **kwargs):
+        """Loads the cache saved at file_path, or creates a new one if none existed before"""
+        if file_exists(file_path):
+            with open(file_path, 'rb') as file:
+                return pickle.load(file)
+        else:
+            return UploadCache(file_path, **kwargs)
+
+    # endregion
+
+    @staticmethod
+    def get_content_hash(file, chunk_size=64 * 1024):
+        """Calculates the hash identifying the contents of the given bytes-like
+           object or stream. Returns None if the stream cannot be read twice"""
+        sha = hashlib.sha256()
+        if isinstance(file, (bytes, bytearray, memoryview, mmap.mmap)):
+            sha.update(file)
+            return sha.hexdigest()
+
+        seekable = getattr(file, 'seekable', None)
+        if not seekable or not seekable():
+            return None
+
+        position = file.tell()
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+
+        file.seek(position)
+        return sha.hexdigest()
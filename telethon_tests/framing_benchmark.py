@@ -0,0 +1,66 @@
+"""Compares how much CPU time and how many bytes every framing needs per packet.
+   Run it with `python -m telethon_tests.framing_benchmark`"""
+import os
+import time
+
+from telethon.network import (AbridgedFraming, FullFraming,
+                              IntermediateFraming, ObfuscatedFraming)
+from telethon.utils import BinaryReader
+
+FRAMINGS = (
+    ('full', FullFraming),
+    ('intermediate', IntermediateFraming),
+    ('abridged', AbridgedFraming),
+    ('obfuscated', ObfuscatedFraming)
+)
+
+# Small requests, bigger ones, and upload or download file parts
+PACKET_SIZES = (64, 1024, 128 * 1024)
+
+
+def benchmark(framing_factory, packet_size, count):
+    """Encodes and decodes count packets of the given size, returning
+       tuple(CPU seconds per packet sent and received, bytes sent per packet)"""
+    framing = framing_factory()
+    header = framing.connection_header()
+    packet = os.urandom(packet_size)
+
+    start = time.process_time()
+    frames = [framing.encode([packet]) for _ in range(count)]
+    elapsed = time.process_time() - start
+
+    # What the server would send back (not measured), since obfuscated
+    # frames are encrypted with the keys of the other direction
+    if isinstance(framing, ObfuscatedFraming):
+        random_reversed = header[55:7:-1]
+        server_cipher = ObfuscatedFraming.create_cipher(
+            random_reversed[:32], random_reversed[32:48])
+        data = server_cipher.encrypt(b''.join(
+            b''.join(framing.framing.encode([packet])) for _ in range(count)))
+    else:
+        data = b''.join(b''.join(frame) for frame in frames)
+
+    start = time.process_time()
+    with BinaryReader(data) as reader:
+        for _ in range(count):
+            framing.read_frame(reader.read)
+    elapsed += time.process_time() - start
+
+    sent = sum(len(part) for frame in frames for part in frame)
+    return elapsed / count, sent / count
+
+
+def main():
+    print('{:<14}{:>10}{:>16}{:>14}'.format(
+        'framing', 'size', 'us/packet', 'bytes/packet'))
+    for size in PACKET_SIZES:
+        # Fewer big packets, since the pure Python obfuscation is slow
+        count = max(1, 2 ** 18 // size)
+        for name, framing_factory in FRAMINGS:
+            cpu, sent = benchmark(framing_factory, size, count)
+            print('{:<14}{:>10}{:>16.2f}{:>14.1f}'.format(
+                name, size, cpu * 1e6, sent))
+
+
+if __name__ == '__main__':
+    main()
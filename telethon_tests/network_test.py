@@ -1,10 +1,37 @@
+import os
 import random
 import socket
 import threading
+import time
+import tracemalloc
 import unittest
+from datetime import timedelta
+from binascii import crc32
+from queue import Empty, Queue
+from struct import pack, unpack
+from unittest import mock
 
+import telethon.helpers as utils
 import telethon.network.authenticator as authenticator
-from telethon.network import TcpClient, TcpTransport
+from telethon.crypto import AES, AuthKey
+from telethon.network import (AbridgedFraming, FullFraming,
+                              IntermediateFraming, MtProtoSender,
+                              ObfuscatedFraming, TcpClient, TcpTransport,
+                              UpdateDispatcher)
+from telethon.tl import Session
+from telethon.errors import InvalidChecksumError, RPCError
+from telethon.tl.functions import PingRequest
+from telethon.tl.functions.channels import DeleteMessagesRequest
+from telethon.tl.functions.messages import SendMessageRequest
+from telethon.tl.functions.updates import GetStateRequest
+from telethon.tl.functions.upload import SaveFilePartRequest
+from telethon.tl.types import (InputChannel, InputPeerSelf, UpdateDeleteMessages,
+                               UpdateNewMessage, UpdateShortChatMessage,
+                               UpdateShortMessage, UpdateShortSentMessage,
+                               UpdatesTg, UpdatesTooLong, UpdateUserTyping)
+from telethon.tl.types.messages import AffectedMessages
+from telethon.tl.update_state import UpdateState
+from telethon.utils import BinaryReader, BinaryWriter
 
 
 def run_server_echo_thread(port):
@@ -21,6 +48,167 @@ def run_server_echo_thread(port):
     server.start()
 
 
+def run_server_pong_thread(port, session, drop_connections):
+    """Runs a server which answers the pings sent through a TcpTransport,
+       closing the first drop_connections connections instead of answering"""
+    def read(conn, size):
+        data = b''
+        while len(data) < size:
+            partial = conn.recv(size - len(data))
+            if not partial:
+                raise ConnectionResetError()
+            data += partial
+        return data
+
+    def handle(conn, drop):
+        with conn:
+            while True:
+                try:
+                    length, seq = unpack('<ii', read(conn, 8))
+                except ConnectionError:
+                    return  # The client disconnected
+                body = read(conn, length - 8)[:-4]
+                if drop:
+                    return  # Killed without answering
+
+                msg_key = body[8:24]
+                key, iv = utils.calc_key(session.auth_key.key, msg_key, True)
+                plain_text = AES.decrypt_ige(body[24:], key, iv)
+                msg_id, = unpack('<q', plain_text[16:24])
+                data = plain_text[32:32 + unpack('<i', plain_text[28:32])[0]]
+                if data[:4] != pack('<I', 0x7abe77ec):  # ping
+                    continue
+
+                pong = pack('<Iq', 0x347773c5, msg_id) + data[4:12]
+                packet = encrypt_server_message(session, msg_id + 1, pong)
+                header = pack('<ii', len(packet) + 12, 0)
+                conn.sendall(header + packet +
+                             pack('<I', crc32(packet, crc32(header))))
+
+    def server_thread():
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('127.0.0.1', port))
+            s.listen(1)
+            for i in range(drop_connections + 1):
+                conn, addr = s.accept()
+                threading.Thread(target=handle, args=(conn, i < drop_connections),
+                                 daemon=True).start()
+
+    server = threading.Thread(target=server_thread, daemon=True)
+    server.start()
+
+
+def decrypt_client_message(session, packet):
+    """Decrypts the contents of the message in a packet sent by the client"""
+    msg_key = packet[8:24]
+    key, iv = utils.calc_key(session.auth_key.key, msg_key, True)
+    plain_text = AES.decrypt_ige(packet[24:], key, iv)
+    length, = unpack('<i', plain_text[28:32])
+    return plain_text[32:32 + length]
+
+
+class CountingSocket:
+    """Socket which counts how many times data was received through it"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.receives = 0
+
+    def recv_into(self, buffer):
+        self.receives += 1
+        return self.sock.recv_into(buffer)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class AllocationCounter:
+    """Counts how many bytes are allocated while it's used (as a with block),
+       adding up the peaks between the checkpoints. Everything allocated
+       between two checkpoints is assumed to be alive at once"""
+    def __init__(self):
+        self.allocated = 0
+
+    def checkpoint(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.allocated += peak - self.base
+        self.base = current
+        tracemalloc.reset_peak()
+
+    def wrap(self, function):
+        """Wraps the given function so that calling it is a checkpoint"""
+        def wrapped(*args, **kwargs):
+            self.checkpoint()
+            return function(*args, **kwargs)
+        return wrapped
+
+    def __enter__(self):
+        tracemalloc.start()
+        self.base = 0
+        return self
+
+    def __exit__(self, *args):
+        self.checkpoint()
+        tracemalloc.stop()
+
+
+class CopyCountingSocket:
+    """Socket whose sends are checkpoints of an AllocationCounter"""
+    def __init__(self, sock, counter):
+        self.sock = sock
+        self.sendall = counter.wrap(sock.sendall)
+        self.sendmsg = counter.wrap(sock.sendmsg)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class FakeTransport:
+    """Transport which stores the sent packets instead of sending them,
+       and receives the packets put in its incoming queue"""
+    def __init__(self):
+        self.sent = []
+        self.incoming = Queue()
+
+    def send(self, packet):
+        self.sent.append(b''.join(packet))
+
+    def receive(self, timeout=None):
+        try:
+            body = self.incoming.get(
+                timeout=timeout.total_seconds() if timeout else None)
+        except Empty:
+            raise TimeoutError()
+        if body is None:
+            raise ConnectionResetError()
+        if isinstance(body, Exception):
+            raise body
+        return 0, body
+
+    def reconnect(self):
+        pass
+
+    def close(self):
+        self.incoming.put(None)
+
+
+def encrypt_server_message(session, msg_id, data):
+    """Encrypts the given data as if the server had sent it in a message"""
+    with BinaryWriter() as writer:
+        writer.write_long(session.salt, signed=False)
+        writer.write_long(session.id, signed=False)
+        writer.write_long(msg_id)
+        writer.write_int(0)  # sequence
+        writer.write_int(len(data))
+        writer.write(data)
+        plain_text = writer.get_bytes()
+
+    msg_key = utils.calc_msg_key(plain_text)
+    key, iv = utils.calc_key(session.auth_key.key, msg_key, False)
+    plain_text += os.urandom(-len(plain_text) % 16)
+    return (pack('<Q', session.auth_key.key_id) + msg_key +
+            AES.encrypt_ige(plain_text, key, iv))
+
+
 class NetworkTests(unittest.TestCase):
     @staticmethod
     def test_tcp_client():
@@ -40,3 +228,534 @@ class NetworkTests(unittest.TestCase):
         transport = TcpTransport('149.154.167.91', 443)
         authenticator.do_authentication(transport)
         transport.close()
+
+    @staticmethod
+    def test_send_packet():
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session)
+
+        request = SaveFilePartRequest(1, 0, os.urandom(1000))
+        sender.send(request)
+        sender.disconnect()
+
+        with BinaryWriter() as writer:
+            request.on_send(writer)
+            serialized = writer.get_bytes()
+
+        with BinaryReader(transport.sent[0]) as reader:
+            assert reader.read_long(signed=False) == session.auth_key.key_id, \
+                'The packet should start with the auth key ID'
+
+            msg_key = reader.read(16)
+            key, iv = utils.calc_key(session.auth_key.key, msg_key, True)
+            plain_text = AES.decrypt_ige(reader.read(len(transport.sent[0]) - 24), key, iv)
+
+        with BinaryReader(plain_text) as reader:
+            reader.read_long(signed=False)  # salt
+            assert reader.read_long(signed=False) == session.id, 'Invalid session ID'
+            assert reader.read_long() == request.msg_id, 'Invalid message ID'
+            reader.read_int()  # sequence
+            length = reader.read_int()
+            assert reader.read(length) == serialized, \
+                'The decrypted request does not match the serialized request'
+
+        assert msg_key == utils.calc_msg_key(plain_text[:32 + length]), \
+            'The message key should be calculated without the padding'
+
+    @staticmethod
+    def test_reader_thread():
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session)
+
+        updates = []
+        sender.add_update_handler(updates.append, UpdatesTooLong)
+
+        ping, get_state = PingRequest(7), GetStateRequest()
+        sender.send(ping)
+        sender.send(get_state)
+
+        # The results arrive in any order, with updates between them
+        with BinaryWriter() as writer:
+            writer.write_int(0xf35c6d01, signed=False)  # rpc_result
+            writer.write_long(get_state.msg_id)
+            writer.write_int(0x2144ca19, signed=False)  # rpc_error
+            writer.write_int(400)
+            writer.tgwrite_string('SOME_UNKNOWN_ERROR')
+            rpc_error = writer.get_bytes()
+        with BinaryWriter() as writer:
+            writer.write_int(0x347773c5, signed=False)  # pong
+            writer.write_long(ping.msg_id)
+            writer.write_long(7)
+            pong = writer.get_bytes()
+        with BinaryWriter() as writer:
+            UpdatesTooLong().on_send(writer)
+            update = writer.get_bytes()
+
+        for i, data in enumerate((rpc_error, update, pong)):
+            transport.incoming.put(encrypt_server_message(session, 4 * i + 1, data))
+
+        sender.receive(ping)
+        try:
+            sender.receive(get_state)
+            raise AssertionError('The error of the request should be raised')
+        except RPCError as error:
+            assert error.message == 'SOME_UNKNOWN_ERROR', 'Invalid error'
+
+        threads = sender.updates.threads
+        sender.disconnect()
+        sender.updates.stop()
+        for thread in threads:
+            thread.join()
+        assert len(updates) == 1, 'Updates should be handled as they arrive'
+
+        try:
+            sender.receive(PingRequest(0))
+            raise AssertionError('Closed connections should not be waited for')
+        except ConnectionError:
+            pass
+
+    @staticmethod
+    def test_keepalive():
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session,
+                               ping_interval=0.05, ping_timeout=0.5,
+                               auto_reconnect=False)
+
+        # Answer the first ping, and let the rest go unanswered
+        deadline = time.monotonic() + 1
+        while not sender.pending_requests and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sender.pending_requests, 'Pings should be sent periodically'
+
+        ping = next(iter(sender.pending_requests.values()))
+        with BinaryWriter() as writer:
+            writer.write_int(0x347773c5, signed=False)  # pong
+            writer.write_long(ping.msg_id)
+            writer.write_long(ping.ping_id)
+            transport.incoming.put(
+                encrypt_server_message(session, 1, writer.get_bytes()))
+
+        sender.receive(ping)
+        metrics = sender.get_metrics()
+        assert metrics['pongs'] == 1 and metrics['rtt'] is not None, \
+            'The round-trip time of the pongs should be measured'
+
+        try:
+            sender.receive(PingRequest(0), timeout=timedelta(seconds=2))
+            raise AssertionError('Connections without pongs should be dead')
+        except ConnectionError:
+            pass
+        sender.disconnect()
+
+    @staticmethod
+    def test_reconnect():
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        port = random.randint(50000, 60000)  # Arbitrary non-privileged port
+        run_server_pong_thread(port, session, drop_connections=2)
+
+        for _ in range(50):
+            try:
+                transport = TcpTransport('127.0.0.1', port)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)  # The server didn't start listening yet
+
+        sender = MtProtoSender(transport, session, reconnect_delay=0.05)
+        ping = PingRequest(7)
+        sender.send(ping)
+        sender.receive(ping, timeout=timedelta(seconds=5))
+
+        metrics = sender.get_metrics()
+        assert metrics['reconnects'] == 2, \
+            'Dropped connections should be replaced by new ones'
+        assert metrics['failover_time'] < 1, 'Reconnecting took too long'
+        sender.disconnect()
+
+    @staticmethod
+    def test_resend_pending():
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session, reconnect_delay=0.01)
+
+        timed_out = SendMessageRequest(InputPeerSelf(), 'Hello', 1)
+        sender.send(timed_out)
+        try:
+            sender.receive(timed_out, timeout=timedelta(seconds=0.1))
+            raise AssertionError('The request should have timed out')
+        except TimeoutError:
+            pass
+
+        sender.send_ping()  # Its pong never arrives
+        waiting = SendMessageRequest(InputPeerSelf(), 'Hello', 2)
+        sender.send(waiting)
+
+        sent = len(transport.sent)
+        locked = []
+        transport.reconnect = lambda: locked.append(sender.write_lock.locked())
+        assert sender.reconnect(), 'The sender should have reconnected'
+        assert locked == [True], \
+            'No writer should use the connection while it is being replaced'
+        # The ping thread sends them, since the reader thread never sends
+        for _ in range(100):
+            if len(transport.sent) > sent:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        assert len(transport.sent) == sent + 1, \
+            'Only the requests which are still waited for should be sent again'
+        assert decrypt_client_message(session, transport.sent[-1])[:4] == \
+            pack('<I', SendMessageRequest.constructor_id), \
+            'The request which is still waited for should be sent again'
+        assert list(sender.pending_requests.values()) == [waiting], \
+            'Only the requests which are still waited for should be pending'
+        sender.disconnect()
+
+    @staticmethod
+    def test_bad_server_salt():
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session)
+
+        request = SendMessageRequest(InputPeerSelf(), 'Hello', 1)
+        sender.send(request)
+        sent = len(transport.sent)
+        with BinaryWriter() as writer:
+            writer.write_int(0xedab447b, signed=False)  # bad_server_salt
+            writer.write_long(request.msg_id)
+            writer.write_int(0)
+            writer.write_int(48)
+            writer.write_long(1234, signed=False)
+            data = writer.get_bytes()
+
+        # A writer may be busy, but the reader thread must not wait for it
+        with sender.write_lock:
+            with BinaryReader(data) as reader:
+                assert sender.handle_bad_server_salt(0, 0, reader)
+            assert request.dirty and len(transport.sent) == sent, \
+                'The request should only be marked to be sent again'
+
+        for _ in range(100):
+            if len(transport.sent) > sent:
+                break
+            time.sleep(0.01)
+        assert session.salt == 1234 and len(transport.sent) == sent + 1, \
+            'The request should be sent again with the new salt'
+        assert not request.dirty and request.msg_id in sender.pending_requests, \
+            'The request should be waited for under its new message ID'
+        sender.disconnect()
+
+    @staticmethod
+    def test_corrupt_frame():
+        # A frame with an invalid checksum, as the framing would find it
+        frame = b''.join(FullFraming().encode([os.urandom(16)]))
+        try:
+            with BinaryReader(frame[:-4] + bytes(4)) as reader:
+                FullFraming().read_frame(reader.read)
+            raise AssertionError('The invalid checksum should be found')
+        except InvalidChecksumError as error:
+            corrupt = error
+
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session, reconnect_delay=0.01)
+        transport.incoming.put(corrupt)
+        for _ in range(100):
+            if sender.reconnects:
+                break
+            time.sleep(0.01)
+        assert sender.reconnects == 1 and sender.reader_thread.is_alive(), \
+            'The connection should be replaced after a corrupt frame'
+        sender.disconnect()
+
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session, auto_reconnect=False)
+        ping = PingRequest(7)
+        sender.send(ping)
+        transport.incoming.put(corrupt)
+        try:
+            sender.receive(ping, timeout=timedelta(seconds=5))
+            raise AssertionError('The request should not be received')
+        except ConnectionError:
+            pass
+        sender.disconnect()
+
+    @staticmethod
+    def test_framing():
+        packets = [os.urandom(size) for size in (16, 508, 512, 4096)]
+        for framing in (FullFraming(), IntermediateFraming(), AbridgedFraming()):
+            stream = BinaryReader(framing.connection_header() + b''.join(
+                b''.join(framing.encode([p])) for p in packets))
+            stream.read(len(framing.connection_header()))
+            for packet in packets:
+                assert framing.read_frame(stream.read)[1] == packet, \
+                    'Packets should be read as they were written ({})' \
+                    .format(type(framing).__name__)
+
+        # The server decrypts with the keys in the header, and uses them reversed
+        client = ObfuscatedFraming(AbridgedFraming())
+        header = client.connection_header()
+        assert len(header) == 64, 'Invalid obfuscated header length'
+        frame = b''.join(client.encode([packets[1][:100], packets[1][100:]]))
+
+        server_decryptor = ObfuscatedFraming.create_cipher(header[8:40], header[40:56])
+        assert server_decryptor.decrypt(header)[56:60] == AbridgedFraming.Tag, \
+            'The server should be able to tell the framing apart'
+        assert server_decryptor.decrypt(frame) == \
+            b''.join(AbridgedFraming().encode([packets[1]])), \
+            'Invalid obfuscated frame'
+
+        reversed_header = header[55:7:-1]
+        server_encryptor = ObfuscatedFraming.create_cipher(
+            reversed_header[:32], reversed_header[32:48])
+        stream = BinaryReader(server_encryptor.encrypt(
+            b''.join(AbridgedFraming().encode([packets[2]]))))
+        assert client.read_frame(stream.read)[1] == packets[2], \
+            'Obfuscated frames should be read as they were written'
+
+    @staticmethod
+    def test_buffered_read():
+        client = TcpClient(buffer_size=1024)
+        client.socket.close()
+        client_socket, server_socket = socket.socketpair()
+        client.socket = CountingSocket(client_socket)
+        client.connected = True
+
+        framing = FullFraming()
+        packets = [os.urandom(size) for size in [100] * 8 + [5000, 700]]
+        data = b''.join(b''.join(framing.encode([packet])) for packet in packets)
+        server_socket.sendall(data[:900])
+
+        read = lambda count: client.read(count, timedelta(seconds=1))
+        for packet in packets[:7]:
+            assert framing.read_frame(read)[1] == packet, 'Invalid packet read'
+        assert client.socket.receives == 1, \
+            'The messages received together should be read with a single receive'
+
+        # Messages split between receives, and larger than the buffer
+        sender = threading.Thread(target=server_socket.sendall, args=(data[900:],))
+        sender.start()
+        for packet in packets[7:]:
+            assert framing.read_frame(read)[1] == packet, 'Invalid packet read'
+        sender.join()
+
+        # Frames are sent as they are, without joining their parts
+        client.write(framing.encode([packets[8][:10], packets[8][10:]]))
+        server_socket.settimeout(1)
+        assert framing.read_frame(lambda count: server_socket.recv(
+            count, socket.MSG_WAITALL))[1] == packets[8], 'Invalid packet sent'
+
+        client.close()
+        server_socket.close()
+
+    @staticmethod
+    def test_upload_copies():
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        transport = TcpTransport('127.0.0.1', server.getsockname()[1])
+        conn, addr = server.accept()
+
+        def discard_received():
+            buffer = bytearray(1024 * 1024)  # Allocated before measuring
+            while conn.recv_into(buffer):
+                pass
+
+        threading.Thread(target=discard_received, daemon=True).start()
+
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        sender = MtProtoSender(transport, session)
+        part = memoryview(os.urandom(512 * 1024))  # As if it were memory mapped
+
+        # Every copy made by the transport, framing or socket is counted too
+        counter = AllocationCounter()
+        transport.send = counter.wrap(transport.send)
+        transport.tcp_client.write = counter.wrap(transport.tcp_client.write)
+        transport.tcp_client.socket = CopyCountingSocket(
+            transport.tcp_client.socket, counter)
+
+        # The ciphertext is the only copy AES must make, but the pure Python
+        # one allocates a lot for every block, so a single copy replaces it
+        with mock.patch.object(AES, 'encrypt_ige', lambda plain_text, key, iv: bytes(plain_text)):
+            with counter:
+                sender.send_packet(SaveFilePartRequest(1, 0, part))
+
+        sender.disconnect()
+        conn.close()
+        server.close()
+
+        copies = counter.allocated / len(part)
+        assert copies < 2.5, \
+            'The part should only be copied when serialized and encrypted, ' \
+            'but {:.2f} bytes were allocated per uploaded byte'.format(copies)
+
+    @staticmethod
+    def test_gzip_packed():
+        session = Session(None)
+        session.auth_key = AuthKey(os.urandom(256))
+        transport = FakeTransport()
+        sender = MtProtoSender(transport, session, compression_threshold=256)
+
+        requests = [
+            SendMessageRequest(InputPeerSelf(), 'Hello, world! ' * 100, 1),
+            SendMessageRequest(InputPeerSelf(), 'Hello, world!', 2),
+            SaveFilePartRequest(1, 0, bytes(1024))
+        ]
+        for request in requests:
+            sender.send(request)
+        sender.disconnect()
+
+        messages = [decrypt_client_message(session, packet)
+                    for packet in transport.sent]
+        with BinaryReader(messages[0]) as reader:
+            assert reader.read_int(signed=False) == 0x3072cfa1, \
+                'Big requests should be sent compressed'
+            unpacked_data = sender.gunzip(reader.tgread_bytes())
+
+        with BinaryWriter() as writer:
+            requests[0].on_send(writer)
+            assert unpacked_data == writer.get_bytes(), \
+                'The compressed request should match the serialized request'
+
+        for message, reason in zip(messages[1:], ('Small requests', 'File parts')):
+            assert message[:4] != pack('<I', 0x3072cfa1), \
+                '{} should not be compressed'.format(reason)
+
+        assert sender.gzip(os.urandom(1024)) is None, \
+            'Requests should not be compressed if they do not get smaller'
+
+    @staticmethod
+    def test_update_dispatcher():
+        dispatcher = UpdateDispatcher(workers=3, max_queue_size=4)
+        messages, chat_messages = {}, []
+
+        def message_handler(update):
+            messages.setdefault(update.user_id, []).append(update.id)
+
+        dispatcher.add_handler(message_handler, UpdateShortMessage)
+        dispatcher.add_handler(chat_messages.append, UpdateShortChatMessage)
+
+        for i in range(100):
+            dispatcher.dispatch(UpdateShortMessage(
+                id=i, user_id=i % 7, message='', pts=0, pts_count=0, date=None))
+        dispatcher.dispatch(UpdateShortChatMessage(
+            id=0, from_id=1, chat_id=1, message='', pts=0, pts_count=0, date=None))
+
+        # Updates within containers should reach the handlers of their types
+        new_messages = []
+        dispatcher.add_handler(new_messages.append, UpdateNewMessage)
+        dispatcher.dispatch(UpdatesTg(
+            updates=[UpdateNewMessage(None, 0, 0), UpdateNewMessage(None, 0, 0)],
+            users=[], chats=[], date=None, seq=0))
+
+        assert dispatcher.wants(UpdateShortMessage.constructor_id), \
+            'Updates with handlers should be decoded'
+        assert dispatcher.wants(UpdatesTg.constructor_id), \
+            'Containers may have updates with handlers within them'
+        assert not dispatcher.wants(UpdateUserTyping.constructor_id), \
+            'Updates without handlers should not be decoded'
+
+        dispatcher.state = UpdateState()
+        assert not dispatcher.wants(UpdateUserTyping.constructor_id), \
+            'Updates without handlers nor state should not be decoded'
+        assert dispatcher.wants(UpdateDeleteMessages.constructor_id), \
+            'Updates with state should be decoded to be checked against it'
+        assert dispatcher.wants(UpdatesTooLong.constructor_id), \
+            'Updates telling about a gap should be decoded to be fetched'
+        dispatcher.state = None
+
+        threads = dispatcher.threads
+        dispatcher.stop()
+        for thread in threads:
+            thread.join()
+
+        assert sum(len(ids) for ids in messages.values()) == 100, \
+            'Every update should be handled by its handler once'
+        assert all(ids == sorted(ids) for ids in messages.values()), \
+            'The updates of the same chat should be handled in order'
+        assert len(chat_messages) == 1, 'Handlers should only get their types'
+        assert len(new_messages) == 2, 'Containers should be split into updates'
+
+        metrics = dispatcher.get_metrics()
+        assert metrics['handled'] == 103 and metrics['queue_depth'] == 0, \
+            'Invalid update metrics'
+
+        # Slow handlers should never block the thread dispatching the updates
+        dispatcher = UpdateDispatcher(workers=1, max_queue_size=2,
+                                      max_overflow_size=8)
+        started, release, handled = threading.Event(), threading.Event(), []
+
+        def slow_handler(update):
+            started.set()
+            release.wait()
+            handled.append(update.id)
+
+        dispatcher.add_handler(slow_handler, UpdateShortMessage)
+        dispatcher.dispatch(UpdateShortMessage(
+            id=0, user_id=1, message='', pts=0, pts_count=0, date=None))
+        started.wait()
+        for i in range(1, 10):
+            dispatcher.dispatch(UpdateShortMessage(
+                id=i, user_id=1, message='', pts=0, pts_count=0, date=None))
+
+        metrics = dispatcher.get_metrics()
+        assert metrics['overflowed'] == 7 and metrics['max_queue_depth'] == 9, \
+            'The updates which do not fit in the queue should overflow'
+
+        # Once the overflow buffer is full too, the newest updates are dropped
+        for i in range(10, 20):
+            dispatcher.dispatch(UpdateShortMessage(
+                id=i, user_id=1, message='', pts=0, pts_count=0, date=None))
+
+        metrics = dispatcher.get_metrics()
+        assert metrics['overflowed'] == 8 and metrics['dropped'] == 9, \
+            'The updates which do not fit in the overflow buffer should be dropped'
+
+        release.set()
+        threads = dispatcher.threads
+        dispatcher.stop()
+        for thread in threads:
+            thread.join()
+        assert handled == list(range(11)), \
+            'The updates which overflowed should be handled in order'
+
+    @staticmethod
+    def test_update_state_results():
+        dispatcher = UpdateDispatcher()
+        dispatcher.state, gaps = UpdateState(), []
+        dispatcher.state.set(pts=10, seq=5)
+        dispatcher.on_gap = gaps.append
+
+        # Without handlers, the updates within containers must be checked anyway
+        dispatcher.dispatch(UpdatesTg(
+            updates=[UpdateNewMessage(None, pts=11, pts_count=1)],
+            users=[], chats=[], date=None, seq=6))
+        assert (dispatcher.state.pts, dispatcher.state.seq) == (11, 6), \
+            'The updates within containers should be applied to the state'
+
+        dispatcher.dispatch_result(
+            SendMessageRequest(InputPeerSelf(), 'Hello', 1),
+            UpdateShortSentMessage(id=1, pts=12, pts_count=1, date=None))
+        assert dispatcher.state.pts == 12, \
+            'The pts of the results should be applied to the state'
+
+        dispatcher.state.set_channel_pts(5, 20)
+        dispatcher.dispatch_result(
+            DeleteMessagesRequest(InputChannel(5, 0), [1]),
+            AffectedMessages(pts=21, pts_count=1))
+        assert dispatcher.state.channel_pts[5] == 21 and \
+            dispatcher.state.pts == 12, \
+            'The results of channel requests should be applied to their channel'
+
+        dispatcher.dispatch(UpdateDeleteMessages([1], pts=13, pts_count=1))
+        assert not gaps, 'No gap should be found after the results were applied'
@@ -1,5 +1,221 @@
+import os
+import tempfile
 import unittest
+from unittest import mock
+
+from telethon.crypto import AuthKey
+from telethon.errors import (FloodWaitError, MigrateError, PhoneMigrateError,
+                             RPCError)
+from telethon.tl import Session, SQLiteSession
+from telethon.tl.types import (
+    Channel, ChatPhotoEmpty, UpdateDeleteChannelMessages,
+    UpdateDeleteMessages, UpdatesTg, UpdatesTooLong, User)
+from telethon.tl.update_state import UpdateState
+from telethon.tl.types.messages import Chats
 
 
 class TLTests(unittest.TestCase):
-    """There are no tests yet"""
+    @staticmethod
+    def test_sqlite_session():
+        with tempfile.TemporaryDirectory() as directory:
+            session_user_id = os.path.join(directory, 'test')
+
+            session = SQLiteSession.try_load_or_create_new(session_user_id)
+            session.auth_key = AuthKey(os.urandom(256))
+            session.salt = 2**64 - 1  # Unsigned longs must fit in the database
+            session.port = 80
+            session.set_dc_auth_key(4, session.auth_key)
+            session.save()
+            session.time_offset = 3
+            session.flush()
+
+            loaded = SQLiteSession.try_load_or_create_new(session_user_id)
+            assert loaded.auth_key.key == session.auth_key.key, \
+                'The loaded auth key should match the saved one'
+            assert loaded.salt == session.salt, 'Invalid loaded salt'
+            assert loaded.port == 80, 'Invalid loaded port'
+            assert loaded.time_offset == 3, 'Invalid loaded time offset'
+            assert loaded.dc_auth_keys[4].key == session.auth_key.key, \
+                'The auth keys of every DC should be saved'
+            assert loaded.id != session.id, \
+                'Loading a session should start a new MTProto session'
+
+            assert loaded.delete(), 'The session should be deleted'
+            session.db.close()
+
+            # Pickled sessions should be converted, even if that fails once
+            old_session = Session(session_user_id)
+            old_session.auth_key = AuthKey(os.urandom(256))
+            old_session.flush()
+            with mock.patch.object(SQLiteSession, 'write', side_effect=OSError):
+                try:
+                    SQLiteSession.try_load_or_create_new(session_user_id)
+                    raise AssertionError('Writing the database should have failed')
+                except OSError:
+                    pass
+
+            loaded = SQLiteSession.try_load_or_create_new(session_user_id)
+            assert loaded.auth_key.key == old_session.auth_key.key, \
+                'The auth key should survive a failed conversion'
+            assert not os.path.isfile('{}.session.old'.format(session_user_id)), \
+                'The pickled session should be removed once converted'
+            loaded.db.close()
+
+    @staticmethod
+    def test_session_saving():
+        with tempfile.TemporaryDirectory() as directory:
+            session_user_id = os.path.join(directory, 'test')
+            path = '{}.session'.format(session_user_id)
+
+            session = Session(session_user_id)
+            session.save()
+            assert os.path.isfile(path), 'New sessions should be written right away'
+
+            session.last_message_id = 4
+            session.save()
+            assert Session.try_load_or_create_new(session_user_id).last_message_id == 0, \
+                'Insignificant changes should not be written right away'
+
+            session.salt = 123
+            session.save()
+            loaded = Session.try_load_or_create_new(session_user_id)
+            assert loaded.salt == 123 and loaded.last_message_id == 4, \
+                'Significant changes should be written right away'
+
+            session.time_offset = 5
+            session.save()
+            session.flush()
+            assert not session.dirty_fields, 'Nothing should be left to write'
+            assert Session.try_load_or_create_new(session_user_id).time_offset == 5, \
+                'Flushing should write any pending change'
+            assert not os.path.isfile(path + '.tmp'), \
+                'The temporary file should replace the session file'
+
+            session.time_offset = 6
+            with mock.patch('pickle.dump', side_effect=OSError):
+                try:
+                    session.flush()
+                    raise AssertionError('Writing the session should have failed')
+                except OSError:
+                    pass
+            assert 'time_offset' in session.dirty_fields, \
+                'Changes which failed to be written should still be pending'
+            assert not os.path.isfile(path + '.tmp'), \
+                'The temporary file should be removed if writing failed'
+            session.flush()
+            assert Session.try_load_or_create_new(session_user_id).time_offset == 6, \
+                'Changes which failed to be written should be written later'
+
+    @staticmethod
+    def test_entity_database():
+        with tempfile.TemporaryDirectory() as directory:
+            session_user_id = os.path.join(directory, 'test')
+
+            session = SQLiteSession.try_load_or_create_new(session_user_id)
+            user = User(id=1, access_hash=-2, username='Someone', phone='123')
+            channel = Channel(id=1, access_hash=3, title='Channel',
+                              photo=ChatPhotoEmpty(), date=None, version=0,
+                              username='channel')
+            session.process_entities(Chats([channel]))
+            session.process_entities([user])
+            session.flush()
+            assert not session.entities.changed, \
+                'Written entities should no longer be marked as changed'
+
+            entities = SQLiteSession.try_load_or_create_new(
+                session_user_id).entities
+            user_peer = entities.get_input_peer(1)
+            channel_peer = entities.get_input_peer(-(10**12 + 1))
+            assert (user_peer.user_id, user_peer.access_hash) == (1, -2), \
+                'Unmarked IDs should prefer users'
+            assert (channel_peer.channel_id, channel_peer.access_hash) == (1, 3), \
+                'Marked IDs should find the exact peer'
+            assert entities.get_input_peer('@someone') is user_peer, \
+                'Usernames should be case insensitive'
+            assert entities.get_input_peer('+1 (23)') is user_peer, \
+                'Phones should only consider their digits'
+            assert entities.get_input_peer('channel') is channel_peer, \
+                'Usernames should not require the leading @'
+
+            # Sessions which are not saved (such as those of other DCs) may share
+            # the entities, but they must not mark them as written
+            session.entities.changed.clear()
+            dc_session = Session(None)
+            dc_session.entities = session.entities
+            dc_session.process_entities([User(id=2, access_hash=4)])
+            dc_session.flush()
+            assert session.entities.changed == {2}, \
+                'Sessions which are not saved should not mark entities as written'
+
+            user.username = None
+            assert entities.process([user]), 'Changes should be detected'
+            assert 'someone' not in entities, 'Old usernames should be removed'
+
+            session.db.close()
+
+    @staticmethod
+    def test_rpc_error():
+        error = RPCError(420, 'FLOOD_WAIT_31')
+        assert isinstance(error, FloodWaitError) and error.seconds == 31, \
+            'Flood wait errors should be typed and know how long to wait'
+
+        error = RPCError(303, 'PHONE_MIGRATE_4')
+        assert isinstance(error, PhoneMigrateError) and \
+            isinstance(error, MigrateError) and error.new_dc == 4, \
+            'Migrate errors should be typed and know their new DC'
+
+        error = RPCError(400, 'FILE_PART_7_MISSING')
+        assert type(error) is RPCError and error.additional_data == 7, \
+            'Numbers within the message should be parsed too'
+
+        error = RPCError(401, 'SESSION_PASSWORD_NEEDED')
+        assert error.password_required and error.additional_data is None, \
+            'Errors without additional data should be classified too'
+
+        error = RPCError(400, 'SOME_UNKNOWN_ERROR_2')
+        assert type(error) is RPCError and error.error_key is None, \
+            'Unknown errors should not be classified'
+
+    @staticmethod
+    def test_update_state():
+        state = UpdateState()
+        assert state.check(UpdateDeleteMessages([1], pts=10, pts_count=1)) == \
+            UpdateState.Apply, 'Updates should be applied if the state is unknown'
+        assert state.pts == 10, 'Applying updates should update the state'
+
+        assert state.check(UpdateDeleteMessages([2, 3], pts=12, pts_count=2)) == \
+            UpdateState.Apply, 'Updates right after the state should be applied'
+        assert state.check(UpdateDeleteMessages([3], pts=12, pts_count=1)) == \
+            UpdateState.Duplicate, 'Updates already applied should be detected'
+        assert state.check(UpdateDeleteMessages([5], pts=15, pts_count=1)) == \
+            UpdateState.Gap, 'Missing updates should be detected'
+        assert state.pts == 12, 'Only applied updates should update the state'
+
+        assert state.check(UpdateDeleteChannelMessages(7, [1], 3, 1)) == \
+            UpdateState.Apply and state.channel_pts[7] == 3, \
+            'Channels should have their own state'
+        assert state.check(UpdateDeleteChannelMessages(7, [1], 5, 1)) == \
+            UpdateState.Gap, 'Channels should detect missing updates too'
+
+        state.set(seq=4)
+        assert state.check(UpdatesTg([], [], [], date=0, seq=5)) == \
+            UpdateState.Apply and state.seq == 5, 'The seq should be checked'
+        assert state.check(UpdatesTg([], [], [], date=0, seq=0)) == \
+            UpdateState.Apply, 'Updates without seq should always be applied'
+        assert state.check(UpdatesTooLong()) == UpdateState.Gap, \
+            'Too many updates should be handled as a gap'
+
+        with tempfile.TemporaryDirectory() as directory:
+            session_user_id = os.path.join(directory, 'test')
+
+            session = SQLiteSession.try_load_or_create_new(session_user_id)
+            session.update_state = state
+            session.save_update_state()
+            assert not state.changed, 'Saved states should not be marked as changed'
+
+            loaded = SQLiteSession.try_load_or_create_new(
+                session_user_id).update_state
+            assert (loaded.pts, loaded.seq, loaded.channel_pts) == \
+                (12, 5, {7: 3}), 'The state should be saved in the session'
+
+            session.db.close()
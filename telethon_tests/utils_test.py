@@ -1,6 +1,33 @@
 import os
+import tempfile
 import unittest
-from telethon.utils import BinaryReader, BinaryWriter
+from io import BytesIO
+
+from telethon.helpers import enumerate_parts, get_stream_size, iter_stream_parts
+from telethon.tl.functions.messages import SendMessageRequest
+from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.types import (Channel, Chat, ChatPhotoEmpty, InputFile,
+                               InputPeerUser, InputPhoto, PeerChannel, PeerChat,
+                               PeerUser, User)
+from telethon.utils import (AdaptivePartSize, BinaryReader, BinaryWriter,
+                            FloodWaitRegistry, RateLimiter, UploadCache, find_user_or_chat,
+                            get_entities_by_peer_id)
+
+
+class UnseekableStream:
+    """Stream which can only be read (at most max_read bytes at once)"""
+    def __init__(self, data, max_read=None):
+        self.stream = BytesIO(data)
+        self.max_read = max_read
+
+    def read(self, size=-1):
+        if self.max_read and (size < 0 or size > self.max_read):
+            size = self.max_read
+        return self.stream.read(size)
+
+    @staticmethod
+    def seekable():
+        return False
 
 
 class UtilsTests(unittest.TestCase):
@@ -88,3 +115,161 @@ class UtilsTests(unittest.TestCase):
                 value = reader.tgread_string()
                 assert value == string, 'Example string should be {} but is {}'.format(
                     string, value)
+
+    @staticmethod
+    def test_upload_cache():
+        cache = UploadCache(max_entries=2)
+        first = InputFile(1, 1, 'first', '')
+        cache.add('a', first)
+        cache.add('b', InputFile(2, 1, 'second', ''))
+
+        # Using 'a' makes 'b' the least recently used entry, so it's evicted
+        assert cache.get('a').input_file is first, 'Cached file should be found'
+        cache.add('c', InputFile(3, 1, 'third', ''))
+        assert cache.get('b') is None, 'Least recently used entry should be evicted'
+
+        cache.set_input_media(first, InputPhoto(4, 5))
+        assert cache.get_by_input_file(first).input_media.id == 4, \
+            'The input media should be found through the input file'
+
+        cache.ttl = -1
+        assert cache.get('a') is None, 'Expired entries should not be found'
+        assert cache.get_by_input_file(first) is None, \
+            'Expired entries should not be found through the input file'
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'uploads.cache')
+            UploadCache(file_path).add('a', first)
+            assert UploadCache.try_load_or_create_new(file_path).get('a'), \
+                'The saved entries should be loaded'
+            assert os.listdir(directory) == ['uploads.cache'], \
+                'No temporary file should be left behind'
+
+        data = os.urandom(100 * 1024)
+        stream = BytesIO(data)
+        stream.seek(10)
+        assert UploadCache.get_content_hash(stream) == \
+            UploadCache.get_content_hash(data[10:]), \
+            'Streams should be hashed from their current position, like bytes'
+        assert stream.tell() == 10, 'The stream position should be restored'
+        assert UploadCache.get_content_hash(UnseekableStream(data)) is None, \
+            'Streams which cannot be read twice should not be hashed'
+
+    @staticmethod
+    def test_stream_parts():
+        stream = BytesIO(bytes(1000))
+        stream.seek(100)
+        assert get_stream_size(stream) == 900, \
+            'The size should only count the remaining data'
+        assert stream.tell() == 100, 'The stream position should be restored'
+        assert get_stream_size(UnseekableStream(b'')) is None, \
+            'The size of streams which are not seekable should be unknown'
+
+        # Short reads should be joined until the part is full
+        data = os.urandom(2500)
+        parts = list(iter_stream_parts(UnseekableStream(data, max_read=300), 1024))
+        assert [len(part) for part in parts] == [1024, 1024, 452], \
+            'Every part but the last one should have exactly the part size'
+        assert b''.join(parts) == data, 'The parts should contain all the data'
+        assert not list(iter_stream_parts(BytesIO(), 1024)), \
+            'Empty streams should have no parts'
+        assert len(list(iter_stream_parts(BytesIO(bytes(2048)), 1024))) == 2, \
+            'No empty part should be yielded when the size is a multiple'
+
+        numbered = list(enumerate_parts(iter([b'a', b'b', b'c'])))
+        assert numbered == [(0, -1, b'a'), (1, -1, b'b'), (2, 3, b'c')], \
+            'The total parts should be -1 until the last one, if not known'
+        assert list(enumerate_parts([b'a', b'b'], 2)) == \
+            [(0, 2, b'a'), (1, 2, b'b')], 'Known totals should always be given'
+        assert not list(enumerate_parts([])), 'No parts should be yielded'
+
+    @staticmethod
+    def test_adaptive_part_size():
+        adaptive = AdaptivePartSize(part_size_kb=64, grow_after=1)
+
+        # With a constant round trip time, bigger parts have a better throughput
+        while adaptive.part_size_kb < 512:
+            adaptive.on_part(adaptive.part_size_kb * 1024, 0.1)
+        adaptive.on_part(512 * 1024, 0.1)
+        assert adaptive.window == 2, \
+            'The window should grow after the part size reaches its maximum'
+
+        adaptive.on_flood_wait()
+        assert adaptive.window == 1, 'The window should shrink on flood waits'
+        adaptive.on_timeout()
+        assert adaptive.part_size_kb == 256, \
+            'The part size should shrink on timeouts once the window is 1'
+
+        # If growing makes the throughput worse, it should be reverted
+        adaptive = AdaptivePartSize(part_size_kb=64, grow_after=1)
+        adaptive.on_part(64 * 1024, 0.1)
+        adaptive.on_part(128 * 1024, 10)
+        assert adaptive.part_size_kb == 64, \
+            'The part size should be reverted if the throughput got worse'
+
+    @staticmethod
+    def test_find_user_or_chat():
+        # Synthetic response with 1000 users and 1000 chats, half of them channels
+        # (sharing their IDs with the users and chats, which must not collide)
+        users = [User(id=i) for i in range(1, 1001)]
+        chats = [Chat(id=i, title='', photo=ChatPhotoEmpty(), participants_count=0,
+                      date=None, version=0) if i % 2 else
+                 Channel(id=i, title='', photo=ChatPhotoEmpty(), date=None, version=0)
+                 for i in range(1, 1001)]
+        entities = get_entities_by_peer_id(users, chats)
+
+        for i in range(1, 1001):
+            assert find_user_or_chat(PeerUser(i), users, chats, entities) \
+                is users[i - 1], 'Users should be found by their ID'
+
+            peer = PeerChat(i) if i % 2 else PeerChannel(i)
+            assert find_user_or_chat(peer, users, chats, entities) \
+                is chats[i - 1], 'Chats and channels should not collide'
+
+        assert find_user_or_chat(PeerUser(1001), users, chats) is None, \
+            'Peers not in the response should not be found'
+
+    @staticmethod
+    def test_rate_limiter():
+        limiter = RateLimiter(global_rate=1, global_burst=2, peer_interval=60)
+        assert not limiter.get_delay(1), 'Nothing was sent yet'
+
+        limiter.on_send(1)
+        assert limiter.get_delay(1) > 59, 'The same peer should wait its interval'
+        assert not limiter.get_delay(2), 'Other peers should not wait yet'
+
+        limiter.on_send(2)
+        assert limiter.get_delay(3) > 0.9, 'The global burst should be spent'
+
+        limiter = RateLimiter()
+        limiter.on_flood_wait(30, peer=1)
+        assert limiter.get_delay(1) > 29, 'The flooded peer should wait'
+        assert not limiter.get_delay(2), 'Flood waits should only affect their peer'
+
+        limiter.on_flood_wait(30)
+        assert limiter.get_delay(2) > 29, 'Global flood waits should affect any peer'
+
+    @staticmethod
+    def test_flood_wait_registry():
+        def send_message(user_id):
+            return SendMessageRequest(InputPeerUser(user_id, 0), '', 0)
+
+        registry = FloodWaitRegistry()
+        assert not registry.get_delay(send_message(1)), 'Nothing should be blocked'
+
+        registry.record(send_message(1), 30)
+        assert registry.get_delay(send_message(1)) > 29, \
+            'The same request to the same peer should be blocked'
+        assert not registry.get_delay(send_message(2)), \
+            'The same request to other peers should not be blocked'
+        assert not registry.get_delay(GetFileRequest(None, 0, 0)), \
+            'Other requests should not be blocked'
+
+        registry.record(GetFileRequest(None, 0, 0), 30)
+        assert registry.get_delay(GetFileRequest(None, 1, 1)) > 29, \
+            'Requests with no peer should be blocked by their class'
+
+        registry.record(send_message(2), 0)
+        assert not registry.get_delay(send_message(2)), \
+            'Expired flood waits should not block'
+